@@ -0,0 +1,160 @@
+"""
+Script for comparing the memory used and the correlation error of the reduced precision
+and disk pool storage types against the default float32 pool, and for measuring how many
+rows a pruning index skips when finding the top correlations
+"""
+import argparse
+import sys
+import time
+import numpy as np
+
+from model.compact_matrix import CompactMatrix
+from model.pnl_pool import PnlPool
+
+
+def run_benchmark(pool, query, top, pruning_clusters=0):
+    """
+    Calculates correlations of query against pool stored with each storage type and prints
+    the memory used, the time taken and the errors compared to the float32 pool
+
+    Parameters
+    ----------
+    pool (PnlPool): float32 pool to compare against
+    query (PnlPool): pnls to calculate correlations for
+    top (int): number of top correlations to compare
+    pruning_clusters (int): number of clusters of the pruning index to try, 0 to skip it
+    """
+    start_time = time.time()
+    expected = pool.get_correlations(query)
+    expected_corrs, expected_indices, _ = expected.top_n_indices_for_col(top)
+    print("float32: {0:.1f}MB, top {1} in {2:.4f}s".format(pool.nbytes() / 2 ** 20, top,
+                                                           time.time() - start_time))
+
+    for storage in CompactMatrix.STORAGE_TYPES:
+        compact_pool = PnlPool(data=pool.as_matrix(), header=pool.headers(),
+                               dates=pool.dates(), storage=storage)
+        start_time = time.time()
+        correlations = compact_pool.get_correlations(query)
+        corrs, indices, _ = correlations.top_n_indices_for_col(top)
+        elapsed = time.time() - start_time
+        print("{0}: {1:.1f}MB ({2:.1f}% saved), top {3} in {4:.4f}s".format(
+            storage, compact_pool.nbytes() / 2 ** 20,
+            100 * (1 - compact_pool.nbytes() / pool.nbytes()), top, elapsed))
+        print("    max approximate correlation error: {0:.2e}".format(
+            np.nanmax(np.abs(correlations.as_matrix() - expected.as_matrix()))))
+        print("    max rescored top {0} error: {1:.2e}, same top rows: {2:.2f}%".format(
+            top, np.nanmax(np.abs(corrs - expected_corrs)),
+            100 * np.mean(np.sort(indices, axis=0) == np.sort(expected_indices, axis=0))))
+
+    disk_pool = PnlPool(data=pool.as_matrix(), header=pool.headers(), dates=pool.dates(),
+                        storage="disk")
+    start_time = time.time()
+    correlations = disk_pool.get_correlations(query)
+    elapsed = time.time() - start_time
+    # The first request also reads the pool to calculate the window statistics
+    print("disk: {0:.1f}MB, correlations in {1:.4f}s ({2:.1f}MB/s read)".format(
+        disk_pool.nbytes() / 2 ** 20, elapsed, 2 * pool.nbytes() / 2 ** 20 / elapsed))
+    print("    max correlation error: {0:.2e}".format(
+        np.nanmax(np.abs(correlations.as_matrix() - expected.as_matrix()))))
+
+    if pruning_clusters:
+        run_pruning_benchmark(pool, query, top, pruning_clusters)
+
+
+def run_pruning_benchmark(pool, query, top, pruning_clusters):
+    """
+    Finds the top correlations of query against pool with a pruning index, for the whole query
+    and for each of its pnls alone, and prints the fraction of rows pruned, the time taken and
+    whether the top correlations are the same as calculating every row
+
+    Parameters
+    ----------
+    pool (PnlPool): float32 pool to compare against
+    query (PnlPool): pnls to calculate correlations for
+    top (int): number of top correlations to compare
+    pruning_clusters (int): number of clusters of the pruning index
+    """
+    pruned_pool = PnlPool(data=pool.as_matrix(), header=pool.headers(), dates=pool.dates(),
+                          pruning_clusters=pruning_clusters)
+    # The first request builds the standardized window and the index
+    start_time = time.time()
+    pruned_pool.get_correlations(query, top=top)
+    print("pruning index with {0} clusters: {1:.1f}MB, built in {2:.4f}s".format(
+        pruning_clusters, (pruned_pool.nbytes() - pool.nbytes()) / 2 ** 20,
+        time.time() - start_time))
+    pool.get_correlations(query)
+    queries = [("all {} pnls".format(len(query.headers())), query)] + \
+        [(name, query.select_by_names([name])) for name in query.headers()]
+    pruned_fractions, speedups = [], []
+    for name, single_query in queries:
+        start_time = time.time()
+        expected = pool.get_correlations(single_query).top_n_corrs_for_col(top)
+        full_elapsed = time.time() - start_time
+        start_time = time.time()
+        correlations = pruned_pool.get_correlations(single_query, top=top)
+        corrs, names, _ = correlations.top_n_corrs_for_col(top)
+        elapsed = time.time() - start_time
+        pruned = 1 - len(correlations.row_names()) / correlations.num_pool_rows()
+        if single_query is not query:
+            pruned_fractions.append(pruned)
+            speedups.append(full_elapsed / elapsed)
+        print("    {0}: {1:.1f}% of rows pruned, top {2} in {3:.4f}s instead of {4:.4f}s, "
+              "same top rows: {5}, max error: {6:.2e}".format(
+                  name, 100 * pruned, top, elapsed, full_elapsed,
+                  np.array_equal(names, expected[1]), np.max(np.abs(corrs - expected[0]))))
+    print("    mean for single pnls: {0:.1f}% pruned, {1:.2f} times as fast".format(
+        100 * np.mean(pruned_fractions), np.mean(speedups)))
+
+
+def generate_pool(num_pnls, days, factors=10, noise=2):
+    """
+    Generates pnls driven by a few common factors, so that the pool has a realistic spread
+    of correlations
+
+    Parameters
+    ----------
+    num_pnls (int): number of pnls in the pool
+    days (int): number of days in each pnl
+    factors (int): number of common factors
+    noise (float): volatility of the part of each pnl not explained by the factors
+
+    Returns
+    -------
+    A PnlPool of num_pnls x days float32 pnls
+    """
+    gen = np.random.default_rng(0)
+    factor_returns = gen.standard_normal(size=(factors, days), dtype="float32")
+    loadings = gen.standard_normal(size=(num_pnls, factors), dtype="float32")
+    data = loadings.dot(factor_returns) + gen.standard_normal(size=(num_pnls, days),
+                                                              dtype="float32") * noise
+    # Large means relative to volatility, like cumulative pnls
+    data += gen.uniform(0, 100, size=(num_pnls, 1)).astype("float32")
+    return PnlPool(data=data,
+                   header=np.array(["pnl_" + str(i) for i in range(num_pnls)]),
+                   dates=np.arange(days))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks reduced precision pool storage")
+    parser.add_argument("--path_to_pnls", "--path", action="store", nargs="*", default=None)
+    parser.add_argument("--num_pnls", "-n", action="store", type=int, default=25000)
+    parser.add_argument("--days", action="store", type=int, default=2500)
+    parser.add_argument("--num_queries", action="store", type=int, default=10)
+    parser.add_argument("--top", action="store", type=int, default=10)
+    parser.add_argument("--noise", action="store", type=float, default=2)
+    parser.add_argument("--pruning_clusters", action="store", type=int, default=500)
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.path_to_pnls:
+        benchmark_pool = PnlPool(*args.path_to_pnls)
+    else:
+        benchmark_pool = generate_pool(args.num_pnls, args.days, noise=args.noise)
+    # Query with noisy copies of pool members so the top correlations are meaningful
+    query_data = benchmark_pool.as_matrix()[:args.num_queries]
+    query_data = query_data + np.random.default_rng(1).standard_normal(
+        size=query_data.shape, dtype="float32") * query_data.std(axis=1, keepdims=True) * \
+        min(1, args.noise)
+    benchmark_query = PnlPool(data=query_data,
+                              header=np.array(["query_" + str(i) for i in range(len(query_data))]),
+                              dates=benchmark_pool.dates())
+    run_benchmark(benchmark_pool, benchmark_query, args.top, args.pruning_clusters)
@@ -4,32 +4,65 @@ send a request to the server with the pnl pool
 """
 import argparse
 import sys
+import requests
 
 from model.correlation_request import CorrelationRequest
 from model.pnl_pool import PnlPool
-from utils.request_utils import send_request
+from utils.request_utils import register_pnls, stream_request
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Submits correlation request to server")
-    parser.add_argument("--pnl", action="store", nargs="*", required=True)
+    parser.add_argument("--pnl", action="store", nargs="*", default=None)
+    parser.add_argument("--alpha_ids", action="store", nargs="*", default=None)
+    parser.add_argument("--pool_names", action="store", nargs="*", default=None)
+    parser.add_argument("--pool", action="store", default=None)
+    parser.add_argument("--register", action="store_true", default=False)
     parser.add_argument("--server", action="store", required=True)
     parser.add_argument("--top", action="store", type=int, default=10)
     parser.add_argument("--start_date", action="store", type=int, default=None)
     parser.add_argument("--end_date", action="store", type=int, default=None)
+    parser.add_argument("--windows", action="store", nargs="*", default=None)
+    parser.add_argument("--timeout", action="store", type=float, default=None)
     args = parser.parse_args(sys.argv[1:])
 
     host_port = args.server.split(":")
     if len(host_port) != 2 or not host_port[1].isdigit():
         raise ValueError("--server {} could not be understood".format(args.server))
+    if not (args.pnl or args.alpha_ids or args.pool_names):
+        parser.error("at least one of --pnl, --alpha_ids or --pool_names is required")
+    if args.register and not args.pnl:
+        parser.error("--register requires --pnl")
+    windows = None
+    if args.windows:
+        # START:END for each pnl, where either date can be left out
+        try:
+            windows = [tuple(int(date) if date else None for date in window.split(":"))
+                       for window in args.windows]
+        except ValueError:
+            parser.error("--windows expects START:END dates in YYYYMMDD for each pnl")
 
     try:
-        response = send_request(host_port[0],
-                                host_port[1],
-                                CorrelationRequest(PnlPool(*args.pnl),
-                                                   start=args.start_date,
-                                                   end=args.end_date,
-                                                   top=args.top))
-        print(response.to_string())
+        pnl_data = PnlPool(*args.pnl) if args.pnl else None
+        if args.register:
+            ids = register_pnls(host_port[0], host_port[1], pnl_data, args.pool)
+            for name, alpha_id in zip(pnl_data.headers(), ids):
+                print("{} registered as {}".format(name, alpha_id))
+            sys.exit(0)
+        # Results are printed for each group of pnls as soon as the server sends them
+        for response in stream_request(host_port[0],
+                                       host_port[1],
+                                       CorrelationRequest(pnl_data,
+                                                          start=args.start_date,
+                                                          end=args.end_date,
+                                                          top=args.top,
+                                                          alpha_ids=args.alpha_ids,
+                                                          pool_names=args.pool_names,
+                                                          pool=args.pool,
+                                                          windows=windows),
+                                       timeout=args.timeout):
+            print(response.to_string())
     except ValueError as err:
         print("Received the following error from server: " + str(err))
+    except requests.Timeout:
+        print("Server did not respond within {}s".format(args.timeout))
@@ -2,23 +2,472 @@
 Module for correlation server
 """
 import argparse
+import functools
+import json
 import sys
+import threading
 import time
+import numpy as np
 import tornado
-from tornado.web import url, Application, RequestHandler
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.iostream import StreamClosedError
+from tornado.web import url, Application, RequestHandler, stream_request_body
 
+from model.alpha_store import AlphaStore
+from model.cancellation import CancellationToken, RequestCancelledError
+from model.compact_matrix import CompactMatrix
 from model.correlation_response import CorrelationResponse
 from model.pnl_pool import PnlPool
+from model.pool_registry import PoolRegistry
 
-from utils.request_utils import decode_request
-from utils.response_utils import build_response
+from utils.admission_utils import AdmissionController
+from utils.capture_utils import TrafficRecorder
+from utils.profile_utils import RequestProfiler
+from utils.request_utils import REGISTER_PATH, TIMEOUT_HEADER, RequestDecoder, \
+    decode_request_params, decode_timeout, encode_registered_ids
+from utils.response_utils import build_error, build_response, decode_response_stream
 
+READY_PATH = "/ready"
+PROGRESS_PATH = "/progress"
+POOLS_PATH = "/pools"
+# Name of the pool when the server is given a single pool
+DEFAULT_POOL = "default"
+# Largest request body tornado accepts when not given max_body_size
+_DEFAULT_MAX_BODY_SIZE = 100 * 2 ** 20
 
-class CorrelationRequestHandler(RequestHandler):
+
+@stream_request_body
+class StreamedRequestHandler(RequestHandler):
+    """
+    Base handler for requests with a CorrelationRequest object in the body. The body is
+    decoded as it arrives, so that large requests are never held in memory as a whole
+    before being decoded
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._decode_error = None
+        self._body_size = 0
+        self._capture = None
+        super().__init__(*args, **kwargs)
+        # The body cannot be larger than its Content-Length, nor than the server accepts
+        max_body_size = self.settings.get("max_body_size") or _DEFAULT_MAX_BODY_SIZE
+        content_length = self.request.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit():
+            max_body_size = min(max_body_size, int(content_length))
+        self._decoder = RequestDecoder(max_body_size)
+
+    def data_received(self, chunk):
+        """
+        Called by tornado with each chunk of the body, after prepare()
+
+        Parameters
+        ----------
+        chunk bytes of the body
+        """
+        self._body_size += len(chunk)
+        if self._capture is not None:
+            self._capture.add(chunk)
+        if self._decode_error is not None:
+            return
+        try:
+            self._decoder.feed(chunk)
+        except ValueError as err:
+            self._decode_error = err
+        except Exception as err:
+            # Anything escaping here would drop the connection without answering
+            self._decode_error = ValueError("Could not decode request: {}".format(err))
+
+    def decoded_request(self):
+        """
+        Returns
+        -------
+        The CorrelationRequest object from the body, or None if it could not be decoded,
+        in which case the request is answered with the reason
+        """
+        try:
+            if self._decode_error is not None:
+                raise self._decode_error
+            return self._decoder.finish()
+        except ValueError as err:
+            print("Could not decode request due to " + str(err))
+            self.set_status(400)
+            self.write(str(err))
+            return None
+
+
+class CorrelationRequestHandler(StreamedRequestHandler):
     """
     Handler for Pnl Correlation requests
     """
 
+    def initialize(self, pools, admission, column_group, alpha_store, profiler, serve_partial,
+                   recorder):
+        """
+        Called immediately after object is initialized. Used to pass argument to the object
+
+        Parameters
+        ----------
+        pools PoolRegistry of the pools requests can compute against
+        admission AdmissionController shared by all requests
+        column_group number of columns of a request to calculate and send at a time
+        alpha_store AlphaStore holding the pnls registered by clients
+        profiler RequestProfiler choosing requests to profile, None if profiling is disabled
+        serve_partial whether to answer against the loaded pnl files while the pool is loading
+        recorder TrafficRecorder recording the requests, None if capture is disabled
+        """
+        self._pools = pools
+        self._pool = None
+        self._serve_partial = serve_partial
+        self._admission = admission
+        self._column_group = column_group
+        self._alpha_store = alpha_store
+        self._profiler = profiler
+        self._recorder = recorder
+        self._profile = None
+        self._profile_tags = {}
+        self._admitted = False
+        self._cancellation = None
+
+    def prepare(self):
+        """
+        Rejects the request right away if too many requests are already pending, before
+        its body is received, starts its deadline if the client sent one and starts recording
+        it if capture is enabled. Rejected requests are recorded without their body
+        """
+        body_size = self.request.headers.get("Content-Length")
+        body_size = int(body_size) if body_size else None
+        if not self._admission.admit():
+            print("Rejected correlations request, too many pending requests")
+            self.set_status(503)
+            self.set_header("Retry-After", str(self._admission.retry_after))
+            if self._recorder is not None:
+                self._recorder.reject(body_size, 503)
+            self.finish("Server is busy, please retry later")
+            return
+        self._admitted = True
+        if self._profiler is not None:
+            self._profile = self._profiler.start(self.request.headers)
+        if self._recorder is not None:
+            self._capture = self._recorder.start(body_size)
+        try:
+            self._cancellation = CancellationToken(
+                decode_timeout(self.request.headers.get(TIMEOUT_HEADER)))
+        except ValueError as err:
+            self.set_status(400)
+            self.finish(str(err))
+
+    def on_connection_close(self):
+        """
+        Stops working on the request if the client disconnects before it is answered, and
+        frees its spot in the admission controller, as on_finish() is not called if the
+        client disconnects while sending the body
+        """
+        if self._cancellation is not None:
+            self._cancellation.cancel("client disconnected")
+        self._release()
+
+    def _release(self):
+        """
+        Frees the request's spot in the admission controller, once
+        """
+        if self._admitted:
+            self._admitted = False
+            self._admission.release()
+
+    def on_finish(self):
+        """
+        Frees the request's spot in the admission controller, writes the request's
+        profile if it was profiled and records it if it is being captured
+        """
+        self._release()
+        if self._capture is not None:
+            self._capture.finish(self.get_status())
+        if self._profile is not None:
+            self._profile_tags["bytes"] = self._body_size
+            self._profile_tags["status"] = self.get_status()
+            self._profile.finish(self._profile_tags)
+
+    async def post(self):
+        """
+        We will only be accepting POST requests and
+        expects an CorrelationRequest object in the body
+        """
+        print("Received new correlations request")
+        request = self.decoded_request()
+        if request is None:
+            return
+        try:
+            self._pool = self._pools.find(request.pool)
+            pnl_data = self._resolve_pnls(request)
+        except ValueError as err:
+            print("Could not find pnls of request due to " + str(err))
+            self.set_status(400)
+            self.write(str(err))
+            return
+        if self._pool.loading_error() is not None:
+            print("Rejected correlations request, pool could not be loaded")
+            self.set_status(500)
+            self.write("Pool could not be loaded: " + self._pool.loading_error())
+            return
+        if not self._pool.is_loaded() and \
+                (not self._serve_partial or self._pool.loading_progress()[0] == 0):
+            print("Rejected correlations request, pool is still loading")
+            self.set_status(503)
+            self.set_header("Retry-After", str(self._admission.retry_after))
+            self.write("Pool is still loading, please retry later")
+            return
+        if self._profile is not None:
+            self._profile_tags = {"pnls": len(pnl_data.headers()),
+                                  "start": request.start,
+                                  "end": request.end,
+                                  "pool": len(self._pool.headers())}
+        written_cols = 0
+        self._pool.count_request(request.column_windows())
+        try:
+            async with self._admission.slot(self._cancellation):
+                # Brings the pool back into memory if it was demoted
+                await self._admission.execute(functools.partial(self._pools.get, request.pool))
+                for (start, end), query in self._column_groups(request, pnl_data):
+                    compute = functools.partial(self._compute, request, query, start, end)
+                    if self._profile is not None:
+                        compute = functools.partial(self._profile.call, compute)
+                    response = await self._admission.execute(compute)
+                    # Each group of columns is sent as soon as it is ready, as one line
+                    self.write(build_response(response) + "\n")
+                    await self.flush()
+                    written_cols += len(response.col_names)
+        except (ValueError, RequestCancelledError) as err:
+            print("Stopped calculating correlation after {} columns due to {}"
+                  .format(written_cols, err))
+            reason = str(err) if isinstance(err, ValueError) else "Request cancelled, " + str(err)
+            if written_cols == 0:
+                self.set_status(500 if isinstance(err, ValueError) else 504)
+                self.write(reason)
+            else:
+                # The status was sent with the first group, the reason ends the response
+                self.write(build_error(reason) + "\n")
+        except StreamClosedError:
+            print("Client disconnected after {} columns".format(written_cols))
+
+    def _resolve_pnls(self, request):
+        """
+        Gathers the pnls of a request: the pnls sent with it, followed by the registered pnls it
+        refers to by ID and the pool's pnl files it refers to by name
+
+        Parameters
+        ----------
+        request CorrelationRequest to gather pnls for
+
+        Returns
+        -------
+        PnlPool of all pnls of the request
+        """
+        pnls = [] if request.pnl_data is None else [request.pnl_data]
+        uploaded = 0 if request.pnl_data is None else len(request.pnl_data.headers())
+        alpha_windows = request.column_windows()[uploaded:]
+        for alpha, (start, end) in zip(self._alpha_store.get(request.alpha_ids), alpha_windows):
+            # Keeps the statistics for the pnl's days with the registered pnl
+            alpha.window_stats(start, end)
+            pnls.append(alpha)
+        if len(request.pool_names) > 0:
+            pnls.append(self._pool.select_by_names(request.pool_names))
+        if len(pnls) == 0:
+            raise ValueError("Request has no pnls")
+        return pnls[0] if len(pnls) == 1 else PnlPool.concatenate(pnls)
+
+    def _column_groups(self, request, pnl_data):
+        """
+        Splits the pnls of a request into the groups to calculate at a time. Pnls with the same
+        window are calculated together, in groups of up to column_group pnls. Each group is
+        only taken from the request once the previous one is calculated, sharing the request's
+        data when its pnls are next to each other
+
+        Parameters
+        ----------
+        request CorrelationRequest to calculate
+        pnl_data PnlPool of all pnls of the request
+
+        Returns
+        -------
+        Generator of ((start, end), PnlPool) for each group, in the order each window first
+        appears in the request
+        """
+        columns_by_window = {}
+        for column, window in enumerate(request.column_windows()):
+            columns_by_window.setdefault(window, []).append(column)
+        for window, columns in columns_by_window.items():
+            for col_start in range(0, len(columns), self._column_group):
+                group = columns[col_start:col_start + self._column_group]
+                if group[-1] - group[0] == len(group) - 1:
+                    yield window, pnl_data.subset(group[0], group[-1] + 1)
+                else:
+                    yield window, pnl_data.select_by_indices(group)
+
+    def _compute(self, request, query, start, end):
+        """
+        Calculates the top correlations for a group of columns of a request.
+        Runs in a worker thread
+
+        Parameters
+        ----------
+        request CorrelationRequest to calculate
+        query PnlPool of the request's columns to calculate
+        start start date of the columns' window, inclusive
+        end end date of the columns' window, inclusive
+
+        Returns
+        -------
+        CorrelationResponse for the columns in query
+        """
+        start_time = time.time()
+        correlations = self._pool.get_correlations(query, start, end, self._cancellation,
+                                                   top=request.top)
+        print("Calculated correlations in {0:.4f}s".format(time.time() - start_time))
+        start_time = time.time()
+        top_corrs, top_indices, col_names = correlations.top_n_indices_for_col(request.top)
+        print("Got top {0} correlations in {1:.4f}s".format(request.top, time.time() - start_time))
+        errors = []
+        total = self._pool.loading_progress()[1]
+        if correlations.num_pool_rows() < total:
+            errors.append("pool is still loading, only {} of {} pnl files were included"
+                          .format(correlations.num_pool_rows(), total))
+        return CorrelationResponse(top_corrs, top_indices, correlations.row_names(), col_names,
+                                   errors)
+
+
+class ReadinessHandler(RequestHandler):
+    """
+    Handler telling whether the server can answer correlation requests yet
+    """
+
+    def initialize(self, pools, serve_partial):
+        """
+        Called immediately after object is initialized. Used to pass argument to the object
+
+        Parameters
+        ----------
+        pools PoolRegistry of the pools requests can compute against
+        serve_partial whether requests are answered while the pools are loading
+        """
+        self._pools = pools
+        self._serve_partial = serve_partial
+
+    def get(self):
+        """
+        Answers 200 once the server can answer correlation requests for all pools, 503 before,
+        and 500 with the reasons if a pool could not be loaded
+        """
+        errors = _loading_errors(self._pools)
+        if errors:
+            self.set_status(500)
+            self.write("failed: " + json.dumps(errors))
+            return
+        if not _is_ready(self._pools, self._serve_partial):
+            self.set_status(503)
+            self.write("loading")
+            return
+        self.write("ready")
+
+
+class ProgressHandler(ReadinessHandler):
+    """
+    Handler for how much of the pools has been loaded
+    """
+
+    def get(self):
+        """
+        Answers with the number of pnl files loaded, out of the total for all pools, and why
+        pools could not be loaded, as JSON. The total is null until the files of every pool
+        have been found
+        """
+        progress = [self._pools.find(name).loading_progress() for name in self._pools.names()]
+        loaded = sum(loaded for loaded, _ in progress)
+        total = None
+        if all(total > 0 for _, total in progress):
+            total = sum(total for _, total in progress)
+        self.write(json.dumps({"loaded": loaded,
+                               "total": total,
+                               "fraction": 0 if total is None else loaded / total,
+                               "ready": _is_ready(self._pools, self._serve_partial),
+                               "errors": _loading_errors(self._pools)}))
+
+
+class PoolsHandler(RequestHandler):
+    """
+    Handler for the usage of each pool
+    """
+
+    def initialize(self, pools):
+        """
+        Called immediately after object is initialized. Used to pass argument to the object
+
+        Parameters
+        ----------
+        pools PoolRegistry of the pools requests can compute against
+        """
+        self._pools = pools
+
+    def get(self):
+        """
+        Answers with PoolRegistry.stats() as JSON
+        """
+        self.write(json.dumps(self._pools.stats()))
+
+
+class RegisterRequestHandler(StreamedRequestHandler):
+    """
+    Handler for registering pnls, so that later requests can refer to them by ID
+    """
+
+    def initialize(self, pools, alpha_store):
+        """
+        Called immediately after object is initialized. Used to pass argument to the object
+
+        Parameters
+        ----------
+        pools PoolRegistry of the pools requests can compute against
+        alpha_store AlphaStore holding the pnls registered by clients
+        """
+        self._pools = pools
+        self._alpha_store = alpha_store
+
+    def post(self):
+        """
+        Expects an CorrelationRequest object with the pnls to register in the body,
+        and answers with their IDs
+        """
+        request = self.decoded_request()
+        if request is None:
+            return
+        try:
+            pool = self._pools.find(request.pool)
+        except ValueError as err:
+            self.set_status(400)
+            self.write(str(err))
+            return
+        if request.pnl_data is None or \
+                not np.array_equal(request.pnl_data.dates(), pool.dates()):
+            self.set_status(400)
+            self.write("Registered pnls must have the same dates as the pool")
+            return
+        try:
+            ids = self._alpha_store.register(request.pnl_data)
+        except ValueError as err:
+            self.set_status(400)
+            self.write(str(err))
+            return
+        print("Registered {} pnls, {} registered in total".format(len(ids),
+                                                                len(self._alpha_store)))
+        self.write(encode_registered_ids(ids))
+
+
+class CoordinatorRequestHandler(RequestHandler):
+    """
+    Handler for Pnl Correlation requests when the server fronts correlation servers that
+    each hold a shard of the pool. Forwards the request to every shard concurrently and
+    merges the top correlations of each shard
+    """
+
     def data_received(self, chunk):
         """
         Abstract function from RequestHandler class
@@ -28,57 +477,273 @@ class CorrelationRequestHandler(RequestHandler):
         chunk
         """
 
-    def initialize(self, pool):
+    def initialize(self, shards, shard_timeout):
         """
         Called immediately after object is initialized. Used to pass argument to the object
 
         Parameters
         ----------
-        pool PnlPool object to use for the server
+        shards list of 'host:port' of the correlation servers holding the shards
+        shard_timeout seconds to wait for each shard before leaving it out of the results
         """
-        self._pool = pool
+        self._shards = shards
+        self._shard_timeout = shard_timeout
+        self._timeout = None
 
-    def post(self):
+    async def post(self):
         """
         We will only be accepting POST requests and
         expects an CorrelationRequest object in the body
         """
         print("Received new correlations request")
-        request = decode_request(self.request.body.decode("utf-8"))
         try:
-            start_time = time.time()
-            correlations = self._pool.get_correlations(request.pnl_data, request.start, request.end)
-            print("Calculated correlations in {0:.4f}s".format(time.time() - start_time))
+            self._timeout = decode_timeout(self.request.headers.get(TIMEOUT_HEADER))
+            # Only the parameters are read, the pnls are forwarded to the shards as they are
+            top, num_pnls = decode_request_params(self.request.body)
         except ValueError as err:
-            print("Could not calculate correlation due to " + str(err))
-            self.set_status(500)
+            print("Could not decode request due to " + str(err))
+            self.set_status(400)
             self.write(str(err))
             return
         start_time = time.time()
-        top_corrs, top_names, col_names = correlations.top_n_corrs_for_col(request.top)
-        print("Got top {0} correlations in {1:.4f}s".format(request.top, time.time() - start_time))
-        response = CorrelationResponse(top_corrs, top_names, col_names)
-        self.write(build_response(response))
+        shard_results = await tornado.gen.multi([self._fetch_shard(shard, num_pnls)
+                                                 for shard in self._shards])
+        print("Received responses from {0} shards in {1:.4f}s".format(len(self._shards),
+                                                                     time.time() - start_time))
+        responses = [response for response, _ in shard_results if response is not None]
+        errors = [error for _, error in shard_results if error is not None]
+        if len(responses) == 0:
+            print("All shards failed: " + "; ".join(errors))
+            self.set_status(500)
+            self.write("\n".join(errors))
+            return
+        for error in errors:
+            print("Leaving out shard, " + error)
+        self.write(build_response(CorrelationResponse.merge(responses, top, errors)) + "\n")
+
+    async def _fetch_shard(self, shard, num_pnls):
+        """
+        Forwards the request body to a shard
+
+        Parameters
+        ----------
+        shard 'host:port' of the shard
+        num_pnls number of pnls of the request, the shard failed if it answered fewer
 
+        Returns
+        -------
+        (response, error) where response is the shard's CorrelationResponse, or None if the
+        shard failed, in which case error describes the failure
+        """
+        headers = {"Content-Type": "application/octet-stream"}
+        request_timeout = self._shard_timeout
+        if self._timeout is not None:
+            # Shards stop working on the request once the client's deadline passes
+            headers[TIMEOUT_HEADER] = str(self._timeout)
+            request_timeout = min(request_timeout, self._timeout)
+        try:
+            shard_response = await AsyncHTTPClient().fetch(
+                "http://" + shard, method="POST", body=self.request.body,
+                headers=headers, request_timeout=request_timeout)
+        except HTTPClientError as err:
+            if err.code == 500 and err.response is not None:
+                return None, "{} could not calculate correlation due to {}".format(
+                    shard, err.response.body.decode("utf-8"))
+            return None, "{} failed with {}".format(shard, err)
+        except OSError as err:
+            return None, "{} could not be reached: {}".format(shard, err)
+        shard_body = shard_response.body.decode("utf-8").splitlines()
+        try:
+            groups = list(decode_response_stream(shard_body))
+        except ValueError as err:
+            return None, "{} failed: {}".format(shard, err)
+        received_cols = sum(len(group.col_names) for group in groups)
+        if received_cols != num_pnls:
+            return None, "{} answered {} of {} pnls".format(shard, received_cols, num_pnls)
+        return CorrelationResponse.concatenate(groups), None
 
-def run_server(port, pool_dir):
+
+def make_app(pools, admission=None, column_group=64, alpha_store=None, profiler=None,
+             serve_partial=False, recorder=None, max_body_size=None):
     """
-    Runs the correlation server on a certain port with a PnlPool
-    to be constructed using a specific directory
+    Parameters
+    ----------
+    pools PoolRegistry of the pools requests can compute against, or a single PnlPool to
+          register as DEFAULT_POOL
+    admission AdmissionController limiting pending requests. If None, one with default limits
+    column_group number of columns of a request to calculate and send at a time
+    alpha_store AlphaStore for pnls registered by clients. If None, one with default limits
+    profiler RequestProfiler choosing requests to profile. If None, profiling is disabled
+    serve_partial whether to answer against the loaded pnl files while the pool is loading,
+                  flagging the responses as partial. If False, requests are rejected until then
+    recorder TrafficRecorder recording correlation requests. If None, requests are not recorded
+    max_body_size largest request body in bytes the server is listening with. If None,
+                  tornado's default
 
+    Returns
+    -------
+    tornado Application computing correlations against the pools
+    """
+    if not isinstance(pools, PoolRegistry):
+        pools = PoolRegistry({DEFAULT_POOL: pools})
+    if admission is None:
+        admission = AdmissionController()
+    if alpha_store is None:
+        alpha_store = AlphaStore()
+    return Application([
+        url(r"/", CorrelationRequestHandler, dict(pools=pools, admission=admission,
+                                                  column_group=column_group,
+                                                  alpha_store=alpha_store,
+                                                  profiler=profiler,
+                                                  serve_partial=serve_partial,
+                                                  recorder=recorder)),
+        url(REGISTER_PATH, RegisterRequestHandler, dict(pools=pools, alpha_store=alpha_store)),
+        url(READY_PATH, ReadinessHandler, dict(pools=pools, serve_partial=serve_partial)),
+        url(PROGRESS_PATH, ProgressHandler, dict(pools=pools, serve_partial=serve_partial)),
+        url(POOLS_PATH, PoolsHandler, dict(pools=pools))
+    ], max_body_size=max_body_size)
+
+
+def make_coordinator_app(shards, shard_timeout):
+    """
     Parameters
     ----------
-    port the port to run on
-    pool_dir the directory to build the PnlPool from
-    """
-    print("Starting server on port {} with pnl pool at '{}'".format(port, pool_dir))
-    print("Initializing pnl pool...")
-    pnl_pool = PnlPool(*pool_dir)
-    print("Pool initialized")
-    app = Application([
-        url(r"/", CorrelationRequestHandler, dict(pool=pnl_pool))
+    shards list of 'host:port' of the correlation servers holding the shards
+    shard_timeout seconds to wait for each shard before leaving it out of the results
+
+    Returns
+    -------
+    tornado Application merging correlations from the shards
+    """
+    return Application([
+        url(r"/", CoordinatorRequestHandler, dict(shards=shards, shard_timeout=shard_timeout))
     ])
-    app.listen(port)
+
+
+def run_server(port, pool_dirs, storage="float32", spill_dir=None, admission=None,
+               max_body_size=None, column_group=64, alpha_store=None, profiler=None,
+               load_chunk=1000, serve_partial=False, memory_budget=None, pruning_clusters=0,
+               recorder=None):
+    """
+    Runs the correlation server on a certain port with PnlPools
+    to be constructed using specific directories
+
+    Parameters
+    ----------
+    port the port to run on
+    pool_dirs dict of pool name to the directories and files to build the PnlPool from. The
+              first pool is used for requests that do not name one
+    storage the storage type of the PnlPools
+    spill_dir the directory for the memory mapped pools if storage is not float32, or if
+              they are demoted
+    admission AdmissionController limiting pending requests. If None, one with default limits
+    max_body_size largest request body in bytes. If None, tornado's default
+    column_group number of columns of a request to calculate and send at a time
+    alpha_store AlphaStore for pnls registered by clients. If None, one with default limits
+    profiler RequestProfiler choosing requests to profile. If None, profiling is disabled
+    load_chunk number of pnl files to read at a time while loading the pool in the background
+    serve_partial whether to answer against the loaded pnl files while the pool is loading
+    memory_budget bytes the pools in memory may take before the least recently used ones are
+                  demoted. If None, pools are never demoted
+    pruning_clusters number of clusters of the index used to skip pnl files that cannot be
+                     among the top correlations of float32 pools. If 0, every file is calculated
+    recorder TrafficRecorder recording correlation requests. If None, requests are not recorded
+    """
+    pools = {}
+    for name, dirs in pool_dirs.items():
+        print("Starting server on port {} with pnl pool {} at '{}'".format(port, name, dirs))
+        pools[name] = PnlPool(*dirs, storage=storage, spill_dir=spill_dir, load=False,
+                              pruning_clusters=pruning_clusters)
+    registry = PoolRegistry(pools, memory_budget=memory_budget, spill_dir=spill_dir)
+    # The server listens right away, and reports its progress while the pools are loading
+    threading.Thread(target=_load_pools, args=(pools, load_chunk), daemon=True).start()
+    _listen(make_app(registry, admission, column_group, alpha_store, profiler, serve_partial,
+                     recorder, max_body_size), port, max_body_size)
+    if recorder is not None:
+        recorder.close()
+
+
+def run_coordinator(port, shards, shard_timeout, max_body_size=None):
+    """
+    Runs the correlation server on a certain port as a coordinator for other
+    correlation servers, each holding a shard of the pool
+
+    Parameters
+    ----------
+    port the port to run on
+    shards list of 'host:port' of the correlation servers holding the shards
+    shard_timeout seconds to wait for each shard before leaving it out of the results
+    max_body_size largest request body in bytes. If None, tornado's default
+    """
+    print("Starting coordinator on port {} with shards {}".format(port, shards))
+    _listen(make_coordinator_app(shards, shard_timeout), port, max_body_size)
+
+
+def _load_pools(pools, load_chunk):
+    """
+    Looks for and reads the files of pools created with load=False, a chunk at a time, one pool
+    after the other.
+    A pool that fails to load is left with its error, reported by /ready and /progress, and the
+    next pools are still loaded
+
+    Parameters
+    ----------
+    pools dict of pool name to the PnlPool to load
+    load_chunk number of pnl files to read at a time
+    """
+    for name, pool in pools.items():
+        print("Initializing pnl pool {}...".format(name))
+        start_time = time.time()
+        try:
+            while not pool.load_next(load_chunk):
+                loaded, total = pool.loading_progress()
+                print("Loaded {} of {} pnl files".format(loaded, total))
+        except ValueError as err:
+            print("Stopped loading pool {} due to {}".format(name, err))
+            continue
+        print("Pool {} initialized in {:.4f}s".format(name, time.time() - start_time))
+
+
+def _is_ready(pools, serve_partial):
+    """
+    Parameters
+    ----------
+    pools PoolRegistry of the server
+    serve_partial whether requests are answered while the pools are loading
+
+    Returns
+    -------
+    True if the server can answer correlation requests for all of its pools
+    """
+    return all(pool.is_loaded() or (serve_partial and pool.loading_progress()[0] > 0)
+               for pool in map(pools.find, pools.names()))
+
+
+def _loading_errors(pools):
+    """
+    Parameters
+    ----------
+    pools PoolRegistry of the server
+
+    Returns
+    -------
+    dict of the name of each pool that could not be loaded to why
+    """
+    return {name: pools.find(name).loading_error() for name in pools.names()
+            if pools.find(name).loading_error() is not None}
+
+
+def _listen(app, port, max_body_size):
+    """
+    Runs app on a port until interrupted
+
+    Parameters
+    ----------
+    app the tornado Application to run
+    port the port to run on
+    max_body_size largest request body in bytes. If None, tornado's default
+    """
+    app.listen(port, max_body_size=max_body_size)
     try:
 
         tornado.ioloop.IOLoop.current().start()
@@ -90,7 +755,51 @@ def run_server(port, pool_dir):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Starts PNL correlation server")
-    parser.add_argument("--path_to_pnls", "--path", action="store", nargs="*", required=True)
+    parser.add_argument("--path_to_pnls", "--path", action="store", nargs="*")
+    parser.add_argument("--pools", action="store", nargs="*", default=[])
+    parser.add_argument("--memory_budget_mb", action="store", type=int, default=None)
     parser.add_argument("--port", "-p", action="store", type=int, required=True)
+    parser.add_argument("--storage", action="store", default="float32",
+                        choices=("float32", "disk") + CompactMatrix.STORAGE_TYPES)
+    parser.add_argument("--spill_dir", action="store", default=None)
+    parser.add_argument("--shards", action="store", nargs="*", default=None)
+    parser.add_argument("--shard_timeout", action="store", type=float, default=60)
+    parser.add_argument("--max_concurrent", action="store", type=int, default=1)
+    parser.add_argument("--max_queued", action="store", type=int, default=16)
+    parser.add_argument("--retry_after", action="store", type=int, default=1)
+    parser.add_argument("--max_body_mb", action="store", type=int, default=1024)
+    parser.add_argument("--column_group", action="store", type=int, default=64)
+    parser.add_argument("--max_registered", action="store", type=int, default=10000)
+    parser.add_argument("--registered_ttl", action="store", type=float, default=3600)
+    parser.add_argument("--profile_dir", action="store", default=None)
+    parser.add_argument("--profile_sample_rate", action="store", type=float, default=0)
+    parser.add_argument("--load_chunk", action="store", type=int, default=1000)
+    parser.add_argument("--serve_partial", action="store_true")
+    parser.add_argument("--pruning_clusters", action="store", type=int, default=0)
+    parser.add_argument("--capture_file", action="store", default=None)
+    parser.add_argument("--capture_max_mb", action="store", type=int, default=None)
     args = parser.parse_args(sys.argv[1:])
-    run_server(args.port, args.path_to_pnls)
+    body_size = args.max_body_mb * 2 ** 20
+    named_pools = {DEFAULT_POOL: args.path_to_pnls} if args.path_to_pnls else {}
+    for pool_arg in args.pools:
+        pool_name, _, pool_paths = pool_arg.partition("=")
+        if not pool_name or not pool_paths:
+            parser.error("--pools expects name=path[,path...], got " + pool_arg)
+        named_pools[pool_name] = pool_paths.split(",")
+    if args.shards:
+        run_coordinator(args.port, args.shards, args.shard_timeout, body_size)
+    elif named_pools:
+        run_server(args.port, named_pools, args.storage, args.spill_dir,
+                   AdmissionController(args.max_concurrent, args.max_queued, args.retry_after),
+                   body_size, args.column_group,
+                   AlphaStore(args.max_registered, args.registered_ttl),
+                   RequestProfiler(args.profile_dir, args.profile_sample_rate)
+                   if args.profile_dir else None,
+                   args.load_chunk, args.serve_partial,
+                   args.memory_budget_mb * 2 ** 20 if args.memory_budget_mb else None,
+                   args.pruning_clusters,
+                   TrafficRecorder(args.capture_file, args.capture_max_mb * 2 ** 20
+                                   if args.capture_max_mb else None)
+                   if args.capture_file else None)
+    else:
+        parser.error("one of --path_to_pnls, --pools or --shards is required")
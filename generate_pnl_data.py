@@ -5,6 +5,7 @@ import argparse
 import datetime
 import multiprocessing
 import os
+from multiprocessing import shared_memory
 import sys
 import time
 import numpy as np
@@ -16,51 +17,127 @@ from utils.file_utils import write_to_file
 INSTRUMENTS = 30  # N
 DAYS = 2500  # D
 IDEAS = 10  # K
+# Number of alphas generated from each seed, so that the data does not depend on the workers
+ALPHAS_PER_SEED = 256
 
 
 # @profile
-def generate_data(dir_name, num_files):
+def generate_data(dir_name, num_files, seed=None, workers=None):
     """
     Generates num_files (n) pnl files in specified directory. Each file contains
-    dates, pnl, and turnover. Files are named 'pnl_0', 'pnl_1', ..., 'pnl_n'
+    dates, pnl, and turnover. Files are named 'pnl_0', 'pnl_1', ..., 'pnl_n'.
+    The returns are generated once and shared with worker processes, which each generate,
+    smooth and write blocks of ALPHAS_PER_SEED alphas
 
     Parameters
     ----------
     dir_name (str): directory to store files
     num_files (int): number of files to generate
+    seed (int): seed for all random data. The files are the same for the same seed, whatever
+                the number of workers. If None, a new seed is used and printed
+    workers (int): number of worker processes. If None, the number of CPUs
     """
+    seed_sequence = np.random.SeedSequence(seed)
+    print("Generating with seed {}".format(seed_sequence.entropy))
+    # The first child is for the returns, the others are for each block of alphas
+    returns_seed, *block_seeds = seed_sequence.spawn(1 + -(-num_files // ALPHAS_PER_SEED))
+    gen = np.random.default_rng(returns_seed)
+
     start_time = time.time()
     dates = generate_dates(20090101, DAYS)
-    individual_returns = generate_returns(INSTRUMENTS, DAYS, IDEAS)
+    individual_returns = generate_returns(INSTRUMENTS, DAYS, IDEAS, gen)
     total_returns = np.sum(individual_returns, axis=0)
 
-    returns_noise = normal_as_float32((IDEAS, DAYS, INSTRUMENTS)) * 0.01
+    returns_noise = normal_as_float32((IDEAS, DAYS, INSTRUMENTS), gen) * 0.01
     observed_signals = individual_returns + returns_noise
     print("Generated returns in {0:.4f}s".format(time.time() - start_time))
 
     start_time = time.time()
-    alpha_idea_indices = np.random.randint(IDEAS, size=num_files, dtype="int8")
-    alphas_raw = normal_as_float32((num_files, DAYS, INSTRUMENTS)) * 0.02  # noise
-    alphas_raw += np.take(observed_signals, alpha_idea_indices, axis=0)  # noise + signal
-    print("Generated raw alphas in {0:.4f}s".format(time.time() - start_time))
+    workers = workers or multiprocessing.cpu_count()
+    print("Using {} processes to generate alphas".format(workers))
+    shared = [_to_shared_memory(observed_signals), _to_shared_memory(total_returns)]
+    try:
+        shared_arrays = [(memory.name, array.shape) for memory, array in
+                         zip(shared, [observed_signals, total_returns])]
+        tasks = [(dir_name, dates, shared_arrays, block_start,
+                  min(block_start + ALPHAS_PER_SEED, num_files), block_seed)
+                 for block_start, block_seed in zip(range(0, num_files, ALPHAS_PER_SEED),
+                                                    block_seeds)]
+        with multiprocessing.Pool(processes=workers) as pool:
+            pool.map(_generate_alphas, tasks, chunksize=1)
+    finally:
+        for memory in shared:
+            memory.close()
+            memory.unlink()
+    print("Generated and wrote {0} alphas in {1:.4f}s".format(num_files,
+                                                              time.time() - start_time))
+
+
+def _generate_alphas(task):
+    """
+    Generates alphas from the shared returns and writes their pnl and turnover to files.
+    Runs in a worker process
 
-    lambdas = np.random.uniform(low=0.0, high=1.0, size=num_files).astype("float32")
-    start_time = time.time()
-    alphas_smoothed = apply_smoothing(alphas_raw, lambdas)
-    del alphas_raw
-    print("Applied smoothing in {0:.4f}s".format(time.time() - start_time))
+    Parameters
+    ----------
+    task (tuple): (dir_name, dates, shared_arrays, start, end, seed) where shared_arrays is
+                  [(name, shape)] of the shared memory holding the observed signals and the
+                  total returns, the alphas are numbered [start, end) and seed is the
+                  SeedSequence for them
+    """
+    dir_name, dates, shared_arrays, start, end, seed = task
+    memories, (observed_signals, total_returns) = _from_shared_memory(shared_arrays)
+    try:
+        gen = np.random.default_rng(seed)
+        num_alphas = end - start
+        alpha_idea_indices = gen.integers(IDEAS, size=num_alphas, dtype="int8")
+        lambdas = gen.uniform(low=0.0, high=1.0, size=num_alphas).astype("float32")
+        alphas_raw = normal_as_float32((num_alphas, DAYS, INSTRUMENTS), gen) * 0.02  # noise
+        alphas_raw += np.take(observed_signals, alpha_idea_indices, axis=0)  # noise + signal
+
+        alphas_smoothed = apply_smoothing(alphas_raw, lambdas)
+        del alphas_raw
+        pnls = calculate_pnls(alphas_smoothed, total_returns)
+        tvrs = calculate_turnovers(alphas_smoothed)
+        for i in range(num_alphas):
+            write_to_file(os.path.join(dir_name, "pnl_" + str(start + i)),
+                          dates, pnls[i, :], tvrs[i, :])
+    finally:
+        del observed_signals, total_returns
+        for memory in memories:
+            memory.close()
+
+
+def _to_shared_memory(array):
+    """
+    Parameters
+    ----------
+    array (ndarray): float32 array to share with worker processes
 
-    start_time = time.time()
-    pnls = calculate_pnls(alphas_smoothed, total_returns)
-    print("Calculated pnls in {0:.4f}s".format(time.time() - start_time))
+    Returns
+    -------
+    A SharedMemory holding a copy of array. It must be closed and unlinked once done with
+    """
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype="float32", buffer=memory.buf)[:] = array
+    return memory
 
-    start_time = time.time()
-    tvrs = calculate_turnovers(alphas_smoothed)
-    print("Calculated turnovers in {0:.4f}s".format(time.time() - start_time))
 
-    start_time = time.time()
-    write_to_directory_parallel(dir_name, dates, pnls, tvrs)
-    print("Wrote to files in {0:.4f}s".format(time.time() - start_time))
+def _from_shared_memory(shared_arrays):
+    """
+    Parameters
+    ----------
+    shared_arrays (list(tuple)): [(name, shape)] of float32 arrays from _to_shared_memory()
+
+    Returns
+    -------
+    (memories, arrays) where memories are the SharedMemory objects to close once done with
+    the arrays, which are views of them
+    """
+    # Workers share the parent's resource tracker, so the memory is only unlinked by the parent
+    memories = [shared_memory.SharedMemory(name=name) for name, _ in shared_arrays]
+    return memories, [np.ndarray(shape, dtype="float32", buffer=memory.buf)
+                      for memory, (_, shape) in zip(memories, shared_arrays)]
 
 
 def generate_dates(start_date, n):
@@ -90,7 +167,7 @@ def generate_dates(start_date, n):
     return np.array(dates, dtype="int32")
 
 
-def generate_returns(instruments, days, k):
+def generate_returns(instruments, days, k, gen):
     """
     Generates k (days x instruments) matrices. Matrices have mean 0 and standard deviation
     of 0.02 / sqrt(n) for n in 1...k. Not doing a lot of optimizing here since instruments,
@@ -101,6 +178,7 @@ def generate_returns(instruments, days, k):
     instruments (int): number of different instruments
     days (int): number of days
     k (int): number of matrices to generate
+    gen (np.random.Generator): generator to sample from
 
     Returns
     -------
@@ -108,7 +186,7 @@ def generate_returns(instruments, days, k):
     """
     result = []
     for denom in range(1, k + 1):
-        result.append(np.random.normal(0, 0.02 / np.sqrt(denom), (days, instruments)))
+        result.append(gen.normal(0, 0.02 / np.sqrt(denom), (days, instruments)))
     return np.array(result, dtype="float32")
 
 
@@ -181,29 +259,7 @@ def calculate_turnovers(alphas):
     return turnover
 
 
-def write_to_directory_parallel(dir_name, dates, pnls, tvrs):
-    """
-    Writes pnls and tvrs, along with dates, to files in a directory
-
-    Parameters
-    ----------
-    dir_name (str): name of directory
-    dates (ndarray): dates (same for all pnls and tvrs), length D
-    pnls (ndarray): (n x D) pnl, where n is the number of files to write to
-    tvrs (ndarray): (n x D) turnover, where n is the number of files to write to
-    """
-    num_files, _ = pnls.shape
-    workers = multiprocessing.cpu_count()
-    print("Using {} CPUs to write files".format(workers))
-    pool = multiprocessing.Pool(processes=workers)
-    pool.starmap(write_to_file, [(os.path.join(dir_name, "pnl_" + str(i)),
-                                  dates,
-                                  pnls[i, :],
-                                  tvrs[i, :])
-                                 for i in range(num_files)])
-
-
-def normal_as_float32(size):
+def normal_as_float32(size, gen):
     """
     Since we cannot pass dtype to np.random.normal(), it generates float64 by default. For
     generating large amounts of data, using a smaller type can be a lot more efficient, so this
@@ -214,12 +270,12 @@ def normal_as_float32(size):
     Parameters
     ----------
     size (tuple): size to generate
+    gen (np.random.Generator): generator to sample from
 
     Returns
     -------
     Data sampled from standard normal distribution of appropriate size
     """
-    gen = np.random.default_rng()
     return gen.standard_normal(size=size, dtype="float32")
 
 
@@ -228,6 +284,8 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", "-o", action="store", required=True)
     parser.add_argument("--num_pnls", "-n", action="store", type=int, required=True)
     parser.add_argument("--force", "-f", action="store_true", default=False)
+    parser.add_argument("--seed", "-s", action="store", type=int, default=None)
+    parser.add_argument("--workers", "-w", action="store", type=int, default=None)
     args = parser.parse_args(sys.argv[1:])
     dir_name = args.output_dir
     files_to_generate = args.num_pnls
@@ -245,4 +303,4 @@ if __name__ == "__main__":
         else:
             raise ValueError("Directory not empty and --force not specified.")
 
-    generate_data(dir_name, files_to_generate)
+    generate_data(dir_name, files_to_generate, args.seed, args.workers)
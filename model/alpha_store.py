@@ -0,0 +1,94 @@
+"""
+Defines a store for pnls that clients register once and then refer to by ID
+"""
+import collections
+import time
+import uuid
+
+from model.pnl_pool import PnlPool
+
+
+class AlphaStore:
+    """
+    Holds registered pnls, each as a single pnl PnlPool with its window statistics already
+    calculated. Keeps at most max_alphas pnls, dropping the least recently used one first,
+    and drops pnls that have not been used for ttl seconds
+    """
+
+    def __init__(self, max_alphas=10000, ttl=3600):
+        """
+        Parameters
+        ----------
+        max_alphas (int): maximum number of pnls to keep
+        ttl (float): seconds after its last use that a pnl is dropped
+        """
+        self._max_alphas = max_alphas
+        self._ttl = ttl
+        # ID -> (PnlPool, time of last use), from least to most recently used
+        self._alphas = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._alphas)
+
+    def register(self, pnl_data):
+        """
+        Stores each pnl of a pool and calculates its statistics over all of its days
+
+        Parameters
+        ----------
+        pnl_data (PnlPool): pnls to register
+
+        Returns
+        -------
+        list(str) of the IDs of the pnls, in the same order as pnl_data. Raises ValueError if
+        there are more pnls than the store keeps, as some of them would be dropped right away
+        """
+        if len(pnl_data.headers()) > self._max_alphas:
+            raise ValueError("Cannot register {} pnls at once, at most {} are kept".format(
+                len(pnl_data.headers()), self._max_alphas))
+        self._expire()
+        ids = []
+        for i in range(len(pnl_data.headers())):
+            # Copied so that the request the pnls came in with can be freed
+            alpha = PnlPool(data=pnl_data.as_matrix()[i:i + 1].copy(),
+                            header=pnl_data.headers()[i:i + 1],
+                            dates=pnl_data.dates())
+            alpha.window_stats()
+            alpha_id = uuid.uuid4().hex
+            self._alphas[alpha_id] = (alpha, time.monotonic())
+            ids.append(alpha_id)
+        while len(self._alphas) > self._max_alphas:
+            self._alphas.popitem(last=False)
+        return ids
+
+    def get(self, alpha_ids):
+        """
+        Parameters
+        ----------
+        alpha_ids (list(str)): IDs returned by register()
+
+        Returns
+        -------
+        list(PnlPool) of the single pnl pools for each ID, in the same order as alpha_ids
+        """
+        self._expire()
+        unknown = [alpha_id for alpha_id in alpha_ids if alpha_id not in self._alphas]
+        if len(unknown) > 0:
+            raise ValueError("Unknown or expired pnl IDs: " + ", ".join(unknown))
+        alphas = []
+        for alpha_id in alpha_ids:
+            alpha, _ = self._alphas.pop(alpha_id)
+            self._alphas[alpha_id] = (alpha, time.monotonic())
+            alphas.append(alpha)
+        return alphas
+
+    def _expire(self):
+        """
+        Drops pnls that have not been used for ttl seconds
+        """
+        oldest_allowed = time.monotonic() - self._ttl
+        while len(self._alphas) > 0:
+            alpha_id, (_, last_used) = next(iter(self._alphas.items()))
+            if last_used >= oldest_allowed:
+                break
+            del self._alphas[alpha_id]
@@ -0,0 +1,54 @@
+"""
+Defines a class for cooperatively cancelling long running computations
+"""
+import time
+
+
+class RequestCancelledError(Exception):
+    """
+    Raised when a computation is stopped because its request was cancelled
+    """
+
+
+class CancellationToken:
+    """
+    Shared between whoever may cancel a request (e.g. the server, when the client disconnects)
+    and the computation for the request, which calls check() between chunks of work
+    """
+
+    def __init__(self, timeout=None):
+        """
+        Parameters
+        ----------
+        timeout (float): seconds from now after which the request is cancelled. If None,
+                         the request is only cancelled by calling cancel()
+        """
+        self._deadline = None if timeout is None else time.monotonic() + timeout
+        self._reason = None
+
+    def cancel(self, reason):
+        """
+        Parameters
+        ----------
+        reason (str): why the request was cancelled
+        """
+        self._reason = reason
+
+    def remaining(self):
+        """
+        Returns
+        -------
+        Seconds until the deadline, or None if there is no deadline
+        """
+        if self._deadline is None:
+            return None
+        return max(self._deadline - time.monotonic(), 0)
+
+    def check(self):
+        """
+        Raises RequestCancelledError if the request was cancelled or its deadline has passed
+        """
+        if self._reason is not None:
+            raise RequestCancelledError(self._reason)
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise RequestCancelledError("deadline exceeded")
@@ -0,0 +1,101 @@
+"""
+Module for storing a pnl matrix in reduced precision. Used by PnlPool when
+it is created with a storage type other than float32
+"""
+import numpy as np
+
+# Number of rows converted at a time, bounds the size of the float32/float64 temporaries
+BLOCK_ROWS = 1024
+
+
+class CompactMatrix:
+    """
+    Stores each row of a matrix standardized over all of its columns, in either float16 or
+    int8 with a per row scale. Since correlation does not change when a row is shifted and
+    scaled, correlations over any range of columns can be calculated from the standardized
+    rows instead of the original data. Standardizing also keeps values in a small range so
+    that float16 and int8 lose as little precision as possible.
+    """
+
+    STORAGE_TYPES = ("float16", "int8")
+
+    def __init__(self, data, storage):
+        """
+        Parameters
+        ----------
+        data (ndarray): N x D, the matrix to store
+        storage (str): one of STORAGE_TYPES
+        """
+        if storage not in self.STORAGE_TYPES:
+            raise ValueError("Unknown storage type {}, expected one of {}"
+                             .format(storage, ", ".join(self.STORAGE_TYPES)))
+        self._storage = storage
+        self._values = np.empty(shape=data.shape, dtype=storage)
+        # int8 rows are stored as value / scale, float16 rows are stored as is
+        self._scales = np.ones(len(data), dtype="float32") if storage == "int8" else None
+        for row_start in range(0, len(data), BLOCK_ROWS):
+            row_end = min(row_start + BLOCK_ROWS, len(data))
+            self._store_block(row_start, row_end, data[row_start:row_end])
+
+    @property
+    def shape(self):
+        """
+        Returns
+        -------
+        (N, D), the shape of the stored matrix
+        """
+        return self._values.shape
+
+    @property
+    def nbytes(self):
+        """
+        Returns
+        -------
+        Number of bytes used to hold the matrix in memory
+        """
+        scale_bytes = 0 if self._scales is None else self._scales.nbytes
+        return self._values.nbytes + scale_bytes
+
+    def blocks(self, start_col=0, end_col=None):
+        """
+        Upcasts the standardized rows back to float32, BLOCK_ROWS rows at a time
+
+        Parameters
+        ----------
+        start_col (int): index of first column to return, inclusive
+        end_col (int): index of last column to return, exclusive. If None, use all columns
+
+        Returns
+        -------
+        Generator of (row_start, block) where block is a float32 ndarray holding rows
+        starting at row_start and columns in [start_col, end_col)
+        """
+        for row_start in range(0, self.shape[0], BLOCK_ROWS):
+            row_end = min(row_start + BLOCK_ROWS, self.shape[0])
+            block = self._values[row_start:row_end, start_col:end_col].astype("float32")
+            if self._scales is not None:
+                block *= self._scales[row_start:row_end, np.newaxis]
+            yield row_start, block
+
+    def _store_block(self, row_start, row_end, block):
+        """
+        Standardizes block and writes it into rows [row_start, row_end)
+
+        Parameters
+        ----------
+        row_start (int): first row of the block, inclusive
+        row_end (int): last row of the block, exclusive
+        block (ndarray): (row_end - row_start) x D rows to store
+        """
+        block = np.asarray(block, dtype="float64")
+        std = block.std(axis=1, keepdims=True)
+        # Constant rows have no defined correlation, we store them as zeros
+        std[std == 0] = 1
+        standardized = (block - block.mean(axis=1, keepdims=True)) / std
+        if self._scales is None:
+            self._values[row_start:row_end] = standardized
+            return
+        scales = np.abs(standardized).max(axis=1, initial=0) / np.iinfo("int8").max
+        scales[scales == 0] = 1
+        self._scales[row_start:row_end] = scales
+        self._values[row_start:row_end] = np.rint(standardized / scales[:, np.newaxis])
@@ -9,16 +9,60 @@ class CorrelationRequest:
     like a dict with hardcoded keys
     """
 
-    def __init__(self, pnl_data, start=None, end=None, top=10):
+    def __init__(self, pnl_data, start=None, end=None, top=10, alpha_ids=None, pool_names=None,
+                 pool=None, windows=None):
         """
         Parameters
         ----------
-        pnl_data (PnlPool): pnl files to compute correlation against
+        pnl_data (PnlPool): pnl files to compute correlation against, can be None if alpha_ids
+                            or pool_names are given
         start (int): YYYYMMDD, start date of correlation computation, inclusive
         end (int): YYYYMMDD, end date of correlation computation, inclusive
         top (int): the top results the server should return
+        alpha_ids (list(str)): IDs of pnls registered with the server to also compute
+                               correlation against
+        pool_names (list(str)): names of pnl files in the server's pool to also compute
+                                correlation against
+        pool (str): name of the server's pool to compute correlation with. If None, the
+                    server's default pool
+        windows (list(tuple)): (start, end) dates of each pnl, in the order of the uploaded
+                               pnls, alpha_ids then pool_names, to compute its correlation over
+                               instead of start and end. Either date can be None, for the
+                               earliest or latest. If None, all pnls use start and end
         """
         self.pnl_data = pnl_data
         self.start = start
         self.end = end
         self.top = top
+        self.alpha_ids = list(alpha_ids) if alpha_ids else []
+        self.pool_names = list(pool_names) if pool_names else []
+        self.pool = pool
+        self.windows = None
+        if windows is not None:
+            if len(windows) != self.num_pnls():
+                raise ValueError("Request has {} pnls but {} windows"
+                                 .format(self.num_pnls(), len(windows)))
+            if any(not isinstance(window, (list, tuple)) or len(window) != 2
+                   for window in windows):
+                raise ValueError("Windows must be (start, end) pairs")
+            self.windows = [tuple(window) for window in windows]
+
+    def num_pnls(self):
+        """
+        Returns
+        -------
+        The number of pnls the request computes correlation against
+        """
+        uploaded = 0 if self.pnl_data is None else len(self.pnl_data.headers())
+        return uploaded + len(self.alpha_ids) + len(self.pool_names)
+
+    def column_windows(self):
+        """
+        Returns
+        -------
+        list((start, end)) of the dates to compute correlation over for each pnl, in the order
+        of the uploaded pnls, alpha_ids then pool_names
+        """
+        if self.windows is None:
+            return [(self.start, self.end)] * self.num_pnls()
+        return self.windows
@@ -1,27 +1,121 @@
 """
 Defines a class for storing correlation results
 """
+import numpy as np
 import pandas as pd
 
+from model.correlations import top_n_indices
+
 
 class CorrelationResponse:
     """
     Stores correlation results
     """
 
-    def __init__(self, corrs_matrix, names_matrix, col_names):
+    def __init__(self, corrs_matrix, row_indices, row_names, col_names, errors=None):
         """
         Parameters
         ----------
         corrs_matrix (ndarray): N x M, correlations
-        names_matrix (ndarray): N x M, labels (file names) from server matching correlations
-                                in corrs_matrix
+        row_indices (ndarray): N x M, indices into row_names of the labels (file names) from
+                               server matching correlations in corrs_matrix
+        row_names (ndarray): labels (file names) from server referenced by row_indices
         col_names (ndarray): M x 1, labels (file names) from client request
+        errors (list(str)): reasons why parts of the pool were not included in the results,
+                            if the results are partial
         """
         self.corrs_matrix = corrs_matrix
-        self.names_matrix = names_matrix
+        self.row_indices = row_indices
+        self.row_names = np.asarray(row_names)
         self.col_names = col_names
+        self.errors = list(errors) if errors else []
         self._rows = len(corrs_matrix)
+        self._names_matrix = None
+
+    @classmethod
+    def merge(cls, responses, top, errors=None):
+        """
+        Combines responses computed against different parts of a pool into the
+        response for the whole pool
+
+        Parameters
+        ----------
+        responses (list(CorrelationResponse)): at least one response, all for the same columns
+        top (int): the number of top correlations to keep for each column
+        errors (list(str)): additional errors to report along with the errors of responses
+
+        Returns
+        -------
+        A CorrelationResponse holding the top correlations across all responses
+        """
+        offsets = np.cumsum([0] + [len(response.row_names) for response in responses])
+        corrs = np.concatenate([response.corrs_matrix for response in responses])
+        indices = np.concatenate([response.row_indices + offset
+                                  for response, offset in zip(responses, offsets)])
+        order = top_n_indices(corrs, min(top, len(corrs)))
+        all_errors = [error for response in responses for error in response.errors]
+        return cls(np.take_along_axis(corrs, order, axis=0),
+                   np.take_along_axis(indices, order, axis=0),
+                   np.concatenate([response.row_names for response in responses]),
+                   responses[0].col_names,
+                   errors=all_errors + (errors or []))
+
+    @classmethod
+    def concatenate(cls, responses):
+        """
+        Combines responses for different columns of the same request into one response
+
+        Parameters
+        ----------
+        responses (list(CorrelationResponse)): at least one response, all with the same number
+                                               of rows
+
+        Returns
+        -------
+        A CorrelationResponse holding the columns of all responses, in order
+        """
+        offsets = np.cumsum([0] + [len(response.row_names) for response in responses])
+        return cls(np.hstack([response.corrs_matrix for response in responses]),
+                   np.hstack([response.row_indices + offset
+                              for response, offset in zip(responses, offsets)]),
+                   np.concatenate([response.row_names for response in responses]),
+                   np.concatenate([response.col_names for response in responses]),
+                   errors=[error for response in responses for error in response.errors])
+
+    @property
+    def partial(self):
+        """
+        Returns
+        -------
+        True if parts of the pool were not included in the results
+        """
+        return len(self.errors) > 0
+
+    @property
+    def names_matrix(self):
+        """
+        Resolves row_indices into names the first time it is accessed, as most
+        of the time we only need the names of one column at a time
+
+        Returns
+        -------
+        N x M ndarray of labels (file names) from server matching correlations in corrs_matrix
+        """
+        if self._names_matrix is None:
+            self._names_matrix = self.row_names[self.row_indices]
+        return self._names_matrix
+
+    def names_for_col(self, col):
+        """
+        Parameters
+        ----------
+        col (int): index of the column in col_names
+
+        Returns
+        -------
+        N x 1 ndarray of labels (file names) from server for a single column
+        """
+        return self.row_names[self.row_indices[:, col]]
 
     def to_string(self):
         """
@@ -31,7 +125,9 @@ class CorrelationResponse:
         """
         data = {}
         for i in range(len(self.col_names)):
-            data[(self.col_names[i], "file_name:")] = self.names_matrix[:, i]
+            data[(self.col_names[i], "file_name:")] = self.names_for_col(i)
             data[(self.col_names[i], "correlation:")] = self.corrs_matrix[:, i]
         df = pd.DataFrame(data, index=range(1, self._rows+1))
-        return df.to_string()
+        if not self.partial:
+            return df.to_string()
+        return "\n".join([df.to_string(), "Partial results:"] + self.errors)
@@ -10,22 +10,61 @@ class Correlations:
     Stores correlation information and can calculate top correlations
     """
 
-    def __init__(self, corr_matrix, row_names, col_names):
+    def __init__(self, corr_matrix, row_names, col_names, rescorer=None, rescore_factor=4,
+                 pool_rows=None):
         """
         Parameters
         ----------
         corr_matrix (ndarray): N x M, all correlations
         row_names (ndarray): N x 1, row index (labels from server's pool)
         col_names (ndarray): M x 1, column index (labels from client's request)
+        rescorer (callable): If corr_matrix only holds approximations, a function taking a
+                             K x M ndarray of row indices and returning the K x M exact
+                             correlations for those rows. None if corr_matrix is exact
+        rescore_factor (int): When there is a rescorer, the top (rescore_factor * n)
+                              approximate correlations are rescored before picking the top n
+        pool_rows (int): Number of rows of the pool the correlations are for, when only the rows
+                         that may be among the top correlations were calculated. If None, N
         """
         if len(corr_matrix.shape) > 2:
             raise ValueError("Not supporting correlation matrices with more than 2 dimensions")
         if len(corr_matrix.shape) == 1:
-            self._corr_matrix, self._row_matrix = np.atleast_2d(corr_matrix, row_names)
+            self._corr_matrix = np.atleast_2d(corr_matrix)
         else:
             self._corr_matrix = corr_matrix
-            self._row_matrix = np.repeat(row_names, corr_matrix.shape[1]).reshape(corr_matrix.shape)
+        # Row names are only looked up for the top results, so we keep them as a
+        # flat array instead of repeating them into an N x M matrix of strings
+        self._row_names = np.asarray(row_names).reshape(-1)
         self._col_names = col_names
+        self._rescorer = rescorer
+        self._rescore_factor = rescore_factor
+        self._pool_rows = len(self._row_names) if pool_rows is None else pool_rows
+
+    def as_matrix(self):
+        """
+        Returns
+        -------
+        The N x M ndarray of all correlations. If there is a rescorer, these are
+        the approximate correlations
+        """
+        return self._corr_matrix
+
+    def row_names(self):
+        """
+        Returns
+        -------
+        An N x 1 ndarray of the row labels (file names from the server's pool)
+        """
+        return self._row_names
+
+    def num_pool_rows(self):
+        """
+        Returns
+        -------
+        Number of rows of the pool the correlations were calculated against, including the
+        rows skipped because they could not be among the top correlations
+        """
+        return self._pool_rows
 
     def top_n_corrs_for_col(self, n):
         """
@@ -43,10 +82,51 @@ class Correlations:
             names (ndarray): n x M, names of top correlations
             col_names(ndarray): M x 1, name of columns
         """
+        corrs, indices, col_names = self.top_n_indices_for_col(n)
+        return corrs, self._row_names[indices], col_names
+
+    def top_n_indices_for_col(self, n):
+        """
+        Same as top_n_corrs_for_col, but returns the row indices of the top correlations
+        instead of their names, so that callers can resolve names only when needed
+
+        Parameters
+        ----------
+        n (int): Greater than 0, the top number of correlations to return
+
+        Returns
+        -------
+        (corrs, indices, col_names) where
+            corrs (ndarray): n x M, top correlations
+            indices (ndarray): n x M, row indices (into row_names()) of top correlations
+            col_names(ndarray): M x 1, name of columns
+        """
         num_rows = len(self._corr_matrix)
         if n > num_rows:
             n = num_rows
-        indices = np.argsort(np.abs(self._corr_matrix), axis=0)[num_rows - n:num_rows, :][::-1]
-        corrs = np.take_along_axis(self._corr_matrix, indices, axis=0)
-        names = np.take_along_axis(self._row_matrix, indices, axis=0)
-        return corrs, names, self._col_names
+        if self._rescorer is None:
+            indices = top_n_indices(self._corr_matrix, n)
+            corrs = np.take_along_axis(self._corr_matrix, indices, axis=0)
+            return corrs, indices, self._col_names
+        candidates = top_n_indices(self._corr_matrix, min(n * self._rescore_factor, num_rows))
+        candidate_corrs = self._rescorer(candidates)
+        order = top_n_indices(candidate_corrs, n)
+        return (np.take_along_axis(candidate_corrs, order, axis=0),
+                np.take_along_axis(candidates, order, axis=0),
+                self._col_names)
+
+
+def top_n_indices(corr_matrix, n):
+    """
+    Parameters
+    ----------
+    corr_matrix (ndarray): N x M, correlations
+    n (int): number of indices to return for each column, at most N
+
+    Returns
+    -------
+    n x M ndarray of the row indices of the largest absolute correlations in each column,
+    from largest to smallest
+    """
+    num_rows = len(corr_matrix)
+    return np.argsort(np.abs(corr_matrix), axis=0)[num_rows - n:num_rows, :][::-1]
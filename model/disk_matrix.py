@@ -0,0 +1,120 @@
+"""
+Module for keeping a pnl matrix in a file instead of memory. Used by PnlPool when
+it is created with "disk" storage
+"""
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Bytes read from the file at a time when scanning the matrix
+DISK_BLOCK_BYTES = 64 * 2 ** 20
+
+
+class DiskMatrix:
+    """
+    Stores a matrix in a temporary file, memory mapped for reading and writing single rows.
+    Scans read the file in large sequential blocks of rows instead of faulting in one page at a
+    time, and read the next block in a background thread while the current one is being used
+    """
+
+    def __init__(self, shape, dtype="float32", spill_dir=None, block_bytes=None):
+        """
+        Parameters
+        ----------
+        shape (tuple): (N, D), the shape of the matrix
+        dtype (str): type of the values of the matrix
+        spill_dir (str): directory for the file, None for the system's temporary directory
+        block_bytes (int): bytes to read at a time when scanning. If None, DISK_BLOCK_BYTES
+        """
+        # The file is removed as soon as it is closed, which happens when this is collected
+        self._file = tempfile.TemporaryFile(dir=spill_dir)
+        dtype = np.dtype(dtype)
+        self._row_bytes = shape[1] * dtype.itemsize
+        self._file.truncate(shape[0] * self._row_bytes)
+        self._array = np.memmap(self._file, dtype=dtype, mode="r+", shape=shape)
+        block_bytes = DISK_BLOCK_BYTES if block_bytes is None else block_bytes
+        self.block_rows = max(1, block_bytes // max(self._row_bytes, 1))
+        if hasattr(os, "posix_fadvise"):
+            # Lets the kernel read further ahead of our sequential reads
+            os.posix_fadvise(self._file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    @property
+    def shape(self):
+        """
+        Returns
+        -------
+        (N, D), the shape of the stored matrix
+        """
+        return self._array.shape
+
+    @property
+    def array(self):
+        """
+        Returns
+        -------
+        The matrix as an N x D memory mapped ndarray
+        """
+        return self._array
+
+    def blocks(self, rows=None, start_col=0, end_col=None):
+        """
+        Reads the first rows of the matrix, block_rows rows at a time. Each block is read into
+        one of two buffers while the previous block is being used, so a block must not be used
+        after asking for the next one
+
+        Parameters
+        ----------
+        rows (int): number of rows to read. If None, all rows
+        start_col (int): index of first column to return, inclusive
+        end_col (int): index of last column to return, exclusive. If None, use all columns
+
+        Returns
+        -------
+        Generator of (row_start, block) where block is an ndarray holding rows starting at
+        row_start and columns in [start_col, end_col)
+        """
+        rows = self.shape[0] if rows is None else rows
+        starts = list(range(0, rows, self.block_rows))
+        buffers = [np.empty(shape=(min(self.block_rows, rows), self.shape[1]),
+                            dtype=self._array.dtype) for _ in starts[:2]]
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            pending = [prefetcher.submit(self._read, row_start, rows, buffers[i % 2])
+                       for i, row_start in enumerate(starts[:1])]
+            for i, row_start in enumerate(starts):
+                block = pending.pop().result()
+                if i + 1 < len(starts):
+                    pending.append(prefetcher.submit(self._read, starts[i + 1], rows,
+                                                     buffers[(i + 1) % 2]))
+                yield row_start, block[:, start_col:end_col]
+
+    def _read(self, row_start, rows, buffer):
+        """
+        Reads rows of the matrix from the file. The read does not hold the GIL, so it runs
+        alongside the matrix products of the block before
+
+        Parameters
+        ----------
+        row_start (int): first row to read
+        rows (int): number of rows of the matrix being scanned, the block stops there
+        buffer (ndarray): block_rows x D array to read into
+
+        Returns
+        -------
+        The part of buffer holding rows [row_start, min(row_start + block_rows, rows))
+        """
+        block = buffer[:min(self.block_rows, rows - row_start)]
+        view = memoryview(block.reshape(-1).view("uint8"))
+        offset = row_start * self._row_bytes
+        read = 0
+        while read < len(view):
+            if hasattr(os, "preadv"):
+                count = os.preadv(self._file.fileno(), [view[read:]], offset + read)
+            else:
+                chunk = os.pread(self._file.fileno(), len(view) - read, offset + read)
+                view[read:read + len(chunk)] = chunk
+                count = len(chunk)
+            if count == 0:
+                raise OSError("Pool file ended before row {}".format(rows))
+            read += count
+        return block
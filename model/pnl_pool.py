@@ -1,14 +1,34 @@
 """
 Module for storing pnl files in memory for faster access
 """
+import collections
+import functools
 import os
 import json
+import tempfile
 import time
 import numpy as np
 
+from model.compact_matrix import BLOCK_ROWS, CompactMatrix
 from model.correlations import Correlations
+from model.disk_matrix import DiskMatrix
+from model.pruning_index import PruningIndex
 from utils.file_utils import read_pnl_from_file
 
+# Number of date ranges to keep window statistics for
+_MAX_CACHED_WINDOWS = 8
+# Number of date ranges to keep a standardized copy of the pool, or a pruning index, for. Each
+# one is as large as the pool in float32. Other date ranges are standardized a block at a time
+_MAX_STANDARDIZED_WINDOWS = 2
+# Factor the request counts of every date range are multiplied by at each request, so that
+# date ranges that stopped being requested give their place to the ones requested now
+_REQUEST_DECAY = 0.9
+# Decayed request counts below this are forgotten
+_MIN_REQUEST_COUNT = 0.01
+# Number of requests more than a kept date range a date range needs to take its place, so that
+# requests going through more date ranges than are kept do not replace one at each request
+_REPLACE_MARGIN = 1
+
 
 class PnlPool:
     """
@@ -16,7 +36,9 @@ class PnlPool:
     against another PnlPool object
     """
 
-    def __init__(self, *dirs_and_files, start=None, end=None, data=None, header=None, dates=None):
+    def __init__(self, *dirs_and_files, start=None, end=None, data=None, header=None, dates=None,
+                 storage="float32", spill_dir=None, rescore_factor=4, load=True,
+                 pruning_clusters=0):
         """
         Either uses (dir_and_files, start, and end) or (data, header, dates) to initialize
             if (dir_and_files, start, and end):
@@ -34,54 +56,180 @@ class PnlPool:
         data (list(list(float)): Data used to initialize PnlPool with specific pnl data
         header (list(str)): File names used to initialize PnlPool with specific pnl data
         dates (list(int)): Dates (sorted) used to initialize PnlPool with specific pnl data
+        storage (str): "float32" to keep the pool in memory as is, one of
+                       CompactMatrix.STORAGE_TYPES to keep a standardized reduced precision copy
+                       in memory and move the exact pool to a memory mapped file, or "disk" to
+                       keep the pool in a file only, scanned sequentially for each request
+        spill_dir (str): Directory for the memory mapped file used by reduced precision or disk
+                         storage. If None, the system's temporary directory is used
+        rescore_factor (int): With reduced precision storage, the top (rescore_factor * n)
+                              approximate correlations are recalculated exactly before picking
+                              the top n
+        load (bool): If False, nothing is read, and the files are only looked for and read by
+                     calling load_next(). Until then, the pool only holds the files read
+        pruning_clusters (int): With float32 storage, the number of clusters of a PruningIndex
+                                built for each standardized window, so that requests for the top
+                                correlations skip the rows that cannot be among them. If 0, no
+                                index is built and every row is calculated
         """
 
         # _data is N x D where N is number of files and D is days
         # _header is N x 1 and seen as the row index (file name) for _data
         # _dates is N x 1 (sorted) and seen as the column index (dates) for _data
+        # _loaded is the number of rows of _data read so far, other rows are not set yet
+
+        self._compact = None
+        self._disk = None
+        self._rescore_factor = rescore_factor
+        # (start_index, end_index) -> (mean, std) of each row over those days
+        self._window_stats = {}
+        # (start_index, end_index) -> rows centered and scaled to norm 1 over those days, float32
+        self._standardized = {}
+        # (start_index, end_index) -> PruningIndex of the standardized window
+        self._pruning_clusters = pruning_clusters
+        self._pruning_indices = {}
+        # (start_index, end_index) -> number of correlation requests, decayed at each request
+        self._window_requests = {}
+        self._header_index = None
+        self._load_error = None
+        # What to look for the pnl files in, None once they have been found
+        self._dirs_and_files = None
 
         if data is not None and header is not None and dates is not None:
-            self._data = np.array(data)
+            # Arrays are used as is, so that large requests are not copied again
+            self._data = np.asarray(data)
             self._header = np.array(header)
             self._dates = np.array(dates)
+            self._loaded = len(self._data)
+            self._set_storage(storage, spill_dir)
             return
 
         if len(dirs_and_files) == 0:
             raise ValueError("Cannot initialize pnl pool with no directories or files specified")
 
-        file_paths = []
-        for file_or_dir in dirs_and_files:
-            if not os.path.exists(file_or_dir):
-                raise OSError("{} could not be found".format(file_or_dir))
-            if os.path.isdir(file_or_dir):
-                for root, _, files in os.walk(file_or_dir):
-                    file_paths += [os.path.join(root, file) for file in files]
-            else:
-                file_paths.append(file_or_dir)
+        # Files are only looked for by the first load_next(), as walking the directories may
+        # take long. Until then, the pool is empty and its total is unknown
+        self._dirs_and_files = dirs_and_files
+        self._read_range = (start, end)
+        self._storage = (storage, spill_dir)
+        self._file_paths = None
+        self._dates = None
+        self._data = np.empty(shape=(0, 0), dtype="float32")
+        self._header = np.array([], dtype=str)
+        self._loaded = 0
+        if load:
+            print("Reading in files...")
+            start_time = time.time()
+            self.load_next(None)
+            print("Read in {} files in {:.4f}s".format(len(self._data), time.time() - start_time))
+        #print(self.as_matrix_for_days())
+
+    def load_next(self, num_files):
+        """
+        Reads the next files of a pool created with load=False, after looking for them on the
+        first call. Other threads can keep using the pool while this runs, and see the files
+        read once this returns
+
+        Parameters
+        ----------
+        num_files (int): number of files to read, besides the first one read when looking for
+                         them. If None, all of them
+
+        Returns
+        -------
+        True if all files of the pool have been read. Raises ValueError if a file could not be
+        read, after which loading_error() tells why
+        """
+        if self._dirs_and_files is not None:
+            try:
+                self._find_files()
+            except Exception as err:
+                self._load_error = "Could not find the pnl files: {}".format(err)
+                raise ValueError(self._load_error) from err
+        if num_files is None:
+            num_files = len(self._data)
+        end = min(self._loaded + num_files, len(self._data))
+        start, end_date = self._read_range
+        for i in range(self._loaded, end):
+            try:
+                self._data[i] = self._read_file(self._file_paths[i], start, end_date)
+            except Exception as err:
+                self._load_error = "Could not read {}: {}".format(self._file_paths[i], err)
+                raise ValueError(self._load_error) from err
+        # Statistics and names found so far were only for the files read before
+        self._window_stats = {}
+        self._standardized = {}
+        self._pruning_indices = {}
+        self._header_index = None
+        self._loaded = end
+        if self.is_loaded() and self._compact is None:
+            self._set_storage(*self._storage)
+        return self.is_loaded()
+
+    def loading_progress(self):
+        """
+        Returns
+        -------
+        (loaded, total) where loaded is the number of pnl files read so far, out of total.
+        total is 0 until the files have been looked for
+        """
+        return self._loaded, len(self._data)
+
+    def _find_files(self):
+        """
+        Looks for the pnl files of the pool and reads the first one, which gives us the dates,
+        so that the whole matrix can be allocated up front
+        """
+        file_paths = _find_files(self._dirs_and_files)
         print("Found {} pnl files to read in".format(len(file_paths)))
         if len(file_paths) == 0:
             raise ValueError("No pnl file found. Cannot create empty pnl pool")
 
-        self._dates = None
-        print("Reading in files...")
-        start_time = time.time()
-        self._data = np.array([self._read_file(filename, start, end) for filename in file_paths])
-        print("Read in {} files in {:.4f}s".format(len(file_paths), time.time() - start_time))
+        start, end = self._read_range
+        storage, spill_dir = self._storage
+        first_pnl = self._read_file(file_paths[0], start, end)
+        if storage == "disk":
+            # Files are read straight into the file, the pool may not fit in memory
+            self._disk = DiskMatrix((len(file_paths), len(first_pnl)), first_pnl.dtype, spill_dir)
+            data = self._disk.array
+        else:
+            data = np.empty(shape=(len(file_paths), len(first_pnl)), dtype=first_pnl.dtype)
+        data[0] = first_pnl
+        self._file_paths = file_paths
         self._header = np.array([os.path.basename(filename) for filename in file_paths])
-        #print(self.as_matrix_for_days())
+        self._data = data
+        self._loaded = 1
+        self._dirs_and_files = None
+
+    def loading_error(self):
+        """
+        Returns
+        -------
+        Why the pool stopped loading, or None if it did not fail
+        """
+        return self._load_error
+
+    def is_loaded(self):
+        """
+        Returns
+        -------
+        True if all pnl files of the pool have been read
+        """
+        return self._dirs_and_files is None and self._loaded == len(self._data)
 
     def as_matrix(self):
         """
         Currently, the internal implementation of this class is a matrix, so we just return that.
         This function should be used instead of directly accessing variable, as implementation
-        may change as more functionality is added.
+        may change as more functionality is added. With reduced precision storage, the matrix
+        is memory mapped and reading it goes through the disk.
 
         Returns
         -------
         The pool, as a N x D ndarray where N is the number of pnl files in the pool and D is the
         number of days in each pnl file
         """
-        return self._data
+        return self._data[:self._loaded]
 
     def as_matrix_for_days(self, start=None, end=None):
         """
@@ -97,6 +245,356 @@ class PnlPool:
         The pool, as a N x D ndarray where N is the number of pnl files in the pool and D is the
         number of days between start and end
         """
+        start_index, end_index = self._day_indices(start, end)
+        return self.as_matrix()[:, start_index:end_index]
+
+    def headers(self):
+        """
+        Returns
+        -------
+        An N x 1 ndarray of the headers for the pnl files (usually file name)
+        """
+        return self._header[:self._loaded]
+
+    def subset(self, start, end):
+        """
+        Parameters
+        ----------
+        start (int): index of the first pnl file, inclusive
+        end (int): index of the last pnl file, exclusive
+
+        Returns
+        -------
+        A PnlPool of the pnl files in [start, end), sharing this pool's data
+        """
+        return self._take_rows(slice(start, end))
+
+    def select_by_names(self, names):
+        """
+        Parameters
+        ----------
+        names (list(str)): headers of pnl files in this pool
+
+        Returns
+        -------
+        A PnlPool of the pnl files with the given headers, in the same order as names
+        """
+        if self._header_index is None:
+            self._header_index = {name: i for i, name in enumerate(self.headers())}
+        unknown = [name for name in names if name not in self._header_index]
+        if len(unknown) > 0:
+            raise ValueError("Could not find {} in pnl pool".format(", ".join(unknown)))
+        return self._take_rows(np.array([self._header_index[name] for name in names],
+                                        dtype="int64"))
+
+    def select_by_indices(self, indices):
+        """
+        Parameters
+        ----------
+        indices (list(int)): indices of pnl files in this pool
+
+        Returns
+        -------
+        A PnlPool of the pnl files at the given indices, in the same order as indices
+        """
+        return self._take_rows(np.array(indices, dtype="int64"))
+
+    @classmethod
+    def concatenate(cls, pools):
+        """
+        Combines pools with the same dates into one pool, keeping the window statistics
+        already calculated for any of them. Parts missing the statistics of such a window only
+        calculate their own
+
+        Parameters
+        ----------
+        pools (list(PnlPool)): at least one pool
+
+        Returns
+        -------
+        A PnlPool with the pnl files of each pool, in order
+        """
+        dates = pools[0].dates()
+        if any(not np.array_equal(pool.dates(), dates) for pool in pools):
+            raise ValueError("Dates mismatch between pnl pools")
+        concatenated = cls(data=np.concatenate([pool.as_matrix() for pool in pools]),
+                           header=np.concatenate([pool.headers() for pool in pools]),
+                           dates=dates)
+        # Windows kept by the most parts first, as only _MAX_CACHED_WINDOWS of them are kept
+        windows = collections.Counter(window for pool in pools for window in pool._window_stats)
+        for window, _ in windows.most_common(_MAX_CACHED_WINDOWS):
+            stats = [pool._days_stats(window) for pool in pools]
+            concatenated._window_stats[window] = (np.concatenate([mean for mean, _ in stats]),
+                                                  np.concatenate([std for _, std in stats]))
+        return concatenated
+
+    def window_stats(self, start=None, end=None):
+        """
+        Gets the mean and standard deviation of each pnl file for days between start and end,
+        inclusive. The results are kept, so requests for the same days do not calculate them
+        again
+
+        Parameters
+        ----------
+        start (int): start date in YYYYMMDD. If None, use earliest
+        end (int): end date in YYYYMMDD. If None, use latest
+
+        Returns
+        -------
+        (mean, std) where both are N x 1 ndarrays
+        """
+        return self._days_stats(self._day_indices(start, end))
+
+    def _days_stats(self, window):
+        """
+        Same as window_stats, for a range of day indices
+
+        Parameters
+        ----------
+        window (tuple): (start_index, end_index) of the days, end exclusive
+
+        Returns
+        -------
+        (mean, std) where both are N x 1 ndarrays
+        """
+        # Statistics kept while files were being loaded miss the files read since
+        if window not in self._window_stats or \
+                len(self._window_stats[window][0]) != self._loaded:
+            if len(self._window_stats) >= _MAX_CACHED_WINDOWS:
+                # dicts keep insertion order, so this drops the oldest window
+                del self._window_stats[next(iter(self._window_stats))]
+            rows = self._loaded
+            mean = np.empty(shape=rows, dtype="float64")
+            std = np.empty(shape=rows, dtype="float64")
+            for row_start, block in self._row_blocks(window[0], window[1], rows):
+                # Accumulating in float64 keeps float32 pnls with large means accurate
+                mean[row_start:row_start + len(block)] = block.mean(1, dtype="float64")
+                std[row_start:row_start + len(block)] = block.std(1, dtype="float64")
+            self._window_stats[window] = (mean, std)
+        return self._window_stats[window]
+
+    def standardized_window(self, start=None, end=None, cancellation=None):
+        """
+        Gets the pnl files for days between start and end, inclusive, centered and scaled to
+        have norm 1, so that the correlations of two pnl files is the dot product of their
+        standardized rows. The result is kept, along with the window statistics it is
+        calculated from, unless other windows kept were requested more often
+
+        Parameters
+        ----------
+        start (int): start date in YYYYMMDD. If None, use earliest
+        end (int): end date in YYYYMMDD. If None, use latest
+        cancellation (CancellationToken): checked between blocks, None if never cancelled
+
+        Returns
+        -------
+        N x W float32 ndarray where W is the number of days in the window
+        """
+        if self._disk is not None:
+            raise ValueError("Pools on disk are not standardized, they would not fit in memory")
+        window = self._day_indices(start, end)
+        if window not in self._standardized or len(self._standardized[window]) != self._loaded:
+            mean, std = self.window_stats(start, end)
+            # Rows are taken from the statistics, as more rows may be loaded while this runs
+            standardized = np.empty(shape=(len(mean), window[1] - window[0]), dtype="float32")
+            for row_start, block in self._row_blocks(window[0], window[1], len(mean),
+                                                     cancellation):
+                rows = slice(row_start, row_start + len(block))
+                standardized[rows] = _standardize_rows(block, mean[rows], std[rows])
+            if not self._keeps_window(self._standardized, window):
+                return standardized
+            self._standardized[window] = standardized
+        return self._standardized[window]
+
+    def count_request(self, windows):
+        """
+        Counts a correlation request towards the windows it uses, which decides the windows
+        kept standardized. Counts of earlier requests decay, so that the windows kept follow
+        the requests
+
+        Parameters
+        ----------
+        windows (list(tuple)): (start, end) dates of the pnls of the request, each window
+                               counted once. Windows outside the pool's dates are not counted
+        """
+        requests = {window: count * _REQUEST_DECAY
+                    for window, count in self._window_requests.items()
+                    if count * _REQUEST_DECAY >= _MIN_REQUEST_COUNT}
+        counted = set()
+        for start, end in windows:
+            try:
+                counted.add(self._day_indices(start, end))
+            except ValueError:
+                continue
+        for window in counted:
+            requests[window] = requests.get(window, 0) + 1
+        # Replaced at once, as computations read the counts from other threads
+        self._window_requests = requests
+
+    def _keeps_window(self, cache, window):
+        """
+        Decides whether a window has a place in a cache of copies of the pool for each window,
+        which holds up to _MAX_STANDARDIZED_WINDOWS. A window only takes the place of one
+        requested at least _REPLACE_MARGIN times less recently, as counted by count_request(),
+        so that requests going through more windows than fit do not build a new copy of the
+        pool each time
+
+        Parameters
+        ----------
+        cache (dict): (start_index, end_index) -> copy of the pool for those days
+        window (tuple): (start_index, end_index) of the days
+
+        Returns
+        -------
+        True if the window is in the cache or can be added to it, after removing the window
+        it replaces
+        """
+        if window in cache or len(cache) < _MAX_STANDARDIZED_WINDOWS:
+            return True
+        least_requested = min(cache, key=lambda cached: self._window_requests.get(cached, 0))
+        if self._window_requests.get(window, 0) <= \
+                self._window_requests.get(least_requested, 0) + _REPLACE_MARGIN:
+            return False
+        del cache[least_requested]
+        return True
+
+    def _pruning_index(self, start, end, cancellation=None):
+        """
+        Gets the PruningIndex of a window, building it from the standardized window the first
+        time. The index keeps its own copy of the standardized rows, so the pool's is dropped
+
+        Parameters
+        ----------
+        start (int): start date in YYYYMMDD. If None, use earliest
+        end (int): end date in YYYYMMDD. If None, use latest
+        cancellation (CancellationToken): checked between blocks, None if never cancelled
+
+        Returns
+        -------
+        The PruningIndex of the rows of the window
+        """
+        window = self._day_indices(start, end)
+        index = self._pruning_indices.get(window)
+        if index is None or index.num_rows != self._loaded:
+            standardized = self.standardized_window(start, end, cancellation)
+            start_time = time.time()
+            index = PruningIndex(standardized, self._pruning_clusters, cancellation)
+            print("Built pruning index of {} rows in {:.4f}s".format(len(standardized),
+                                                                    time.time() - start_time))
+            self._standardized.pop(window, None)
+            self._pruning_indices[window] = index
+        return index
+
+    def _row_blocks(self, start_index, end_index, rows, cancellation=None):
+        """
+        Goes through the first rows of the pool a block at a time. Pools on disk are read in
+        large sequential blocks, reading the next block while the current one is used
+
+        Parameters
+        ----------
+        start_index (int): index of first day, inclusive
+        end_index (int): index of last day, exclusive
+        rows (int): number of rows to go through
+        cancellation (CancellationToken): checked between blocks, None if never cancelled
+
+        Returns
+        -------
+        Generator of (row_start, block) where block holds rows starting at row_start for the
+        days in [start_index, end_index). A block must not be used after asking for the next
+        """
+        if self._disk is not None:
+            blocks = self._disk.blocks(rows, start_index, end_index)
+        else:
+            blocks = ((row_start, self._data[row_start:min(row_start + BLOCK_ROWS, rows),
+                                             start_index:end_index])
+                      for row_start in range(0, rows, BLOCK_ROWS))
+        for row_start, block in blocks:
+            if cancellation is not None:
+                cancellation.check()
+            yield row_start, block
+
+    def _take_rows(self, rows):
+        """
+        Parameters
+        ----------
+        rows (slice or ndarray): rows of this pool to take
+
+        Returns
+        -------
+        A PnlPool of the given rows, along with their window statistics
+        """
+        pool = PnlPool(data=self.as_matrix()[rows], header=self.headers()[rows], dates=self._dates)
+        pool._window_stats = {window: (mean[rows], std[rows])
+                              for window, (mean, std) in self._window_stats.items()}
+        return pool
+
+    def dates(self):
+        """
+        Returns
+        -------
+        A D x 1 ndarray of the dates (YYYYMMDD) of the pnl files, sorted
+        """
+        return self._dates
+
+    def nbytes(self):
+        """
+        Returns
+        -------
+        Number of bytes the pnl data of this pool holds in memory, including the standardized
+        windows kept. Does not include the memory mapped pool of reduced precision storage or of
+        a demoted pool
+        """
+        nbytes = sum(standardized.nbytes for standardized in self._standardized.values())
+        nbytes += sum(index.nbytes for index in self._pruning_indices.values())
+        if self._compact is not None:
+            nbytes += self._compact.nbytes
+        if not isinstance(self._data, np.memmap):
+            nbytes += self._data.nbytes
+        return nbytes
+
+    def is_resident(self):
+        """
+        Returns
+        -------
+        False if the pool was demoted to a memory mapped file or is on disk
+        """
+        return self._compact is not None or not isinstance(self._data, np.memmap)
+
+    def demote(self, spill_dir=None):
+        """
+        Moves the pnl data to a memory mapped file and drops the standardized windows, so
+        that the pool takes little memory until promote() is called. It can still be used
+        in the meantime, reading the pnl data from the file
+
+        Parameters
+        ----------
+        spill_dir (str): directory for the memory mapped pool, None for the default
+        """
+        self._standardized = {}
+        self._pruning_indices = {}
+        if self.is_resident() and self._compact is None:
+            self._data = _spill(self._data, spill_dir)
+
+    def promote(self):
+        """
+        Reads the pnl data of a demoted pool back into memory. Pools on disk stay there
+        """
+        if not self.is_resident() and self._disk is None:
+            self._data = np.array(self._data)
+
+    def _day_indices(self, start=None, end=None):
+        """
+        Finds the range of column indices for days between start and end, inclusive
+
+        Parameters
+        ----------
+        start (int): start date in YYYYMMDD. If None, use earliest
+        end (int): end date in YYYYMMDD. If None, use latest
+
+        Returns
+        -------
+        (start_index, end_index) where start_index is inclusive and end_index is exclusive
+        """
         if start and start > self._dates[-1]:
             raise ValueError("start is greater than all dates in pnl pool")
         if end and end < self._dates[0]:
@@ -115,48 +613,168 @@ class PnlPool:
         else:
             # Index of largest date before end
             end_index = np.where(self._dates <= end)[0][-1] + 1
-        return self._data[:, start_index:end_index]
+        return start_index, end_index
 
-    def headers(self):
+    def get_correlations(self, new_pnls, start=None, end=None, cancellation=None, top=None):
         """
+        Gets correlations between every pnl file in this pool
+        and every pnl file from new_pnls pool. Both are standardized for the window, so that
+        correlations are the product of float32 matrices without losing precision to pnls with
+        large means. The pool is processed BLOCK_ROWS rows at a time, checking for cancellation
+        between blocks. Windows that are not kept standardized are standardized a block at a
+        time from their statistics
+
+        Parameters
+        ----------
+        new_pnls (PnlPool): pool to compute against
+        start (int): start date in YYYYMMDD to calculate correlation, inclusive
+        end (int): end date in YYYYMMDD to calculate correlation, inclusive
+        cancellation (CancellationToken): checked between blocks, raising RequestCancelledError
+                                          if the request was cancelled. If None, never cancelled
+        top (int): If the pool was created with pruning_clusters, the number of top correlations
+                   needed for each pnl file of new_pnls, so that only the files that may be
+                   among them are calculated. If None, every file is calculated
+
         Returns
         -------
-        An N x 1 ndarray of the headers for the pnl files (usually file name)
+        A Correlations object, storing the correlations between file as well
+        as the files' names
         """
-        return self._header
+        start_index, end_index = self._day_indices(start=start, end=end)
+        window = (start_index, end_index)
+        y = new_pnls.as_matrix_for_days(start=start, end=end)
+        y_mean, y_std = new_pnls.window_stats(start=start, end=end)
+        if end_index - start_index != y.shape[1]:
+            raise ValueError("Dates mismatch between pnl pools")
+        if y.shape[1] < 2:
+            raise ValueError("Cannot calculate correlation with only 1 day")
+        if self._compact is not None:
+            return self._get_compact_correlations(new_pnls, y, start_index, end_index,
+                                                  cancellation)
+        y_t = _standardize_rows(y, y_mean, y_std).transpose()
+        if self._disk is not None:
+            return self._get_streamed_correlations(new_pnls, y_t, start, end, cancellation)
+        if self._pruning_clusters:
+            if not self._keeps_window(self._pruning_indices, window):
+                return self._get_streamed_correlations(new_pnls, y_t, start, end, cancellation)
+            index = self._pruning_index(start, end, cancellation)
+            if top is not None and top < index.num_rows:
+                rows, corrs_xy = index.top_correlations(y_t, top, cancellation)
+                return Correlations(corrs_xy, self._header[rows], new_pnls.headers(),
+                                    pool_rows=index.num_rows)
+            return Correlations(index.correlations(y_t, cancellation),
+                                self._header[:index.num_rows], new_pnls.headers())
+        if not self._keeps_window(self._standardized, window):
+            return self._get_streamed_correlations(new_pnls, y_t, start, end, cancellation)
+        x = self.standardized_window(start, end, cancellation)
+        # Rows and headers are taken together, as more rows may be loaded while this runs
+        corrs_xy = np.empty(shape=(len(x), len(y)), dtype="float32")
+        for row_start in range(0, len(x), BLOCK_ROWS):
+            if cancellation is not None:
+                cancellation.check()
+            rows = slice(row_start, row_start + BLOCK_ROWS)
+            np.dot(x[rows], y_t, out=corrs_xy[rows])
+        return Correlations(corrs_xy, self._header[:len(x)], new_pnls.headers())
 
-    def get_correlations(self, new_pnls, start=None, end=None):
+    def _get_streamed_correlations(self, new_pnls, y_t, start, end, cancellation):
         """
-        Gets correlations between every pnl file in this pool
-        and every pnl file from new_pnls pool
+        Calculates correlations from a pool on disk, or for a window that is not kept
+        standardized, standardizing each block as it is read
 
         Parameters
         ----------
         new_pnls (PnlPool): pool to compute against
+        y_t (ndarray): W x M, standardized pnls of new_pnls for the requested days
         start (int): start date in YYYYMMDD to calculate correlation, inclusive
         end (int): end date in YYYYMMDD to calculate correlation, inclusive
+        cancellation (CancellationToken): checked between blocks, None if never cancelled
 
         Returns
         -------
         A Correlations object, storing the correlations between file as well
         as the files' names
         """
-        x = self.as_matrix_for_days(start=start, end=end)
-        y = new_pnls.as_matrix_for_days(start=start, end=end)
-        if x.shape[1] != y.shape[1]:
-            raise ValueError("Dates mismatch between pnl pools")
-        if x.shape[1] < 2:
-            raise ValueError("Cannot calculate correlation with only 1 day")
-        x_len = x.shape[0]
-        y_len = y.shape[0]
-        y_t = y.transpose()
-        E_x = x.mean(1).reshape(x_len, 1)
-        S_x = x.std(1).reshape(x_len, 1)
-        E_y = y_t.mean(0).reshape(1, y_len)
-        S_y = y_t.std(0).reshape(1, y_len)
-        cov_xy = (x.dot(y_t) / x.shape[1]) - E_x.dot(E_y)
-        corrs_xy = cov_xy / S_x.dot(S_y)
-        return Correlations(corrs_xy, self.headers(), new_pnls.headers())
+        start_index, end_index = self._day_indices(start=start, end=end)
+        mean, std = self.window_stats(start, end)
+        corrs_xy = np.empty(shape=(len(mean), y_t.shape[1]), dtype="float32")
+        for row_start, block in self._row_blocks(start_index, end_index, len(mean),
+                                                 cancellation):
+            rows = slice(row_start, row_start + len(block))
+            np.dot(_standardize_rows(block, mean[rows], std[rows]), y_t, out=corrs_xy[rows])
+        return Correlations(corrs_xy, self._header[:len(mean)], new_pnls.headers())
+
+    def _get_compact_correlations(self, new_pnls, y, start_index, end_index, cancellation):
+        """
+        Approximates correlations from the reduced precision pool, upcasting it to float32 one
+        block at a time. The top approximate correlations are recalculated exactly from the
+        memory mapped pool when the top correlations are requested
+
+        Parameters
+        ----------
+        new_pnls (PnlPool): pool to compute against
+        y (ndarray): M x D, pnls of new_pnls for the requested days
+        start_index (int): index of first day, inclusive
+        end_index (int): index of last day, exclusive
+        cancellation (CancellationToken): checked between blocks, None if never cancelled
+
+        Returns
+        -------
+        A Correlations object, storing the approximate correlations between files
+        """
+        # Since y is centered, the product with a block does not need the block's mean removed
+        y_normalized = _normalize_rows(y).astype("float32").transpose()
+        corrs_xy = np.empty(shape=(self._compact.shape[0], len(y)), dtype="float32")
+        for row_start, block in self._compact.blocks(start_index, end_index):
+            if cancellation is not None:
+                cancellation.check()
+            norms = np.sqrt(np.square(block - block.mean(axis=1, keepdims=True, dtype="float64"))
+                            .sum(axis=1, keepdims=True))
+            corrs_xy[row_start:row_start + len(block)] = block.dot(y_normalized) / norms
+        rescorer = functools.partial(self._get_exact_correlations,
+                                     y=y, start_index=start_index, end_index=end_index)
+        return Correlations(corrs_xy, self.headers(), new_pnls.headers(),
+                            rescorer=rescorer, rescore_factor=self._rescore_factor)
+
+    def _get_exact_correlations(self, indices, y, start_index, end_index):
+        """
+        Calculates correlations for a subset of rows in float64 from the original pool
+
+        Parameters
+        ----------
+        indices (ndarray): K x M, row indices in this pool to calculate correlations for
+        y (ndarray): M x D, pnls to compute against
+        start_index (int): index of first day, inclusive
+        end_index (int): index of last day, exclusive
+
+        Returns
+        -------
+        K x M ndarray where [i, j] is the correlation between row indices[i, j] and y[j]
+        """
+        rows, positions = np.unique(indices, return_inverse=True)
+        x = self._data[rows, start_index:end_index]
+        corrs = _normalize_rows(x).dot(_normalize_rows(y).transpose())
+        return corrs[positions.reshape(indices.shape), np.arange(indices.shape[1])]
+
+    def _set_storage(self, storage, spill_dir):
+        """
+        Moves the pool to reduced precision storage if requested
+
+        Parameters
+        ----------
+        storage (str): "float32", "disk" or one of CompactMatrix.STORAGE_TYPES
+        spill_dir (str): directory for the memory mapped exact pool, None for the default
+        """
+        if storage == "float32" or self._disk is not None:
+            return
+        if storage == "disk":
+            self._disk = DiskMatrix(self._data.shape, self._data.dtype, spill_dir)
+            for row_start in range(0, len(self._data), BLOCK_ROWS):
+                rows = slice(row_start, row_start + BLOCK_ROWS)
+                self._disk.array[rows] = self._data[rows]
+            self._data = self._disk.array
+            return
+        self._compact = CompactMatrix(self._data, storage)
+        self._data = _spill(self._data, spill_dir)
 
     @classmethod
     def from_json(cls, all_data):
@@ -184,8 +802,8 @@ class PnlPool:
         -------
         A string json representation of the object
         """
-        return json.dumps({"data": self._data.tolist(),
-                           "header": self._header.tolist(),
+        return json.dumps({"data": self.as_matrix().tolist(),
+                           "header": self.headers().tolist(),
                            "dates": self._dates.tolist()})
 
     def _read_file(self, filename, start, end):
@@ -210,3 +828,78 @@ class PnlPool:
         if self._dates is None:
             self._dates = dates
         return pnl
+
+
+def _normalize_rows(x):
+    """
+    Parameters
+    ----------
+    x (ndarray): N x D
+
+    Returns
+    -------
+    N x D float64 ndarray of the rows of x, centered and scaled to have norm 1
+    """
+    centered = x - x.mean(axis=1, keepdims=True, dtype="float64")
+    return centered / np.sqrt(np.square(centered).sum(axis=1, keepdims=True))
+
+
+def _spill(data, spill_dir):
+    """
+    Parameters
+    ----------
+    data (ndarray): array to move out of memory
+    spill_dir (str): directory for the file, None for the system's temporary directory
+
+    Returns
+    -------
+    A read only memory map of a copy of data in a temporary file
+    """
+    # The file is removed as soon as it is closed, which happens when the memory map is
+    # collected. Writing through the file instead of the memory map keeps the pages out of memory
+    spill_file = tempfile.TemporaryFile(dir=spill_dir)
+    data.tofile(spill_file)
+    spill_file.flush()
+    return np.memmap(spill_file, dtype=data.dtype, mode="r", shape=data.shape)
+
+
+def _standardize_rows(x, mean, std):
+    """
+    Parameters
+    ----------
+    x (ndarray): N x W
+    mean (ndarray): N x 1, mean of each row of x
+    std (ndarray): N x 1, standard deviation of each row of x
+
+    Returns
+    -------
+    N x W float32 ndarray of the rows of x, centered and scaled to have norm 1. Rows that
+    do not change are all nan, like their correlations
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norms = std.reshape(-1, 1) * np.sqrt(x.shape[1])
+        return ((x - mean.reshape(-1, 1)) / norms).astype("float32")
+
+
+def _find_files(dirs_and_files):
+    """
+    Parameters
+    ----------
+    dirs_and_files (list(str)): Directories and files
+
+    Returns
+    -------
+    list(str) of the files and all files in the directories (recursively). Files in a
+    directory are sorted, so that the pool's order does not depend on the file system
+    """
+    file_paths = []
+    for file_or_dir in dirs_and_files:
+        if not os.path.exists(file_or_dir):
+            raise OSError("{} could not be found".format(file_or_dir))
+        if os.path.isdir(file_or_dir):
+            for root, dirs, files in os.walk(file_or_dir):
+                dirs.sort()
+                file_paths += [os.path.join(root, file) for file in sorted(files)]
+        else:
+            file_paths.append(file_or_dir)
+    return file_paths
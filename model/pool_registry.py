@@ -0,0 +1,134 @@
+"""
+Defines a registry for the named pnl pools a server holds
+"""
+import collections
+import threading
+import time
+
+
+class PoolRegistry:
+    """
+    Holds named PnlPools. With a memory budget, keeps the most recently used pools in memory
+    and demotes the least recently used ones to memory mapped files when the pools in memory
+    take more than the budget. A demoted pool is promoted back into memory when it is used again
+    """
+
+    def __init__(self, pools, default=None, memory_budget=None, spill_dir=None):
+        """
+        Parameters
+        ----------
+        pools (dict(str, PnlPool)): pools by name, at least one
+        default (str): name of the pool for requests that do not name one. If None, the first
+        memory_budget (int): bytes the pools in memory may take. If None, pools are never demoted
+        spill_dir (str): directory for the memory mapped pools, None for the default
+        """
+        if len(pools) == 0:
+            raise ValueError("Cannot create pool registry with no pools")
+        self._default = next(iter(pools)) if default is None else default
+        if self._default not in pools:
+            raise ValueError("Default pool {} is not one of the pools".format(self._default))
+        self._memory_budget = memory_budget
+        self._spill_dir = spill_dir
+        # name -> PnlPool, from least to most recently used
+        self._pools = collections.OrderedDict(pools)
+        # name -> {"requests": int, "last_used": float, "demotions": int}
+        self._usage = {name: {"requests": 0, "last_used": None, "demotions": 0}
+                       for name in pools}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pools)
+
+    def names(self):
+        """
+        Returns
+        -------
+        list(str) of the names of the pools, from least to most recently used
+        """
+        return list(self._pools)
+
+    def find(self, name=None):
+        """
+        Gets a pool without counting it as used, nor promoting it
+
+        Parameters
+        ----------
+        name (str): name of the pool. If None, the default pool
+
+        Returns
+        -------
+        The PnlPool with that name. Raises ValueError if there is none
+        """
+        name = self._default if name is None else name
+        if name not in self._pools:
+            raise ValueError("Unknown pool {}".format(name))
+        return self._pools[name]
+
+    def get(self, name=None):
+        """
+        Gets a pool to calculate correlations against. Promotes it into memory if it was
+        demoted, then demotes the least recently used pools until the pools in memory fit the
+        memory budget again. Can take a while, so is best called from a worker thread
+
+        Parameters
+        ----------
+        name (str): name of the pool. If None, the default pool
+
+        Returns
+        -------
+        The PnlPool with that name. Raises ValueError if there is none
+        """
+        name = self._default if name is None else name
+        with self._lock:
+            pool = self.find(name)
+            self._pools.move_to_end(name)
+            self._usage[name]["requests"] += 1
+            self._usage[name]["last_used"] = time.time()
+            if self._memory_budget is not None:
+                if not pool.is_resident():
+                    print("Promoting pool {} into memory".format(name))
+                    pool.promote()
+                self._enforce_budget(name)
+            return pool
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict of pool name to a dict of its number of pnl files, loading progress, bytes in
+        memory, whether it is in memory, number of requests, time of last use and number of
+        times it was demoted
+        """
+        with self._lock:
+            stats = {}
+            for name, pool in self._pools.items():
+                loaded, total = pool.loading_progress()
+                stats[name] = dict(self._usage[name],
+                                   default=name == self._default,
+                                   pnls=total,
+                                   loaded=loaded,
+                                   bytes=pool.nbytes(),
+                                   resident=pool.is_resident())
+            return stats
+
+    def _enforce_budget(self, keep):
+        """
+        Demotes the least recently used pools until the pools in memory fit the memory budget
+
+        Parameters
+        ----------
+        keep (str): name of a pool to keep in memory even if it does not fit on its own
+        """
+        in_memory = sum(pool.nbytes() for pool in self._pools.values())
+        for name, pool in self._pools.items():
+            if in_memory <= self._memory_budget:
+                return
+            # Pools being loaded are left alone, they are demoted once loaded and used
+            if name == keep or not pool.is_loaded():
+                continue
+            before = pool.nbytes()
+            pool.demote(self._spill_dir)
+            if pool.nbytes() < before:
+                print("Demoted pool {}, freeing {} bytes".format(name, before - pool.nbytes()))
+                self._usage[name]["demotions"] += 1
+                in_memory -= before - pool.nbytes()
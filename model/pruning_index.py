@@ -0,0 +1,271 @@
+"""
+Module for finding the top correlations of a standardized pool without calculating
+the correlations of rows that cannot be among them. Used by PnlPool when it is created
+with pruning_clusters
+"""
+import numpy as np
+
+from model.compact_matrix import BLOCK_ROWS
+
+# Number of rounds spent improving the clusters when building an index
+_CLUSTER_ITERATIONS = 3
+# Number of rows per cluster the clusters are improved on, as a sample of the pool is enough
+# to place the centroids, and only the final assignment needs every row
+_SAMPLE_ROWS_PER_CLUSTER = 32
+
+
+class PruningIndex:
+    """
+    Groups standardized rows (centered, norm 1, so that correlations are dot products) into
+    clusters around unit centroids, and keeps the angle between each row and its centroid.
+    If a row z is at an angle a from its centroid and a query q at an angle b from it (taking
+    -z or -q when closer, since only absolute correlations are ranked), the triangle inequality
+    on angles bounds |corr(z, q)| by cos(|a - b|). Each cluster is bounded as a whole from the
+    range of angles of its rows, so a query only ranks C x M cluster bounds, and rows of
+    clusters whose bound is below a correlation already known to be among the top k of every
+    column are never calculated, which gives the same top k as calculating every row.
+    The index keeps its own copy of the standardized rows, ordered by cluster so that the rows
+    of a cluster are multiplied as one contiguous block
+    """
+
+    def __init__(self, standardized, num_clusters, cancellation=None):
+        """
+        Parameters
+        ----------
+        standardized (ndarray): N x W float32, rows centered and scaled to norm 1
+        num_clusters (int): number of clusters, at most N
+        cancellation (CancellationToken): checked between blocks, None if never cancelled
+        """
+        num_rows, days = standardized.shape
+        num_clusters = max(1, min(num_clusters, num_rows))
+        # Bound on the rounding of float32 products of W values, kept out of every bound
+        self._slack = 2 * days * np.finfo("float32").eps
+        # Evenly spaced rows as the sample and the first centroids, so the index does not
+        # depend on a seed. Rows that could not be standardized are left out of the sample
+        sample = standardized[np.unique(np.linspace(
+            0, num_rows - 1, min(num_rows, num_clusters * _SAMPLE_ROWS_PER_CLUSTER))
+            .astype("int64"))]
+        sample = sample[np.isfinite(sample).all(axis=1)]
+        if len(sample) == 0:
+            sample = np.zeros(shape=(1, days), dtype="float32")
+        num_clusters = min(num_clusters, len(sample))
+        centroids = sample[np.linspace(0, len(sample) - 1, num_clusters).astype("int64")]
+        for _ in range(_CLUSTER_ITERATIONS):
+            labels, _, signs = _assign(sample, centroids, cancellation)
+            # Adds each row, flipped to the side of its centroid, to its cluster's sum
+            members = np.zeros(shape=(len(sample), len(centroids)), dtype="float32")
+            members[np.arange(len(sample)), labels] = signs
+            sums = members.T.dot(sample).astype("float64")
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Clusters left empty keep their centroid
+            centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids) \
+                .astype("float32")
+        labels, cosines, _ = _assign(standardized, centroids, cancellation)
+
+        # Clusters left empty are dropped, the others numbered in order
+        counts = np.bincount(labels, minlength=len(centroids))
+        labels = (np.cumsum(counts > 0) - 1)[labels]
+        self._centroids = centroids[counts > 0]
+        counts = counts[counts > 0]
+        self.num_rows = num_rows
+        # Original index of each row of the index, whose rows are sorted by cluster, and where
+        # the rows of each cluster start, with the end of the last one
+        self._order = np.argsort(labels, kind="stable")
+        self._offsets = np.concatenate([[0], np.cumsum(counts)])
+        self._labels = labels[self._order].astype("int32")
+        self._rows = np.empty(shape=standardized.shape, dtype="float32")
+        for row_start in range(0, num_rows, BLOCK_ROWS):
+            if cancellation is not None:
+                cancellation.check()
+            rows = slice(row_start, row_start + BLOCK_ROWS)
+            np.take(standardized, self._order[rows], axis=0, out=self._rows[rows])
+        # The range of angles each row may be at from its centroid, widened by the slack.
+        # Rows with undefined angles get the widest range, so that they are always calculated
+        self._min_angles, self._max_angles = _angle_ranges(cosines[self._order], self._slack)
+        self._min_angles[np.isnan(self._min_angles)] = 0
+        self._max_angles[np.isnan(self._max_angles)] = np.pi / 2
+        self._cluster_min_angles = np.minimum.reduceat(self._min_angles, self._offsets[:-1])
+        self._cluster_max_angles = np.maximum.reduceat(self._max_angles, self._offsets[:-1])
+
+    @property
+    def nbytes(self):
+        """
+        Returns
+        -------
+        Number of bytes used to hold the index in memory, including its copy of the rows
+        """
+        return sum(array.nbytes for array in (
+            self._rows, self._centroids, self._order, self._offsets, self._labels,
+            self._min_angles, self._max_angles, self._cluster_min_angles,
+            self._cluster_max_angles))
+
+    def correlations(self, y_t, cancellation=None):
+        """
+        Calculates the correlations of every row
+
+        Parameters
+        ----------
+        y_t (ndarray): W x M float32, standardized columns to calculate correlations for
+        cancellation (CancellationToken): checked between blocks, None if never cancelled
+
+        Returns
+        -------
+        N x M float32 ndarray of the correlations, rows in the order the index was built from
+        """
+        corrs = np.empty(shape=(self.num_rows, y_t.shape[1]), dtype="float32")
+        corrs[self._order] = _dot_rows(self._rows, slice(0, self.num_rows), y_t, cancellation)
+        return corrs
+
+    def top_correlations(self, y_t, top, cancellation=None):
+        """
+        Calculates the correlations of the rows that may be among the top correlations of a
+        column. Clusters are visited in increasing order of the smallest angle they may be at
+        from any column, a batch at a time. The k-th best absolute correlation calculated so
+        far is a threshold the k-th best of the pool cannot be below, so clusters that cannot
+        reach the threshold of any column are skipped, and within the others only the rows
+        that may reach it are calculated. The search stops once the next cluster cannot reach
+        any threshold
+
+        Parameters
+        ----------
+        y_t (ndarray): W x M float32, standardized columns to calculate correlations for
+        top (int): number of top correlations needed for each column, at most N
+        cancellation (CancellationToken): checked between blocks, None if never cancelled
+
+        Returns
+        -------
+        (rows, corrs) where rows are the indices of the rows calculated, in increasing order,
+        and corrs is the len(rows) x M float32 ndarray of their correlations. rows include the
+        top correlations of every column
+        """
+        num_columns = y_t.shape[1]
+        if not np.isfinite(y_t).all():
+            # Columns that could not be standardized cannot be bounded
+            return np.arange(self.num_rows), self.correlations(y_t, cancellation)
+        min_query, max_query = _angle_ranges(
+            np.abs(self._centroids.dot(y_t)).astype("float64"), self._slack)
+        # Smallest angle there can be between any row of each cluster and each column,
+        # |corr| <= cos(gap)
+        cluster_gaps = np.maximum(
+            np.maximum(self._cluster_min_angles[:, np.newaxis] - max_query,
+                       min_query - self._cluster_max_angles[:, np.newaxis]), 0)
+        smallest_gaps = cluster_gaps.min(axis=1)
+        visit_order = np.argsort(smallest_gaps, kind="stable")
+
+        kept_rows, kept_corrs = [], []
+        # The top absolute correlations calculated so far for each column
+        best = np.empty(shape=(0, num_columns), dtype="float32")
+        max_gaps = np.full(num_columns, np.pi, dtype="float32")
+        visited = 0
+        # Starts with about the closest cluster of each column
+        batch = num_columns
+        while visited < len(visit_order):
+            if smallest_gaps[visit_order[visited]] > max_gaps.max():
+                break
+            clusters = visit_order[visited:visited + batch]
+            visited += batch
+            batch *= 2
+            clusters = clusters[(cluster_gaps[clusters] <= max_gaps).any(axis=1)]
+            if len(clusters) == 0:
+                continue
+            clusters.sort()
+            rows = np.concatenate([np.arange(self._offsets[cluster], self._offsets[cluster + 1])
+                                   for cluster in clusters])
+            labels = self._labels[rows]
+            row_gaps = np.maximum(
+                np.maximum(self._min_angles[rows, np.newaxis] - max_query[labels],
+                           min_query[labels] - self._max_angles[rows, np.newaxis]), 0)
+            rows = rows[(row_gaps <= max_gaps).any(axis=1)]
+            if len(rows) == 0:
+                continue
+            corrs = _dot_rows(self._rows, rows, y_t, cancellation)
+            kept_rows.append(rows)
+            kept_corrs.append(corrs)
+            best = np.concatenate([best, np.abs(corrs)])
+            if len(best) > top:
+                best = np.partition(best, len(best) - top, axis=0)[len(best) - top:]
+            if len(best) >= top:
+                # A row can only reach the threshold if its gap is at most this angle. The
+                # slack covers the rounding of the calculated correlations and the row norms
+                thresholds = best.min(axis=0).astype("float64")
+                max_gaps = np.arccos(np.clip((thresholds - 2 * self._slack) /
+                                             (1 + self._slack), -1, 1)).astype("float32")
+                # NaN correlations leave a column without a threshold
+                max_gaps[np.isnan(max_gaps)] = np.pi
+        rows = self._order[np.concatenate(kept_rows)]
+        order = np.argsort(rows)
+        return rows[order], np.concatenate(kept_corrs)[order]
+
+
+def _assign(standardized, centroids, cancellation):
+    """
+    Assigns each row to the centroid it is closest to in absolute correlation
+
+    Parameters
+    ----------
+    standardized (ndarray): N x W float32, rows centered and scaled to norm 1
+    centroids (ndarray): C x W float32, unit centroids
+    cancellation (CancellationToken): checked between blocks, None if never cancelled
+
+    Returns
+    -------
+    (labels, cosines, signs) where labels are the N cluster indices, cosines the N absolute
+    cosines between each row and its centroid and signs the N signs of those cosines
+    """
+    labels = np.empty(shape=len(standardized), dtype="int64")
+    cosines = np.empty(shape=len(standardized), dtype="float32")
+    for row_start in range(0, len(standardized), BLOCK_ROWS):
+        if cancellation is not None:
+            cancellation.check()
+        rows = slice(row_start, row_start + BLOCK_ROWS)
+        products = standardized[rows].dot(centroids.T)
+        labels[rows] = np.abs(products).argmax(axis=1)
+        cosines[rows] = np.take_along_axis(products, labels[rows, np.newaxis], axis=1)[:, 0]
+    signs = np.where(cosines < 0, -1, 1).astype("float32")
+    return labels, np.abs(cosines).astype("float64"), signs
+
+
+def _angle_ranges(cosines, slack):
+    """
+    Parameters
+    ----------
+    cosines (ndarray): absolute cosines calculated in float32, each within slack of the exact
+    slack (float): bound on the rounding of the cosines
+
+    Returns
+    -------
+    (min_angles, max_angles), float32 ndarrays shaped like cosines holding the range of
+    angles in [0, pi / 2] each cosine may be the cosine of
+    """
+    # Also widened by the slack in radians, so that rounding to float32 cannot narrow them
+    min_angles = np.arccos(np.clip(cosines + slack, 0, 1)) - slack
+    max_angles = np.arccos(np.clip(cosines - slack, 0, 1)) + slack
+    return min_angles.astype("float32"), max_angles.astype("float32")
+
+
+def _dot_rows(rows_data, rows, y_t, cancellation):
+    """
+    Parameters
+    ----------
+    rows_data (ndarray): N x W float32
+    rows (ndarray): indices of the rows to multiply, or a slice of them
+    y_t (ndarray): W x M float32
+    cancellation (CancellationToken): checked between blocks, None if never cancelled
+
+    Returns
+    -------
+    len(rows) x M float32 ndarray, the products of those rows of rows_data with y_t
+    """
+    rows = np.arange(len(rows_data))[rows] if isinstance(rows, slice) else rows
+    products = np.empty(shape=(len(rows), y_t.shape[1]), dtype="float32")
+    for row_start in range(0, len(rows), BLOCK_ROWS):
+        if cancellation is not None:
+            cancellation.check()
+        block = slice(row_start, row_start + BLOCK_ROWS)
+        block_rows = rows[block]
+        # Runs of consecutive rows, as most are within a cluster, are multiplied without a copy
+        if block_rows[-1] - block_rows[0] == len(block_rows) - 1:
+            np.dot(rows_data[block_rows[0]:block_rows[-1] + 1], y_t, out=products[block])
+        else:
+            np.dot(rows_data[block_rows], y_t, out=products[block])
+    return products
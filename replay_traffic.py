@@ -0,0 +1,169 @@
+"""
+Script for replaying the correlation requests recorded by a server started with --capture_file
+against another server, at their original rate, a multiple of it or as fast as possible, and
+reporting the latency and throughput seen
+"""
+import argparse
+import collections
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from utils.capture_utils import read_capture
+from utils.request_utils import decode_request_params, stream_request
+
+_PERCENTILES = (50, 90, 99)
+
+
+def replay(records, host, port, speed=1, concurrency=4, timeout=None):
+    """
+    Sends recorded requests to a server, each one at its original time since the first request
+    divided by speed. Latencies are measured from the time a request should have been sent, so
+    that requests held back because all connections were busy count as slow
+
+    Parameters
+    ----------
+    records (list): (arrival, body) of the requests, sorted by arrival. Raises ValueError if
+                    the parameters of a body cannot be read
+    host (str): hostname of the server
+    port (int): port the server runs on
+    speed (float): how many times faster than recorded to send requests. If None, each
+                   request is sent as soon as a connection is free, and its latency is measured
+                   from then
+    concurrency (int): number of requests that can be waiting for the server at a time
+    timeout (float): seconds to wait for each response. If None, waits indefinitely
+
+    Returns
+    -------
+    (results, elapsed) where results holds (latency, pnls, error) for each request, with error
+    None if it succeeded, and elapsed is the number of seconds the replay took
+    """
+    # Only the parameters are read, beforehand, so that reading them is not counted in the
+    # latency. Bodies are sent as they were recorded
+    requests = [(arrival, body, decode_request_params(body)[1]) for arrival, body in records]
+    start_time = time.time()
+    futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for arrival, body, num_pnls in requests:
+            scheduled = None
+            if speed is not None:
+                scheduled = start_time + (arrival - requests[0][0]) / speed
+                time.sleep(max(0, scheduled - time.time()))
+            futures.append(executor.submit(_send, host, port, body, num_pnls, scheduled,
+                                           timeout))
+        results = [future.result() for future in futures]
+    return results, time.time() - start_time
+
+
+def _send(host, port, body, num_pnls, scheduled, timeout):
+    """
+    Sends a request and reads the whole response. Runs in a worker thread
+
+    Parameters
+    ----------
+    host (str): hostname of the server
+    port (int): port the server runs on
+    body (bytes): the encoded request, sent as is
+    num_pnls (int): number of pnls of the request
+    scheduled (float): time the request should have been sent at. If None, now
+    timeout (float): seconds to wait for the response. If None, waits indefinitely
+
+    Returns
+    -------
+    (latency, pnls, error) where error is None if the request succeeded, else its reason
+    """
+    sent = time.time() if scheduled is None else scheduled
+    error = None
+    try:
+        for _ in stream_request(host, port, None, timeout, body=body):
+            pass
+    except Exception as err:
+        # Server messages can be long, only their first line is kept to group them
+        error = "{}: {}".format(type(err).__name__, str(err).split("\n")[0][:100])
+    return time.time() - sent, num_pnls, error
+
+
+def print_report(results, elapsed, recorded=None):
+    """
+    Prints the throughput, errors and latency percentiles of a replay
+
+    Parameters
+    ----------
+    results (list): (latency, pnls, error) of each request, as returned by replay()
+    elapsed (float): number of seconds the replay took
+    recorded (list): (arrival, body, duration, status, body_size) of every recorded request, as
+                     read by read_capture(), including the ones rejected without their body,
+                     whose rate, rejections and latencies are reported alongside for
+                     comparison. If None, not reported
+    """
+    latencies = np.array([latency for latency, _, error in results if error is None])
+    pnls = sum(num_pnls for _, num_pnls, error in results if error is None)
+    errors = collections.Counter(error for _, _, error in results if error is not None)
+    print("Replayed {} requests in {:.2f}s: {:.2f} requests/s, {:.1f} pnls/s".format(
+        len(results), elapsed, len(latencies) / elapsed, pnls / elapsed))
+    print("Succeeded: {}, failed: {}".format(len(latencies), sum(errors.values())))
+    for error, count in errors.most_common():
+        print("    {} x {}".format(count, error))
+    if len(latencies) > 0:
+        print("Latency: " + _format_percentiles(latencies))
+    if recorded:
+        arrivals = [arrival for arrival, _, _, _, _ in recorded]
+        recorded_elapsed = max(arrivals) - min(arrivals)
+        statuses = collections.Counter(status for _, _, _, status, _ in recorded)
+        print("Recorded {} requests over {:.2f}s: {:.2f} requests/s".format(
+            len(recorded), recorded_elapsed, len(recorded) / max(recorded_elapsed, 1e-9)))
+        print("Rejected when recorded: {}, of which {} before their body was received".format(
+            statuses[503], sum(body is None for _, body, _, _, _ in recorded)))
+        durations = [duration for _, _, duration, status, _ in recorded if status == 200]
+        if durations:
+            print("Recorded: " + _format_percentiles(np.array(durations)))
+
+
+def _format_percentiles(latencies):
+    """
+    Parameters
+    ----------
+    latencies (ndarray): latencies in seconds
+
+    Returns
+    -------
+    str of the mean, percentiles and maximum of the latencies
+    """
+    return ", ".join(["mean {:.4f}s".format(latencies.mean())] +
+                     ["p{} {:.4f}s".format(percentile, value) for percentile, value in
+                      zip(_PERCENTILES, np.percentile(latencies, _PERCENTILES))] +
+                     ["max {:.4f}s".format(latencies.max())])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays recorded requests against a server")
+    parser.add_argument("--capture_file", action="store", required=True)
+    parser.add_argument("--server", action="store", required=True)
+    parser.add_argument("--speed", action="store", type=float, default=1)
+    parser.add_argument("--max_rate", action="store_true")
+    parser.add_argument("--concurrency", action="store", type=int, default=4)
+    parser.add_argument("--timeout", action="store", type=float, default=None)
+    parser.add_argument("--limit", action="store", type=int, default=None)
+    args = parser.parse_args(sys.argv[1:])
+
+    host_port = args.server.split(":")
+    if len(host_port) != 2 or not host_port[1].isdigit():
+        parser.error("--server {} could not be understood".format(args.server))
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    # Records are in the order requests were answered, they are replayed in order of arrival
+    captured = sorted(read_capture(args.capture_file), key=lambda record: record[0])
+    captured = captured[:args.limit]
+    # Only requests that succeeded are replayed. The others, such as malformed requests or
+    # requests rejected before their body was received, are only reported
+    replayable = [(arrival, body) for arrival, body, _, status, _ in captured if status == 200]
+    if len(replayable) == 0:
+        parser.error("{} holds no successful requests".format(args.capture_file))
+    print("Replaying {} requests recorded over {:.2f}s, leaving out {} that did not succeed"
+          .format(len(replayable), captured[-1][0] - captured[0][0],
+                  len(captured) - len(replayable)))
+    replay_results, replay_elapsed = replay(replayable, host_port[0], int(host_port[1]),
+                                            None if args.max_rate else args.speed,
+                                            args.concurrency, args.timeout)
+    print_report(replay_results, replay_elapsed, captured)
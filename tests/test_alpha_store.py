@@ -0,0 +1,51 @@
+import unittest
+from unittest import mock
+import numpy as np
+
+from model.alpha_store import AlphaStore
+from model.pnl_pool import PnlPool
+
+
+class AlphaStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pnls = PnlPool(data=np.array([[1., 2, 4], [3, 1, 2], [5, 6, 2]]),
+                            header=np.array(["file1", "file2", "file3"]),
+                            dates=np.array([20090101, 20090102, 20090105]))
+
+    def test_register_and_get(self):
+        store = AlphaStore()
+        ids = store.register(self.pnls)
+        self.assertEqual(len(set(ids)), 3)
+        alphas = store.get([ids[2], ids[0]])
+        self.assertTrue(np.array_equal(alphas[0].as_matrix(), [[5, 6, 2]]))
+        self.assertTrue(np.array_equal(alphas[1].headers(), ["file1"]))
+        self.assertRaises(ValueError, store.get, [ids[0], "unknown"])
+
+    def test_bounded(self):
+        store = AlphaStore(max_alphas=2)
+        ids = store.register(self.pnls.subset(0, 2))
+        # Using the first pnl makes the second one the least recently used
+        store.get([ids[0]])
+        new_id = store.register(self.pnls.subset(2, 3))[0]
+        self.assertEqual(len(store), 2)
+        self.assertRaises(ValueError, store.get, [ids[1]])
+        store.get([ids[0], new_id])
+        # A batch larger than the store is rejected rather than partly dropped
+        self.assertRaises(ValueError, store.register, self.pnls)
+        self.assertEqual(len(store), 2)
+
+    def test_expires(self):
+        store = AlphaStore(ttl=10)
+        with mock.patch("time.monotonic", return_value=100):
+            ids = store.register(self.pnls)
+        with mock.patch("time.monotonic", return_value=105):
+            store.get([ids[0]])
+        with mock.patch("time.monotonic", return_value=112):
+            self.assertRaises(ValueError, store.get, [ids[1]])
+            store.get([ids[0]])
+            self.assertEqual(len(store), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
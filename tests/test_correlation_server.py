@@ -0,0 +1,492 @@
+import json
+import os
+import pstats
+import socket
+import tempfile
+import threading
+import unittest
+import numpy as np
+from tornado import gen
+from tornado.httpclient import HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import AsyncHTTPTestCase, bind_unused_port, gen_test
+
+import correlation_server
+from replay_traffic import replay
+from model.cancellation import RequestCancelledError
+from model.correlation_request import CorrelationRequest
+from model.correlation_response import CorrelationResponse
+from model.pnl_pool import PnlPool
+from model.pool_registry import PoolRegistry
+from utils.admission_utils import AdmissionController
+from utils.capture_utils import TrafficRecorder, read_capture
+from utils.profile_utils import PROFILE_HEADER, RequestProfiler
+from utils.request_utils import REGISTER_PATH, TIMEOUT_HEADER, encode_request
+from utils.response_utils import decode_response, decode_response_stream
+
+
+class CorrelationServerTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.pool = _BlockingPool()
+        super().setUp()
+        query = PnlPool(data=self.pool.data[:1], header=np.array(["q"]), dates=self.pool.dates)
+        self.body = encode_request(CorrelationRequest(query, top=2))
+
+    def get_app(self):
+        self.admission = AdmissionController(max_concurrent=1, max_queued=0, retry_after=3)
+        return correlation_server.make_app(self.pool, self.admission)
+
+    @gen_test
+    async def test_rejects_when_busy(self):
+        first = self.http_client.fetch(self.get_url("/"), method="POST", body=self.body)
+        await gen.sleep(0.1)
+        second = await self.http_client.fetch(self.get_url("/"), method="POST", body=self.body,
+                                              raise_error=False)
+        self.assertEqual(second.code, 503)
+        self.assertEqual(second.headers["Retry-After"], "3")
+        self.pool.finished.set()
+        response = decode_response((await first).body.decode("utf-8"))
+        self.assertTrue(np.array_equal(response.names_matrix, np.array([["pnl_0"], ["pnl_2"]])))
+
+    def test_malformed_request(self):
+        response = self.fetch("/", method="POST", body=self.body[:-1])
+        self.assertEqual(response.code, 400)
+        self.assertEqual(response.body.decode("utf-8"), "Request is incomplete")
+        # Neither a shape larger than the body nor missing fields are allocated or leak a slot
+        huge = self.body.replace(b"[1, 10]", b"[200000, 200000]")
+        self.assertNotEqual(huge, self.body)
+        self.assertEqual(self.fetch("/", method="POST", body=huge).code, 400)
+        self.assertEqual(self.fetch("/", method="POST",
+                                    body=self.body.replace(b'"header"', b'"other"')).code, 400)
+        self.assertEqual(self.admission._pending, 0)
+
+    @gen_test
+    async def test_disconnect_while_sending(self):
+        with socket.create_connection(("127.0.0.1", self.get_http_port())) as client:
+            client.sendall("POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n"
+                           .format(len(self.body)).encode("utf-8") + self.body[:10])
+            await gen.sleep(0.1)
+            self.assertEqual(self.admission._pending, 1)
+        for _ in range(100):
+            if self.admission._pending == 0:
+                break
+            await gen.sleep(0.01)
+        self.assertEqual(self.admission._pending, 0)
+
+    @gen_test
+    async def test_deadline(self):
+        response = await self.http_client.fetch(self.get_url("/"), method="POST", body=self.body,
+                                                headers={TIMEOUT_HEADER: "0.1"}, raise_error=False)
+        self.assertEqual(response.code, 504)
+        self.assertIn("deadline exceeded", response.body.decode("utf-8"))
+        for timeout in ["soon", "nan", "inf", "-1"]:
+            response = await self.http_client.fetch(
+                self.get_url("/"), method="POST", body=self.body,
+                headers={TIMEOUT_HEADER: timeout}, raise_error=False)
+            self.assertEqual(response.code, 400)
+            self.assertIn(TIMEOUT_HEADER, response.body.decode("utf-8"))
+
+    @gen_test
+    async def test_cancel_on_disconnect(self):
+        with self.assertRaises(HTTPClientError):
+            await self.http_client.fetch(self.get_url("/"), method="POST", body=self.body,
+                                         request_timeout=0.1)
+        for _ in range(100):
+            if self.pool.cancelled_with is not None:
+                break
+            await gen.sleep(0.01)
+        self.assertEqual(str(self.pool.cancelled_with), "client disconnected")
+
+
+class StreamingResponseTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        gen = np.random.default_rng(0)
+        self.pool = PnlPool(data=gen.standard_normal(size=(20, 30)),
+                            header=np.array(["pnl_" + str(i) for i in range(20)]),
+                            dates=np.arange(20090101, 20090131))
+        super().setUp()
+
+    def get_app(self):
+        return correlation_server.make_app(self.pool, column_group=2)
+
+    def test_column_groups(self):
+        query = self.pool.subset(3, 8)
+        response = self.fetch("/", method="POST",
+                              body=encode_request(CorrelationRequest(query, top=4)))
+        groups = list(decode_response_stream(response.body.decode("utf-8").splitlines()))
+        self.assertEqual([list(group.col_names) for group in groups],
+                         [["pnl_3", "pnl_4"], ["pnl_5", "pnl_6"], ["pnl_7"]])
+
+        expected = self.pool.get_correlations(query).top_n_corrs_for_col(4)
+        result = CorrelationResponse.concatenate(groups)
+        self.assertTrue(np.allclose(result.corrs_matrix, expected[0]))
+        self.assertTrue(np.array_equal(result.names_matrix, expected[1]))
+        self.assertTrue(np.array_equal(result.col_names, expected[2]))
+
+    def test_column_windows(self):
+        query = self.pool.subset(3, 8)
+        windows = [(20090110, None), (None, 20090120), (20090110, None), (20090110, None),
+                   (None, 20090120)]
+        response = self.fetch("/", method="POST",
+                              body=encode_request(CorrelationRequest(query, top=4,
+                                                                     windows=windows)))
+        groups = list(decode_response_stream(response.body.decode("utf-8").splitlines()))
+        # Pnls with the same window are calculated together, column_group at a time
+        self.assertEqual([list(group.col_names) for group in groups],
+                         [["pnl_3", "pnl_5"], ["pnl_6"], ["pnl_4", "pnl_7"]])
+        # The request counts once towards each of its windows, whatever its number of groups
+        self.assertEqual(sorted(self.pool._window_requests.values()), [1, 1])
+        for group, (start, end) in zip(groups, [(20090110, None)] * 2 + [(None, 20090120)]):
+            expected = self.pool.get_correlations(self.pool.select_by_names(group.col_names),
+                                                  start, end).top_n_corrs_for_col(4)
+            self.assertTrue(np.allclose(group.corrs_matrix, expected[0]))
+            self.assertTrue(np.array_equal(group.names_matrix, expected[1]))
+
+        self.assertRaises(ValueError, CorrelationRequest, query, windows=windows[1:])
+
+    def test_error_after_some_groups(self):
+        windows = [(None, None), (20090129, 20090130), (20200101, None)]
+        request = CorrelationRequest(self.pool.subset(0, 3), windows=windows)
+        response = self.fetch("/", method="POST", body=encode_request(request))
+        self.assertEqual(response.code, 200)
+        groups = decode_response_stream(response.body.decode("utf-8").splitlines())
+        self.assertEqual(len(next(groups).col_names), 1)
+        self.assertEqual(len(next(groups).col_names), 1)
+        with self.assertRaisesRegex(ValueError, "after 2 pnls due to start is greater"):
+            next(groups)
+
+    def test_registered_and_pool_pnls(self):
+        response = self.fetch(REGISTER_PATH, method="POST",
+                              body=encode_request(CorrelationRequest(self.pool.subset(5, 7))))
+        ids = json.loads(response.body.decode("utf-8"))["alpha_ids"]
+        self.assertEqual(len(ids), 2)
+
+        request = CorrelationRequest(self.pool.subset(0, 1), top=3, start=20090110,
+                                     alpha_ids=[ids[1]], pool_names=["pnl_9"])
+        response = self.fetch("/", method="POST", body=encode_request(request))
+        result = CorrelationResponse.concatenate(
+            list(decode_response_stream(response.body.decode("utf-8").splitlines())))
+        query = self.pool.select_by_names(["pnl_0", "pnl_6", "pnl_9"])
+        expected = self.pool.get_correlations(query, start=20090110).top_n_corrs_for_col(3)
+        self.assertTrue(np.allclose(result.corrs_matrix, expected[0]))
+        self.assertTrue(np.array_equal(result.names_matrix, expected[1]))
+        self.assertTrue(np.array_equal(result.col_names, ["pnl_0", "pnl_6", "pnl_9"]))
+
+        request = CorrelationRequest(None, alpha_ids=["unknown"])
+        response = self.fetch("/", method="POST", body=encode_request(request))
+        self.assertEqual(response.code, 400)
+
+
+class MultiplePoolsTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        gen = np.random.default_rng(0)
+        dates = np.arange(20090101, 20090131)
+        self.pools = {name: PnlPool(data=gen.standard_normal(size=(20, 30)),
+                                    header=np.array([name + "_" + str(i) for i in range(20)]),
+                                    dates=dates)
+                      for name in ["us", "eu"]}
+        super().setUp()
+
+    def get_app(self):
+        return correlation_server.make_app(PoolRegistry(self.pools))
+
+    def test_named_pools(self):
+        query = self.pools["us"].subset(0, 2)
+        for pool in [None, "us", "eu"]:
+            response = self.fetch("/", method="POST",
+                                  body=encode_request(CorrelationRequest(query, top=3, pool=pool)))
+            expected = self.pools[pool or "us"].get_correlations(query).top_n_corrs_for_col(3)
+            result = decode_response(response.body.decode("utf-8"))
+            self.assertTrue(np.array_equal(result.names_matrix, expected[1]))
+
+        response = self.fetch("/", method="POST",
+                              body=encode_request(CorrelationRequest(query, pool="asia")))
+        self.assertEqual(response.code, 400)
+        stats = json.loads(self.fetch(correlation_server.POOLS_PATH).body)
+        self.assertEqual(stats["us"]["requests"], 2)
+        self.assertEqual(stats["eu"]["requests"], 1)
+        self.assertEqual(stats["eu"]["pnls"], 20)
+
+
+class ProfilingTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profile_dir.cleanup)
+        self.pool = PnlPool(data=np.random.default_rng(0).standard_normal(size=(20, 30)),
+                            header=np.array(["pnl_" + str(i) for i in range(20)]),
+                            dates=np.arange(20090101, 20090131))
+        super().setUp()
+
+    def get_app(self):
+        return correlation_server.make_app(self.pool,
+                                           profiler=RequestProfiler(self.profile_dir.name))
+
+    def test_profile_header(self):
+        body = encode_request(CorrelationRequest(self.pool.subset(0, 2), start=20090105))
+        self.assertEqual(self.fetch("/", method="POST", body=body).code, 200)
+        self.assertEqual(os.listdir(self.profile_dir.name), [])
+
+        response = self.fetch("/", method="POST", body=body, headers={PROFILE_HEADER: "1"})
+        self.assertEqual(response.code, 200)
+        reports = sorted(os.listdir(self.profile_dir.name))
+        self.assertEqual(len(reports), 2)
+        self.assertTrue(reports[0].endswith("pnls-2_start-20090105_end-None_pool-20_bytes-{}"
+                                            "_status-200.alloc.txt".format(len(body))))
+        self.assertTrue(reports[1].endswith(".prof"))
+        stats = pstats.Stats(os.path.join(self.profile_dir.name, reports[1]))
+        self.assertTrue(any(name == "get_correlations" for _, _, name in stats.stats))
+
+
+class CaptureTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        capture_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(capture_dir.cleanup)
+        self.capture_path = os.path.join(capture_dir.name, "capture.bin")
+        self.pool = PnlPool(data=np.random.default_rng(0).standard_normal(size=(20, 30)),
+                            header=np.array(["pnl_" + str(i) for i in range(20)]),
+                            dates=np.arange(20090101, 20090131))
+        self.body = encode_request(CorrelationRequest(self.pool.subset(0, 2), top=3))
+        super().setUp()
+
+    def get_app(self):
+        # Room for the two requests of the test and a rejected one, but not a third
+        self.recorder = TrafficRecorder(self.capture_path, max_bytes=2 * len(self.body) + 100)
+        self.admission = AdmissionController()
+        return correlation_server.make_app(self.pool, self.admission, recorder=self.recorder)
+
+    def test_capture_and_replay(self):
+        self.assertEqual(self.fetch("/", method="POST", body=self.body).code, 200)
+        self.assertEqual(self.fetch("/", method="POST", body=self.body[:-1]).code, 400)
+        self.admission._pending = self.admission._max_pending
+        self.assertEqual(self.fetch("/", method="POST", body=self.body).code, 503)
+        self.admission._pending = 0
+        self.assertEqual(self.fetch("/", method="POST", body=self.body).code, 200)
+        self.recorder.close()
+        captured = list(read_capture(self.capture_path))
+        # Rejected requests are recorded with the size they announced, but not their body
+        self.assertEqual([(body, status, size) for _, body, _, status, size in captured],
+                         [(self.body, 200, len(self.body)), (self.body[:-1], 400,
+                                                              len(self.body) - 1),
+                          (None, 503, len(self.body))])
+        self.assertLessEqual(captured[0][0], captured[1][0])
+        self.assertRaises(ValueError, TrafficRecorder, os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "test_data", "multiple_file_pool",
+            "pnl_0"))
+
+        host, port = self.get_url("/").split("/")[2].split(":")
+        records = [(arrival, body) for arrival, body, _, status, _ in captured if status == 200]
+        for speed in [1, None]:
+            results, elapsed = self.io_loop.run_sync(lambda: self.io_loop.run_in_executor(
+                None, replay, records * 3, host, int(port), speed, 2))
+            self.assertEqual([(num_pnls, error) for _, num_pnls, error in results],
+                             [(2, None)] * 3)
+            self.assertTrue(all(0 < latency <= elapsed for latency, _, _ in results))
+
+
+class LoadingTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        pool_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "test_data", "multiple_file_pool")
+        self.pool = PnlPool(pool_dir, load=False)
+        self.body = encode_request(CorrelationRequest(PnlPool(pool_dir).subset(0, 1), top=2))
+        super().setUp()
+
+    def get_app(self):
+        return correlation_server.make_app(self.pool)
+
+    def test_rejects_until_loaded(self):
+        # Files are only looked for once loading starts
+        self.assertEqual(self.pool.loading_progress(), (0, 0))
+        self.assertEqual(self.fetch(correlation_server.READY_PATH).code, 503)
+        progress = json.loads(self.fetch(correlation_server.PROGRESS_PATH).body)
+        self.assertEqual(progress, {"loaded": 0, "total": None, "fraction": 0, "ready": False,
+                                    "errors": {}})
+
+        self.pool.load_next(0)
+        progress = json.loads(self.fetch(correlation_server.PROGRESS_PATH).body)
+        self.assertEqual(progress, {"loaded": 1, "total": 3, "fraction": 1 / 3, "ready": False,
+                                    "errors": {}})
+        response = self.fetch("/", method="POST", body=self.body)
+        self.assertEqual(response.code, 503)
+        self.assertIn("Retry-After", response.headers)
+
+        self.pool.load_next(2)
+        self.assertEqual(self.fetch(correlation_server.READY_PATH).code, 200)
+        response = decode_response(self.fetch("/", method="POST", body=self.body).body)
+        self.assertFalse(response.partial)
+        self.assertEqual(response.corrs_matrix.shape, (2, 1))
+
+
+class LoadingErrorTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.pool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.pool_dir.cleanup)
+        # The last file is missing a day, so it does not fit in the pool
+        for i, days in enumerate([5, 5, 4]):
+            with open(os.path.join(self.pool_dir.name, "pnl_" + str(i)), "w") as pnl_file:
+                pnl_file.write("Date PNL Tvr\n")
+                pnl_file.writelines("2009010{} {} 0.0\n".format(day + 1, day * (i + 1))
+                                    for day in range(days))
+        self.pool = PnlPool(self.pool_dir.name, load=False)
+        super().setUp()
+
+    def get_app(self):
+        return correlation_server.make_app(self.pool)
+
+    def test_loading_error(self):
+        correlation_server._load_pools({"default": self.pool}, 1)
+        self.assertIn("pnl_2", self.pool.loading_error())
+        response = self.fetch(correlation_server.READY_PATH)
+        self.assertEqual(response.code, 500)
+        self.assertIn(b"pnl_2", response.body)
+        progress = json.loads(self.fetch(correlation_server.PROGRESS_PATH).body)
+        self.assertEqual(progress["loaded"], 2)
+        self.assertFalse(progress["ready"])
+        self.assertEqual(progress["errors"], {"default": self.pool.loading_error()})
+        response = self.fetch("/", method="POST", body=encode_request(
+            CorrelationRequest(self.pool.subset(0, 1), top=1)))
+        self.assertEqual(response.code, 500)
+        self.assertIn(b"could not be loaded", response.body)
+
+
+class PartialLoadingTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        pool_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "test_data", "multiple_file_pool")
+        self.pool = PnlPool(pool_dir, load=False)
+        self.body = encode_request(CorrelationRequest(PnlPool(pool_dir).subset(0, 1), top=2))
+        super().setUp()
+
+    def get_app(self):
+        return correlation_server.make_app(self.pool, serve_partial=True)
+
+    def test_serve_partial(self):
+        self.assertEqual(self.fetch(correlation_server.READY_PATH).code, 503)
+        self.assertEqual(self.fetch("/", method="POST", body=self.body).code, 503)
+
+        self.pool.load_next(0)
+        self.assertEqual(self.fetch(correlation_server.READY_PATH).code, 200)
+        response = decode_response(self.fetch("/", method="POST", body=self.body).body)
+        self.assertTrue(response.partial)
+        self.assertEqual(response.errors,
+                         ["pool is still loading, only 1 of 3 pnl files were included"])
+        self.assertTrue(np.array_equal(response.names_matrix, [["pnl_0"]]))
+
+
+class CoordinatorTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        gen = np.random.default_rng(0)
+        self.dates = np.arange(20090101, 20090131)
+        self.data = gen.standard_normal(size=(20, len(self.dates)))
+        self.header = np.array(["pnl_" + str(i) for i in range(20)])
+        # The coordinator app is created in super().setUp(), before the shards can be
+        # started on its IOLoop, so it is given this list to fill in afterwards
+        self.shards = []
+        self.shard_servers = []
+        super().setUp()
+        for rows in [slice(0, 8), slice(8, 20)]:
+            pool = PnlPool(data=self.data[rows], header=self.header[rows], dates=self.dates)
+            self._start_shard(correlation_server.make_app(pool))
+        # Bound but never served, so requests to it time out
+        sock, port = bind_unused_port()
+        self.addCleanup(sock.close)
+        self.shards.append("127.0.0.1:" + str(port))
+
+    def tearDown(self):
+        for server in self.shard_servers:
+            server.stop()
+        super().tearDown()
+
+    def get_app(self):
+        return correlation_server.make_coordinator_app(self.shards, shard_timeout=1)
+
+    def test_merges_shards(self):
+        query = PnlPool(data=self.data[[3, 15]] + 0.1, header=np.array(["q1", "q2"]),
+                        dates=self.dates)
+        body = encode_request(CorrelationRequest(query, top=5))
+
+        expected = PnlPool(data=self.data, header=self.header, dates=self.dates) \
+            .get_correlations(query).top_n_corrs_for_col(5)
+        response = decode_response(self.fetch("/", method="POST", body=body).body.decode("utf-8"))
+        self.assertTrue(np.allclose(response.corrs_matrix, expected[0]))
+        self.assertTrue(np.array_equal(response.names_matrix, expected[1]))
+        # The shard that never answers is reported instead of failing the request
+        self.assertTrue(response.partial)
+        self.assertEqual(len(response.errors), 1)
+        self.assertIn(self.shards[-1], response.errors[0])
+
+    def test_malformed_request(self):
+        response = self.fetch("/", method="POST", body=b"not json\n")
+        self.assertEqual(response.code, 400)
+        self.assertIn(b"Could not read request parameters", response.body)
+        query = PnlPool(data=self.data[:1], header=np.array(["q1"]), dates=self.dates)
+        response = self.fetch("/", method="POST", body=encode_request(CorrelationRequest(query)),
+                              headers={TIMEOUT_HEADER: "nan"})
+        self.assertEqual(response.code, 400)
+        self.assertIn(TIMEOUT_HEADER, response.body.decode("utf-8"))
+
+    def test_shard_failing_after_some_pnls(self):
+        query = PnlPool(data=self.data[:3], header=np.array(["q1", "q2", "q3"]),
+                        dates=self.dates)
+        windows = [(None, None), (20090129, 20090130), (20200101, None)]
+        body = encode_request(CorrelationRequest(query, windows=windows))
+        response = self.fetch("/", method="POST", body=body)
+        # Shards stopping after some pnls are left out, rather than merged
+        self.assertEqual(response.code, 500)
+        self.assertIn("after 2 pnls due to start is greater", response.body.decode("utf-8"))
+
+    def _start_shard(self, app):
+        sock, port = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        self.shard_servers.append(server)
+        self.shards.append("127.0.0.1:" + str(port))
+
+
+class _BlockingPool:
+    """
+    Stands in for a PnlPool whose computation keeps checking for cancellation
+    until finished is set
+    """
+
+    def __init__(self):
+        self.dates = np.arange(20090101, 20090111)
+        self.data = np.array([np.arange(10) ** 2, np.arange(10) % 3, np.arange(10)])
+        self.finished = threading.Event()
+        self.cancelled_with = None
+
+    def is_loaded(self):
+        return True
+
+    def loading_progress(self):
+        return len(self.data), len(self.data)
+
+    def loading_error(self):
+        return None
+
+    def count_request(self, windows):
+        pass
+
+    def get_correlations(self, new_pnls, start, end, cancellation, top=None):
+        try:
+            while not self.finished.wait(0.01):
+                cancellation.check()
+        except RequestCancelledError as err:
+            self.cancelled_with = err
+            raise
+        pool = PnlPool(data=self.data, header=np.array(["pnl_0", "pnl_1", "pnl_2"]),
+                       dates=self.dates)
+        return pool.get_correlations(new_pnls, start, end)
+
+
+if __name__ == '__main__':
+    unittest.main()
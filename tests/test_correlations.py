@@ -34,6 +34,20 @@ class CorrelationsTest(unittest.TestCase):
         self.assertTrue(np.array_equal(names, np.array([["row1", "row3", "row1"],
                                                         ["row2", "row2", "row3"]])))
 
+    def test_top_n_indices_for_col(self):
+        corr_matrix = np.array([[3, 0, 9],
+                                [2, 1, 7],
+                                [1, 2, 8]])
+        rows = np.array(["row1", "row2", "row3"])
+        cols = np.array(["col1", "col2", "col3"])
+        correlations = Correlations(corr_matrix, rows, cols)
+        corrs, indices, _ = correlations.top_n_indices_for_col(2)
+        self.assertTrue(np.array_equal(corrs, np.array([[3, 2, 9],
+                                                        [2, 1, 8]])))
+        self.assertTrue(np.array_equal(indices, np.array([[0, 2, 0],
+                                                          [1, 1, 2]])))
+        self.assertTrue(np.array_equal(correlations.row_names(), rows))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,8 @@
+import filecmp
+import os
+import tempfile
 import unittest
+from unittest import mock
 import numpy as np
 
 import generate_pnl_data
@@ -28,3 +32,21 @@ class GeneratePnlDataTest(unittest.TestCase):
 
         smoothed = generate_pnl_data.apply_smoothing(alphas, lambas)
         self.assertTrue(np.allclose(smoothed, np.array([expected1, expected2])))
+
+    @mock.patch.object(generate_pnl_data, "ALPHAS_PER_SEED", 2)
+    def test_generate_data_deterministic(self):
+        dirs = [tempfile.TemporaryDirectory() for _ in range(3)]
+        for temp_dir in dirs:
+            self.addCleanup(temp_dir.cleanup)
+        generate_pnl_data.generate_data(dirs[0].name, 5, seed=7, workers=1)
+        generate_pnl_data.generate_data(dirs[1].name, 5, seed=7, workers=3)
+        generate_pnl_data.generate_data(dirs[2].name, 5, seed=8, workers=1)
+
+        files = ["pnl_" + str(i) for i in range(5)]
+        self.assertEqual(sorted(os.listdir(dirs[0].name)), files)
+        # The same seed gives the same files, whatever the number of workers
+        match, mismatch, errors = filecmp.cmpfiles(dirs[0].name, dirs[1].name, files,
+                                                   shallow=False)
+        self.assertEqual((match, mismatch, errors), (files, [], []))
+        match, _, _ = filecmp.cmpfiles(dirs[0].name, dirs[2].name, files, shallow=False)
+        self.assertEqual(match, [])
@@ -1,8 +1,12 @@
 import os
+import tempfile
 import unittest
+from unittest import mock
 import numpy as np
 from scipy.stats.stats import pearsonr
 
+from model import disk_matrix
+from model.cancellation import CancellationToken, RequestCancelledError
 from model.pnl_pool import PnlPool
 
 
@@ -66,6 +70,208 @@ class PnlPoolTest(unittest.TestCase):
         result = corrs.top_n_corrs_for_col(2)[0]
         self.assertTrue(np.allclose(expected, result))
 
+    def test_get_correlations_float32_accuracy(self):
+        gen = np.random.default_rng(0)
+        # Means far larger than the daily changes, as for cumulative pnls
+        data = gen.standard_normal(size=(2000, 250)) + gen.uniform(-1e4, 1e4, size=(2000, 1))
+        query = data[:5] + gen.standard_normal(size=(5, 250))
+        dates = np.arange(250)
+        expected = np.corrcoef(data.astype("float32").astype("float64"),
+                               query.astype("float32").astype("float64"))[:2000, 2000:]
+
+        pool = PnlPool(data=data.astype("float32"), header=np.arange(2000).astype(str),
+                       dates=dates)
+        query_pool = PnlPool(data=query.astype("float32"), header=np.arange(5).astype(str),
+                             dates=dates)
+        corrs = pool.get_correlations(query_pool).as_matrix()
+        self.assertEqual(corrs.dtype, np.float32)
+        self.assertLess(np.abs(corrs - expected).max(), 1e-5)
+
+        # The standardized pool is kept for each window
+        window = pool.standardized_window(start=100)
+        self.assertIs(pool.standardized_window(start=100), window)
+        self.assertTrue(np.allclose(np.square(window, dtype="float64").sum(1), 1))
+        corrs = pool.get_correlations(query_pool, start=100).as_matrix()
+        expected = np.corrcoef(data.astype("float32")[:, 100:].astype("float64"),
+                               query.astype("float32")[:, 100:].astype("float64"))[:2000, 2000:]
+        self.assertLess(np.abs(corrs - expected).max(), 1e-5)
+
+    def test_standardized_windows_kept(self):
+        gen = np.random.default_rng(0)
+        data = gen.standard_normal(size=(50, 40)) + gen.uniform(0, 100, size=(50, 1))
+        dates = np.arange(20090101, 20090141)
+        pool = PnlPool(data=data, header=np.array(["file" + str(i) for i in range(50)]),
+                       dates=dates)
+        query = pool.subset(0, 3)
+
+        def request(start):
+            pool.count_request([(start, None), (start, 20090140)])
+            corrs = pool.get_correlations(query, start=start).as_matrix()
+            expected = np.corrcoef(data[:, start - 20090101:])[:, :3]
+            self.assertLess(np.abs(corrs - expected).max(), 1e-5)
+            self.assertLessEqual(len(pool._standardized), 2)
+
+        for start in [20090101, 20090101, 20090105, 20090110]:
+            request(start)
+        # The third window is calculated a block at a time until it was requested more often
+        # than the second
+        self.assertEqual(set(pool._standardized), {(0, 40), (4, 40)})
+        request(20090110)
+        self.assertEqual(set(pool._standardized), {(0, 40), (9, 40)})
+        # Earlier requests count less, so the first window gives its place once others are
+        # requested instead
+        request(20090105)
+        self.assertEqual(set(pool._standardized), {(0, 40), (9, 40)})
+        request(20090105)
+        self.assertEqual(set(pool._standardized), {(4, 40), (9, 40)})
+
+    def test_get_correlations_reduced_storage(self):
+        gen = np.random.default_rng(0)
+        data = gen.standard_normal(size=(300, 50)) + gen.uniform(0, 10, size=(300, 1))
+        header = np.array(["file" + str(i) for i in range(300)])
+        dates = np.arange(20090101, 20090151)
+        query = PnlPool(data=data[:4] + gen.standard_normal(size=(4, 50)),
+                        header=np.array(["query" + str(i) for i in range(4)]),
+                        dates=dates)
+        expected = np.array([[pearsonr(row, col)[0] for col in query.as_matrix()] for row in data])
+        expected_indices = np.argsort(-np.abs(expected), axis=0)[:5]
+
+        pool = PnlPool(data=data, header=header, dates=dates)
+        for storage in ["float16", "int8"]:
+            compact_pool = PnlPool(data=data, header=header, dates=dates, storage=storage)
+            self.assertLess(compact_pool.nbytes(), pool.nbytes() / 2)
+            self.assertTrue(np.array_equal(compact_pool.as_matrix(), pool.as_matrix()))
+            correlations = compact_pool.get_correlations(query)
+            self.assertTrue(np.allclose(correlations.as_matrix(), expected, atol=0.02))
+            corrs, indices, _ = correlations.top_n_indices_for_col(5)
+            # Top correlations are rescored exactly
+            self.assertTrue(np.array_equal(indices, expected_indices))
+            self.assertTrue(np.allclose(corrs, np.take_along_axis(expected, indices, axis=0)))
+
+        self.assertRaises(ValueError, PnlPool, data=data, header=header, dates=dates,
+                          storage="int4")
+
+    @mock.patch.object(disk_matrix, "DISK_BLOCK_BYTES", 7 * 50 * 4)
+    def test_get_correlations_disk_storage(self):
+        gen = np.random.default_rng(0)
+        data = gen.standard_normal(size=(30, 50)).astype("float32") + 100
+        header = np.array(["file" + str(i) for i in range(30)])
+        dates = np.arange(20090101, 20090151)
+        query = PnlPool(data=data[:3] + gen.standard_normal(size=(3, 50)), header=header[:3],
+                        dates=dates)
+        pool = PnlPool(data=data, header=header, dates=dates)
+        # Blocks of 7 rows, so the last block is a partial one
+        disk_pool = PnlPool(data=data, header=header, dates=dates, storage="disk")
+        self.assertEqual(disk_pool.nbytes(), 0)
+        self.assertTrue(np.array_equal(disk_pool.as_matrix(), data))
+
+        for start in [None, 20090120]:
+            self.assertTrue(np.allclose(disk_pool.window_stats(start=start),
+                                        pool.window_stats(start=start)))
+            self.assertTrue(np.allclose(disk_pool.get_correlations(query, start=start)
+                                        .as_matrix(),
+                                        pool.get_correlations(query, start=start).as_matrix(),
+                                        atol=1e-6))
+        self.assertEqual(disk_pool.nbytes(), 0)
+        cancellation = CancellationToken()
+        cancellation.cancel("client disconnected")
+        self.assertRaises(RequestCancelledError, disk_pool.get_correlations, query,
+                          cancellation=cancellation)
+
+    def test_get_correlations_pruned(self):
+        gen = np.random.default_rng(0)
+        # Pnls around a few common ones, so that the clusters are tight
+        centers = gen.standard_normal(size=(8, 60))
+        data = centers[gen.integers(0, 8, size=400)] * gen.choice([-1, 1], size=(400, 1)) + \
+            gen.standard_normal(size=(400, 60)) * 0.2 + gen.uniform(0, 100, size=(400, 1))
+        header = np.array(["file" + str(i) for i in range(400)])
+        dates = np.arange(20090101, 20090161)
+        query = PnlPool(data=np.vstack([-data[0], data[200], gen.standard_normal(size=60)]) +
+                        gen.standard_normal(size=(3, 60)) * 0.2,
+                        header=np.array(["negative", "positive", "random"]), dates=dates)
+        pool = PnlPool(data=data, header=header, dates=dates)
+        pruned_pool = PnlPool(data=data, header=header, dates=dates, pruning_clusters=20)
+
+        for start, top in [(None, 5), (20090110, 5), (None, 1), (None, 50)]:
+            corrs, names, _ = pool.get_correlations(query, start=start).top_n_corrs_for_col(top)
+            correlations = pruned_pool.get_correlations(query, start=start, top=top)
+            self.assertEqual(correlations.num_pool_rows(), 400)
+            pruned_corrs, pruned_names, _ = correlations.top_n_corrs_for_col(top)
+            self.assertTrue(np.array_equal(pruned_names, names))
+            self.assertTrue(np.allclose(pruned_corrs, corrs, atol=1e-6))
+            # Each column alone only needs the rows of a few clusters
+            for column in range(2):
+                single = pruned_pool.get_correlations(query.select_by_indices([column]),
+                                                      start=start, top=top)
+                self.assertLess(len(single.row_names()), 400)
+                self.assertTrue(np.array_equal(single.top_n_corrs_for_col(top)[1],
+                                               names[:, [column]]))
+        self.assertTrue(np.array_equal(pruned_pool.get_correlations(query, top=400).as_matrix(),
+                                       pool.get_correlations(query).as_matrix()))
+
+    def test_get_correlations_cancelled(self):
+        pool = PnlPool(_get_pool_directory_path("multiple_file_pool"))
+        cancellation = CancellationToken()
+        cancellation.cancel("client disconnected")
+        self.assertRaises(RequestCancelledError, pool.get_correlations, pool,
+                          cancellation=cancellation)
+        self.assertRaises(RequestCancelledError, pool.get_correlations, pool,
+                          cancellation=CancellationToken(timeout=-1))
+        pool.get_correlations(pool, cancellation=CancellationToken(timeout=60))
+
+    def test_select_and_concatenate(self):
+        pool = PnlPool(_get_pool_directory_path("multiple_file_pool"))
+        names = list(pool.headers())
+        selected = pool.select_by_names([names[2], names[0]])
+        self.assertTrue(np.array_equal(selected.headers(), [names[2], names[0]]))
+        self.assertTrue(np.array_equal(selected.as_matrix(), pool.as_matrix()[[2, 0]]))
+        self.assertRaises(ValueError, pool.select_by_names, ["unknown"])
+
+        mean, std = pool.window_stats(start=20090102)
+        self.assertTrue(np.allclose(mean, pool.as_matrix_for_days(start=20090102).mean(1)))
+        self.assertTrue(np.allclose(std, pool.as_matrix_for_days(start=20090102).std(1)))
+        # Statistics calculated for each part are kept when combining them
+        combined = PnlPool.concatenate([pool.subset(1, 3), selected])
+        self.assertTrue(np.array_equal(combined.headers(), names[1:3] + [names[2], names[0]]))
+        self.assertTrue(np.array_equal(combined.window_stats(start=20090102)[0],
+                                       mean[[1, 2, 2, 0]]))
+        # Parts without them, such as uploaded pnls, only calculate their own
+        uploaded = PnlPool(data=pool.as_matrix()[:2], header=np.array(["up1", "up2"]),
+                           dates=pool.dates())
+        combined = PnlPool.concatenate([uploaded, selected])
+        self.assertIn(pool._day_indices(start=20090102), combined._window_stats)
+        self.assertTrue(np.allclose(combined.window_stats(start=20090102)[0],
+                                    mean[[0, 1, 2, 0]]))
+        other_dates = PnlPool(data=np.array([[1, 2]]), header=np.array(["other"]),
+                              dates=np.array([20090101, 20090102]))
+        self.assertRaises(ValueError, PnlPool.concatenate, [pool, other_dates])
+
+    def test_load_in_chunks(self):
+        full = PnlPool(_get_pool_directory_path("multiple_file_pool"))
+        on_disk = PnlPool(_get_pool_directory_path("multiple_file_pool"), storage="disk")
+        self.assertTrue(np.array_equal(on_disk.as_matrix(), full.as_matrix()))
+        pool = PnlPool(_get_pool_directory_path("multiple_file_pool"), load=False)
+        self.assertEqual(pool.loading_progress(), (0, 0))
+        self.assertFalse(pool.is_loaded())
+        self.assertFalse(pool.load_next(0))
+        self.assertEqual(pool.loading_progress(), (1, 3))
+        self.assertFalse(pool.is_loaded())
+        self.assertTrue(np.array_equal(pool.headers(), ["pnl_0"]))
+        self.assertEqual(pool.get_correlations(full).as_matrix().shape, (1, 3))
+        pool.window_stats()
+
+        self.assertTrue(pool.load_next(5))
+        self.assertEqual(pool.loading_progress(), (3, 3))
+        self.assertTrue(np.array_equal(pool.as_matrix(), full.as_matrix()))
+        self.assertTrue(np.array_equal(pool.headers(), full.headers()))
+        # Statistics from before are dropped once more files are read
+        self.assertEqual(len(pool.window_stats()[0]), 3)
+
+        with tempfile.TemporaryDirectory() as empty_dir:
+            pool = PnlPool(empty_dir, load=False)
+            self.assertRaises(ValueError, pool.load_next, 1)
+            self.assertIn("No pnl file found", pool.loading_error())
+
 
 def _get_pool_directory_path(dir_name):
     cur_path = os.path.dirname(os.path.realpath(__file__))
@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+
+from model.pnl_pool import PnlPool
+from model.pool_registry import PoolRegistry
+
+
+class PoolRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        gen = np.random.default_rng(0)
+        dates = np.arange(20090101, 20090131)
+        self.pools = {name: PnlPool(data=gen.standard_normal(size=(100, 30)).astype("float32"),
+                                    header=np.array(["pnl_" + str(i) for i in range(100)]),
+                                    dates=dates)
+                      for name in ["us", "eu", "asia"]}
+        self.pool_bytes = self.pools["us"].nbytes()
+
+    def test_get(self):
+        registry = PoolRegistry(self.pools, default="eu")
+        self.assertIs(registry.get(), self.pools["eu"])
+        self.assertIs(registry.get("asia"), self.pools["asia"])
+        self.assertRaises(ValueError, registry.get, "unknown")
+        self.assertEqual(registry.names(), ["us", "eu", "asia"])
+        self.assertEqual(registry.stats()["eu"]["requests"], 1)
+        self.assertTrue(registry.stats()["eu"]["default"])
+        self.assertRaises(ValueError, PoolRegistry, self.pools, default="unknown")
+
+    def test_memory_budget(self):
+        registry = PoolRegistry(self.pools, memory_budget=2 * self.pool_bytes)
+        query = self.pools["us"].subset(0, 2)
+        expected = self.pools["us"].get_correlations(query).as_matrix()
+        # Keeps the standardized window from the correlations above, which counts as well
+        self.assertGreater(self.pools["us"].nbytes(), self.pool_bytes)
+
+        registry.get("eu")
+        registry.get("asia")
+        stats = registry.stats()
+        self.assertFalse(stats["us"]["resident"])
+        self.assertEqual(stats["us"]["demotions"], 1)
+        self.assertEqual(stats["us"]["bytes"], 0)
+        self.assertTrue(stats["eu"]["resident"] and stats["asia"]["resident"])
+
+        # Using the demoted pool again brings it back, demoting the least recently used one
+        self.assertIs(registry.get("us"), self.pools["us"])
+        stats = registry.stats()
+        self.assertTrue(stats["us"]["resident"])
+        self.assertFalse(stats["eu"]["resident"])
+        self.assertEqual(sum(pool["bytes"] for pool in stats.values()), 2 * self.pool_bytes)
+        self.assertTrue(np.allclose(self.pools["us"].get_correlations(query).as_matrix(),
+                                    expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import numpy as np
+
+from model.correlation_request import CorrelationRequest
+from model.pnl_pool import PnlPool
+from utils.request_utils import RequestDecoder, decode_request, decode_request_params, \
+    decode_timeout, encode_request
+
+
+class RequestUtilsTest(unittest.TestCase):
+
+    def test_encode_and_decode_request(self):
+        pool = PnlPool(data=np.array([[1.5, 2, 3], [4, 5, 6.25]]),
+                       header=np.array(["file1", "file2"]),
+                       dates=np.array([20090101, 20090102, 20090105]))
+        data = encode_request(CorrelationRequest(pool, start=20090102, end=None, top=3,
+                                                 pool="us", windows=[(None, 20090102),
+                                                                     (20090102, None)]))
+
+        # Decoding the whole body at once and in chunks that split the parameters
+        # and the pnls should give the same request
+        decoders = [RequestDecoder(), RequestDecoder()]
+        decoders[0].feed(data)
+        for i in range(0, len(data), 7):
+            decoders[1].feed(data[i:i + 7])
+        for decoder in decoders:
+            request = decoder.finish()
+            self.assertEqual(request.pnl_data.as_matrix().dtype, np.float32)
+            self.assertTrue(np.array_equal(request.pnl_data.as_matrix(), pool.as_matrix()))
+            self.assertTrue(np.array_equal(request.pnl_data.headers(), pool.headers()))
+            self.assertTrue(np.array_equal(request.pnl_data.dates(), pool.dates()))
+            self.assertEqual((request.start, request.end, request.top, request.pool),
+                             (20090102, None, 3, "us"))
+            self.assertEqual(request.column_windows(), [(None, 20090102), (20090102, None)])
+
+    def test_decode_malformed_request(self):
+        pool = PnlPool(data=np.array([[1, 2]]), header=np.array(["file1"]),
+                       dates=np.array([20090101, 20090102]))
+        data = encode_request(CorrelationRequest(pool))
+        self.assertRaises(ValueError, decode_request, data[:-1])
+        self.assertRaises(ValueError, decode_request, data + b"0")
+        self.assertRaises(ValueError, decode_request, b"not json\n")
+        self.assertRaises(ValueError, decode_request, data.replace(b"[1, 2]", b"[2, 2]"))
+        self.assertRaises(ValueError, decode_request, data.replace(b'"header"', b'"other"'))
+        self.assertRaises(ValueError, decode_request, data.replace(b'["file1"]', b'"f"'))
+        # Shapes are checked against the largest body before the pnls are allocated
+        decoder = RequestDecoder(max_body_size=len(data) - 1)
+        decoder.feed(data)
+        self.assertEqual(len(decoder.finish().pnl_data.headers()), 1)
+        decoder = RequestDecoder(max_body_size=7)
+        self.assertRaises(ValueError, decoder.feed, data)
+
+    def test_decode_request_params(self):
+        pool = PnlPool(data=np.array([[1, 2], [3, 4]]), header=np.array(["file1", "file2"]),
+                       dates=np.array([20090101, 20090102]))
+        data = encode_request(CorrelationRequest(pool, top=3, alpha_ids=["a"],
+                                                 pool_names=["b", "c"]))
+        # The pnls are not read, so a body cut short still gives the parameters
+        self.assertEqual(decode_request_params(data[:-1]), (3, 5))
+        self.assertRaises(ValueError, decode_request_params, data[:10])
+        self.assertRaises(ValueError, decode_request_params, b"not json\n")
+        self.assertRaises(ValueError, decode_request_params, b"[]\n")
+        self.assertRaises(ValueError, decode_request_params,
+                          data.replace(b'"header"', b'"other"'))
+        self.assertRaises(ValueError, decode_request_params,
+                          data.replace(b'"top": 3', b'"top": "3"'))
+
+    def test_decode_timeout(self):
+        self.assertIsNone(decode_timeout(None))
+        self.assertEqual(decode_timeout("0"), 0)
+        self.assertEqual(decode_timeout("2.5"), 2.5)
+        for timeout in ["soon", "nan", "inf", "-1"]:
+            self.assertRaises(ValueError, decode_timeout, timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
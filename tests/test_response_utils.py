@@ -0,0 +1,39 @@
+import json
+import unittest
+import numpy as np
+
+from model.correlation_response import CorrelationResponse
+from utils.response_utils import build_response, decode_response
+
+
+class ResponseUtilsTest(unittest.TestCase):
+
+    def test_build_and_decode_response(self):
+        corrs = np.array([[0.9, -0.8],
+                          [0.5, 0.4]], dtype="float32")
+        indices = np.array([[3, 0],
+                            [0, 3]])
+        row_names = np.array(["pnl_0", "pnl_1", "pnl_2", "pnl_3"])
+        response = CorrelationResponse(corrs, indices, row_names, np.array(["col1", "col2"]))
+
+        data = build_response(response)
+        # Only the names referenced by the top correlations are sent
+        self.assertEqual(sorted(json.loads(data)["row_names"]), ["pnl_0", "pnl_3"])
+
+        decoded = decode_response(data)
+        self.assertEqual(decoded.corrs_matrix.dtype, np.float32)
+        self.assertTrue(np.array_equal(decoded.corrs_matrix, corrs))
+        self.assertTrue(np.array_equal(decoded.names_matrix, np.array([["pnl_3", "pnl_0"],
+                                                                       ["pnl_0", "pnl_3"]])))
+        self.assertTrue(np.array_equal(decoded.col_names, np.array(["col1", "col2"])))
+        self.assertEqual(decoded.to_string(), response.to_string())
+        self.assertFalse(decoded.partial)
+
+        response.errors = ["shard failed"]
+        decoded = decode_response(build_response(response))
+        self.assertTrue(decoded.partial)
+        self.assertEqual(decoded.errors, ["shard failed"])
+
+
+if __name__ == '__main__':
+    unittest.main()
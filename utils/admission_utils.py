@@ -0,0 +1,92 @@
+"""
+Module for limiting how many correlation requests the server works on at a time.
+The server should call admit() as soon as a request arrives, rejecting the request
+if it returns False, wait for a computing slot with slot(), compute the request in
+worker threads with execute() while holding the slot, and call release() once the
+request is finished.
+"""
+import contextlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import tornado.ioloop
+import tornado.locks
+import tornado.util
+
+from model.cancellation import RequestCancelledError
+
+
+class AdmissionController:
+    """
+    Bounds the number of requests computing at once and the number waiting for their turn.
+    Computation runs in worker threads (numpy releases the GIL), which keeps the IOLoop free
+    to accept, reject and notice disconnected clients while requests are being computed
+    """
+
+    def __init__(self, max_concurrent=1, max_queued=16, retry_after=1):
+        """
+        Parameters
+        ----------
+        max_concurrent (int): number of requests computed at the same time
+        max_queued (int): number of requests that can wait for a computing slot. Requests
+                          beyond that are rejected
+        retry_after (int): seconds rejected clients should wait before retrying
+        """
+        self.retry_after = retry_after
+        self._max_pending = max_concurrent + max_queued
+        self._pending = 0
+        self._slots = tornado.locks.Semaphore(max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent)
+
+    def admit(self):
+        """
+        Returns
+        -------
+        True if the request can be accepted, in which case release() must be called once the
+        request is finished. False if too many requests are already pending
+        """
+        if self._pending >= self._max_pending:
+            return False
+        self._pending += 1
+        return True
+
+    def release(self):
+        """
+        Marks an admitted request as finished
+        """
+        self._pending -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cancellation):
+        """
+        Waits for a computing slot, which is held until the end of the with block
+
+        Parameters
+        ----------
+        cancellation (CancellationToken): token of the request. Raises RequestCancelledError
+                                          if the request is cancelled while waiting
+        """
+        remaining = cancellation.remaining()
+        try:
+            await self._slots.acquire(
+                timeout=None if remaining is None else datetime.timedelta(seconds=remaining))
+        except tornado.util.TimeoutError:
+            raise RequestCancelledError("deadline exceeded while waiting in queue")
+        try:
+            cancellation.check()
+            yield
+        finally:
+            self._slots.release()
+
+    async def execute(self, func):
+        """
+        Calls func in a worker thread. Should only be called while holding a slot
+
+        Parameters
+        ----------
+        func (callable): the computation, taking no arguments
+
+        Returns
+        -------
+        The result of func
+        """
+        return await tornado.ioloop.IOLoop.current().run_in_executor(self._executor, func)
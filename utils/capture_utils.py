@@ -0,0 +1,194 @@
+"""
+Module for recording the correlation requests a server receives, so that they can be replayed
+against another server with replay_traffic.py.
+The server creates a TrafficRecorder only if capture is enabled, and calls start() when each
+request arrives, which returns a RequestCapture if the request fits in the capture. The body is
+added to it as it is received, and it is written with RequestCapture.finish() once the request
+is answered. Requests rejected before their body is received are written without it, with
+reject().
+
+A capture file starts with CAPTURE_MAGIC, followed by one record per request: the arrival time
+(float64 seconds since the epoch), the body size in bytes (uint64), the time taken to answer
+(float32 seconds), the status of the response (uint16) and whether the body follows (uint8), all
+little endian, then the body exactly as it was received, an encoded request as made by
+request_utils.encode_request().
+"""
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CAPTURE_MAGIC = b"PNLCAP1\n"
+
+_RECORD = struct.Struct("<dQfHB")
+
+
+class TrafficRecorder:
+    """
+    Appends the requests of a server to a capture file. Records are written in a background
+    thread, in the order requests are answered, so that the server never waits on the file
+    """
+
+    def __init__(self, path, max_bytes=None):
+        """
+        Parameters
+        ----------
+        path (str): capture file, appended to if it exists. Raises ValueError if it is not a
+                    capture file
+        max_bytes (int): size the capture file may grow to, after which requests are no longer
+                         recorded. If None, no limit
+        """
+        self._file = open(path, "ab+")
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+        else:
+            self._file.seek(0)
+            magic = self._file.read(len(CAPTURE_MAGIC))
+            if magic != CAPTURE_MAGIC:
+                self._file.close()
+                raise ValueError("{} is not a capture file".format(path))
+            self._file.seek(0, os.SEEK_END)
+        self._max_bytes = max_bytes
+        # Bytes of the file, including the records that are not written yet
+        self._size = self._file.tell()
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1)
+
+    def start(self, body_size=None):
+        """
+        Parameters
+        ----------
+        body_size (int): size of the request's body, if known before it is received
+
+        Returns
+        -------
+        A RequestCapture to add the body of the request to, or None if the capture is full
+        """
+        if self._max_bytes is not None and self._size + _RECORD.size + (body_size or 0) > \
+                self._max_bytes:
+            return None
+        return RequestCapture(self, body_size)
+
+    def reject(self, body_size, status):
+        """
+        Records a request answered before its body was received, with the size it announced
+        but without its body, unless the capture file is full
+
+        Parameters
+        ----------
+        body_size (int): size of the request's body, if it was announced
+        status (int): status of the response
+        """
+        self._write(RequestCapture(self, body_size), status, has_body=False)
+
+    def close(self):
+        """
+        Writes the pending records and closes the capture file
+        """
+        self._writer.shutdown(wait=True)
+        self._file.close()
+
+    def _write(self, capture, status, has_body=True):
+        """
+        Queues the record of a request to be written
+
+        Parameters
+        ----------
+        capture (RequestCapture): the request to write
+        status (int): status of the response
+        has_body (bool): whether the body was received. If False, only the size the request
+                         announced is written
+        """
+        chunks = capture.chunks if has_body else []
+        stored_size = sum(len(chunk) for chunk in chunks)
+        body_size = stored_size if has_body else capture.body_size or 0
+        with self._lock:
+            if self._max_bytes is not None and \
+                    self._size + _RECORD.size + stored_size > self._max_bytes:
+                return
+            self._size += _RECORD.size + stored_size
+        record = _RECORD.pack(capture.arrival, body_size, time.time() - capture.arrival, status,
+                              has_body)
+        self._writer.submit(self._append, [record] + chunks)
+
+    def _append(self, chunks):
+        """
+        Writes a record to the capture file. Runs in the writer thread
+
+        Parameters
+        ----------
+        chunks (list(bytes)): the record followed by the body of the request
+        """
+        self._file.writelines(chunks)
+        self._file.flush()
+
+
+class RequestCapture:
+    """
+    The arrival time and body of a request being received
+    """
+
+    def __init__(self, recorder, body_size=None):
+        """
+        Parameters
+        ----------
+        recorder (TrafficRecorder): recorder to write the request to
+        body_size (int): size of the request's body, if known before it is received
+        """
+        self._recorder = recorder
+        self.arrival = time.time()
+        self.body_size = body_size
+        self.chunks = []
+
+    def add(self, chunk):
+        """
+        Parameters
+        ----------
+        chunk (bytes): the next part of the request's body
+        """
+        self.chunks.append(chunk)
+
+    def finish(self, status):
+        """
+        Records the request, unless the capture file is full
+
+        Parameters
+        ----------
+        status (int): status of the response
+        """
+        self._recorder._write(self, status)
+
+
+def read_capture(path):
+    """
+    Reads the requests recorded in a capture file, one at a time
+
+    Parameters
+    ----------
+    path (str): capture file written by a TrafficRecorder
+
+    Returns
+    -------
+    Generator of (arrival, body, duration, status, body_size) for each request, in the order
+    they were answered, where body is the bytes of the encoded request, or None if the request
+    was rejected before its body was received, and body_size is the size of the body, 0 if
+    such a request did not announce it
+    """
+    with open(path, "rb") as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("{} is not a capture file".format(path))
+        while True:
+            header = capture.read(_RECORD.size)
+            if len(header) == 0:
+                return
+            if len(header) < _RECORD.size:
+                raise ValueError("Capture file ends in the middle of a record")
+            arrival, body_size, duration, status, has_body = _RECORD.unpack(header)
+            body = None
+            if has_body:
+                body = capture.read(body_size)
+                if len(body) < body_size:
+                    raise ValueError("Capture file ends in the middle of a record")
+            yield arrival, body, duration, status, body_size
+
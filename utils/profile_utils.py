@@ -0,0 +1,136 @@
+"""
+Module for profiling individual requests on a running server.
+The server creates a RequestProfiler only if profiling is enabled, and calls start() for
+each request, which returns a RequestProfile if that request should be profiled. The
+request's computation is run through RequestProfile.call() and the reports are written
+with RequestProfile.finish() once the request is done.
+"""
+import cProfile
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+# Header a client sets to "1" to ask for its request to be profiled
+PROFILE_HEADER = "X-Profile"
+
+# tracemalloc traces the whole process, so it stays on while any profiled request is running
+_tracing_lock = threading.Lock()
+_tracing_requests = 0
+# Only one cProfile profiler can be enabled at a time
+_profiling_lock = threading.Lock()
+
+
+class RequestProfiler:
+    """
+    Decides which requests are profiled, and where their reports are written
+    """
+
+    def __init__(self, output_dir, sample_rate=0, top_allocations=25, trace_frames=10):
+        """
+        Parameters
+        ----------
+        output_dir (str): directory to write reports to, created if missing
+        sample_rate (float): fraction of requests to profile without the client asking for it
+        top_allocations (int): number of lines with the most allocated memory to report
+        trace_frames (int): number of frames tracemalloc keeps for each allocation
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        self._output_dir = output_dir
+        self._sample_rate = sample_rate
+        self._top_allocations = top_allocations
+        self._trace_frames = trace_frames
+
+    def start(self, headers):
+        """
+        Parameters
+        ----------
+        headers (dict): headers of the request
+
+        Returns
+        -------
+        A started RequestProfile if the request should be profiled, else None
+        """
+        if headers.get(PROFILE_HEADER) != "1" and random.random() >= self._sample_rate:
+            return None
+        return RequestProfile(self._output_dir, self._top_allocations, self._trace_frames)
+
+
+class RequestProfile:
+    """
+    Profiles the calls made for a single request with cProfile, and the memory allocated
+    while the request runs with tracemalloc
+    """
+
+    def __init__(self, output_dir, top_allocations, trace_frames):
+        """
+        Parameters
+        ----------
+        output_dir (str): directory to write reports to
+        top_allocations (int): number of lines with the most allocated memory to report
+        trace_frames (int): number of frames tracemalloc keeps for each allocation
+        """
+        global _tracing_requests
+        self._output_dir = output_dir
+        self._top_allocations = top_allocations
+        self._profile = cProfile.Profile()
+        self._start_time = time.time()
+        with _tracing_lock:
+            if _tracing_requests == 0:
+                tracemalloc.start(trace_frames)
+            _tracing_requests += 1
+
+    def call(self, func):
+        """
+        Calls func under cProfile. Can be called from any thread, several times, with all
+        calls reported together. If another request is being profiled at the same time,
+        func is called without being profiled
+
+        Parameters
+        ----------
+        func (callable): function taking no arguments
+
+        Returns
+        -------
+        The result of func
+        """
+        if not _profiling_lock.acquire(blocking=False):
+            return func()
+        try:
+            return self._profile.runcall(func)
+        finally:
+            _profiling_lock.release()
+
+    def finish(self, tags):
+        """
+        Stops profiling and writes a cProfile dump (.prof, readable with pstats or snakeviz)
+        and a report of the lines that allocated the most memory (.alloc.txt)
+
+        Parameters
+        ----------
+        tags (dict): describes the request (e.g. size, dates, pool size), added to the
+                     name of the reports
+        """
+        global _tracing_requests
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        with _tracing_lock:
+            _tracing_requests -= 1
+            if _tracing_requests == 0:
+                tracemalloc.stop()
+
+        name = "_".join([time.strftime("%Y%m%d-%H%M%S", time.localtime(self._start_time)),
+                         "{:06d}".format(int(self._start_time * 1e6) % 1000000)] +
+                        ["{}-{}".format(key, value) for key, value in tags.items()])
+        path = os.path.join(self._output_dir, name)
+        self._profile.dump_stats(path + ".prof")
+        with open(path + ".alloc.txt", "w") as report:
+            report.write("Request: {}\n".format(tags))
+            report.write("Took {:.4f}s\n".format(time.time() - self._start_time))
+            report.write("Traced memory: current {:.1f}MB, peak {:.1f}MB\n"
+                         .format(current / 2 ** 20, peak / 2 ** 20))
+            report.write("Top {} allocating lines:\n".format(self._top_allocations))
+            for stat in snapshot.statistics("lineno")[:self._top_allocations]:
+                report.write(str(stat) + "\n")
+        print("Wrote profile of request to " + path)
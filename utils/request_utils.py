@@ -1,17 +1,34 @@
 """
 Module for consistent handling of client request.
-Client should send request as a CorrelationRequest object using send_request() and
-server should use decode_request() to get CorrelationRequest specified by the client.
+Client should send request as a CorrelationRequest object using send_request() (or
+stream_request() to get results as the server sends them) and
+server should use decode_request() (or a RequestDecoder, if the body arrives in chunks)
+to get CorrelationRequest specified by the client.
+
+A request is a single line of json holding the request parameters and the header and dates
+of the pnls, followed by the pnls as raw little endian float32 values, one pnl after the other.
+This way the server can allocate the pnl matrix as soon as the first line arrives and copy
+the rest of the body into it as it is received.
 """
 import json
+import math
+import numpy as np
 import requests
 
 from model.correlation_request import CorrelationRequest
+from model.correlation_response import CorrelationResponse
 from model.pnl_pool import PnlPool
-from utils.response_utils import decode_response
+from utils.response_utils import decode_response_stream
+
+# Header with the number of seconds the client is willing to wait for its request
+TIMEOUT_HEADER = "X-Request-Timeout"
+# Path pnls are registered at, so that later requests can refer to them by ID
+REGISTER_PATH = "/register"
+
+_PNL_DTYPE = np.dtype("<f4")
 
 
-def send_request(host, port, request):
+def send_request(host, port, request, timeout=None):
     """
     Sends correlation request to a correlation server and throws
     exception with message from server if request fails.
@@ -21,19 +38,125 @@ def send_request(host, port, request):
     host (str): hostname of the server
     port (int): port the server runs on
     request (CorrelationRequest): request to send
+    timeout (float): seconds to wait for the response. Also sent to the server, which stops
+                     working on the request once it passes. If None, waits indefinitely
 
     Returns
     -------
     A CorrelationResponse object representing top correlations if the request succeeds
     """
-    payload = {_RequestField.TOP: request.top,
-               _RequestField.START_DATE: request.start,
-               _RequestField.END_DATE: request.end,
-               _RequestField.PNL_DATA: request.pnl_data.to_json()}
-    response = requests.post(_build_url(host, port), json=payload)
+    return CorrelationResponse.concatenate(list(stream_request(host, port, request, timeout)))
+
+
+def stream_request(host, port, request, timeout=None, body=None):
+    """
+    Same as send_request, but returns the results for each group of columns as soon as
+    the server sends them
+
+    Parameters
+    ----------
+    host (str): hostname of the server
+    port (int): port the server runs on
+    request (CorrelationRequest): request to send, can be None if body is given
+    timeout (float): seconds to wait for the response. Also sent to the server, which stops
+                     working on the request once it passes. If None, waits indefinitely
+    body (bytes): request already encoded with encode_request(), such as one recorded by a
+                  server, sent as is without decoding its pnls. If None, request is encoded
+
+    Returns
+    -------
+    Generator of CorrelationResponse objects, each representing top correlations for a group
+    of columns, in order
+    """
+    headers = {"Content-Type": "application/octet-stream"}
+    if timeout is not None:
+        headers[TIMEOUT_HEADER] = str(timeout)
+    if body is None:
+        body = encode_request(request)
+    num_pnls = decode_request_params(body)[1] if request is None else request.num_pnls()
+    response = requests.post(_build_url(host, port), data=body,
+                             headers=headers, timeout=timeout, stream=True)
     if response.status_code != 200:
         raise ValueError(response.text)
-    return decode_response(response.text)
+    received_cols = 0
+    for group in decode_response_stream(response.iter_lines()):
+        received_cols += len(group.col_names)
+        yield group
+    if received_cols != num_pnls:
+        raise ValueError("Server stopped responding after {} of {} pnls"
+                         .format(received_cols, num_pnls))
+
+
+def register_pnls(host, port, pnl_data, pool=None):
+    """
+    Registers pnls with a correlation server, so that later requests can refer to them by ID
+    instead of sending them again. Throws exception with message from server if it fails
+
+    Parameters
+    ----------
+    host (str): hostname of the server
+    port (int): port the server runs on
+    pnl_data (PnlPool): pnls to register
+    pool (str): name of the server's pool the pnls will be used with, which must have the
+                same dates. If None, the server's default pool
+
+    Returns
+    -------
+    list(str) of the IDs of the pnls, in the same order as pnl_data
+    """
+    response = requests.post(_build_url(host, port) + REGISTER_PATH,
+                             data=encode_request(CorrelationRequest(pnl_data, pool=pool)),
+                             headers={"Content-Type": "application/octet-stream"})
+    if response.status_code != 200:
+        raise ValueError(response.text)
+    return json.loads(response.text)[_RequestField.ALPHA_IDS]
+
+
+def encode_registered_ids(ids):
+    """
+    Creates the server's response to register_pnls()
+
+    Parameters
+    ----------
+    ids (list(str)): IDs of the registered pnls
+
+    Returns
+    -------
+    A string representation of the IDs
+    """
+    return json.dumps({_RequestField.ALPHA_IDS: ids})
+
+
+def encode_request(request):
+    """
+    Creates the message to send to the server for a CorrelationRequest object
+
+    Parameters
+    ----------
+    request (CorrelationRequest): request to encode
+
+    Returns
+    -------
+    The bytes of the request, to be decoded with decode_request()
+    """
+    params = {_RequestField.TOP: request.top,
+              _RequestField.START_DATE: request.start,
+              _RequestField.END_DATE: request.end,
+              _RequestField.ALPHA_IDS: request.alpha_ids,
+              _RequestField.POOL_NAMES: request.pool_names,
+              _RequestField.POOL: request.pool,
+              _RequestField.WINDOWS: request.windows,
+              _RequestField.HEADER: [],
+              _RequestField.DATES: [],
+              _RequestField.SHAPE: [0, 0]}
+    if request.pnl_data is None:
+        return json.dumps(params).encode("utf-8") + b"\n"
+    pnl_data = request.pnl_data.as_matrix()
+    params[_RequestField.HEADER] = request.pnl_data.headers().tolist()
+    params[_RequestField.DATES] = request.pnl_data.dates().tolist()
+    params[_RequestField.SHAPE] = list(pnl_data.shape)
+    return (json.dumps(params).encode("utf-8") + b"\n" +
+            np.ascontiguousarray(pnl_data, dtype=_PNL_DTYPE).tobytes())
 
 
 def decode_request(request):
@@ -42,17 +165,158 @@ def decode_request(request):
 
     Parameters
     ----------
-    request (str): the message to be decoded
+    request (bytes): the message to be decoded
 
     Returns
     -------
     A CorrelationRequest object storing information about client request
     """
-    data = json.loads(request)
-    return CorrelationRequest(PnlPool.from_json(data[_RequestField.PNL_DATA]),
-                              start=data[_RequestField.START_DATE],
-                              end=data[_RequestField.END_DATE],
-                              top=data[_RequestField.TOP])
+    decoder = RequestDecoder()
+    decoder.feed(request)
+    return decoder.finish()
+
+
+def decode_timeout(timeout):
+    """
+    Parameters
+    ----------
+    timeout (str): value of the TIMEOUT_HEADER of a request, None if it was not sent
+
+    Returns
+    -------
+    The number of seconds the client waits for the response, None if it waits indefinitely.
+    Raises ValueError if timeout is not a finite number of seconds, at least 0
+    """
+    if timeout is None:
+        return None
+    try:
+        seconds = float(timeout)
+    except ValueError:
+        seconds = None
+    if seconds is None or not math.isfinite(seconds) or seconds < 0:
+        raise ValueError("{} header must be a number of seconds, at least 0".format(
+            TIMEOUT_HEADER))
+    return seconds
+
+
+def decode_request_params(request):
+    """
+    Reads what a coordinator needs from a request without decoding its pnls, which are
+    forwarded to the shards as they are
+
+    Parameters
+    ----------
+    request (bytes): the encoded request
+
+    Returns
+    -------
+    (top, num_pnls) where top is the number of top correlations requested and num_pnls the
+    number of pnls of the request. Raises ValueError if the parameters are malformed
+    """
+    end_of_params = request.find(b"\n")
+    if end_of_params < 0:
+        raise ValueError("Request is incomplete")
+    try:
+        params = json.loads(request[:end_of_params])
+        top = params.get(_RequestField.TOP, 10)
+        pnl_lists = [params[_RequestField.HEADER], params.get(_RequestField.ALPHA_IDS) or [],
+                     params.get(_RequestField.POOL_NAMES) or []]
+    except (AttributeError, KeyError, json.JSONDecodeError) as err:
+        raise ValueError("Could not read request parameters: {}".format(err))
+    if not isinstance(top, int) or not all(isinstance(pnls, list) for pnls in pnl_lists):
+        raise ValueError("Request top must be an int and its pnls lists")
+    return top, sum(len(pnls) for pnls in pnl_lists)
+
+
+class RequestDecoder:
+    """
+    Decodes a request one chunk at a time, copying the pnls straight into their final matrix
+    """
+
+    def __init__(self, max_body_size=None):
+        """
+        Parameters
+        ----------
+        max_body_size (int): largest body accepted, the pnl matrix is only allocated if it
+                             fits. If None, any size
+        """
+        self._max_body_size = max_body_size
+        self._params = None
+        self._param_chunks = []
+        self._pnl_data = None
+        self._pnl_bytes = None
+        self._received = 0
+
+    def feed(self, chunk):
+        """
+        Decodes the next chunk of the request. Raises ValueError if the request is malformed
+
+        Parameters
+        ----------
+        chunk (bytes): the next part of the request
+        """
+        if self._params is None:
+            end_of_params = chunk.find(b"\n")
+            if end_of_params < 0:
+                self._param_chunks.append(chunk)
+                return
+            self._param_chunks.append(chunk[:end_of_params])
+            self._start(b"".join(self._param_chunks))
+            chunk = chunk[end_of_params + 1:]
+        if self._received + len(chunk) > len(self._pnl_bytes):
+            raise ValueError("Request has more pnl data than its shape")
+        self._pnl_bytes[self._received:self._received + len(chunk)] = np.frombuffer(chunk, "uint8")
+        self._received += len(chunk)
+
+    def finish(self):
+        """
+        Returns
+        -------
+        The CorrelationRequest object for all the chunks fed so far. Raises ValueError if the
+        request is incomplete
+        """
+        if self._params is None or self._received != len(self._pnl_bytes):
+            raise ValueError("Request is incomplete")
+        pnl_data = None
+        if len(self._pnl_data) > 0:
+            pnl_data = PnlPool(data=self._pnl_data,
+                               header=self._params[_RequestField.HEADER],
+                               dates=self._params[_RequestField.DATES])
+        return CorrelationRequest(pnl_data,
+                                  start=self._params.get(_RequestField.START_DATE),
+                                  end=self._params.get(_RequestField.END_DATE),
+                                  top=self._params.get(_RequestField.TOP, 10),
+                                  alpha_ids=self._params.get(_RequestField.ALPHA_IDS),
+                                  pool_names=self._params.get(_RequestField.POOL_NAMES),
+                                  pool=self._params.get(_RequestField.POOL),
+                                  windows=self._params.get(_RequestField.WINDOWS))
+
+    def _start(self, params):
+        """
+        Reads the request parameters and allocates the pnl matrix
+
+        Parameters
+        ----------
+        params (bytes): the first line of the request
+        """
+        try:
+            self._params = json.loads(params)
+            shape = tuple(self._params[_RequestField.SHAPE])
+            header = self._params[_RequestField.HEADER]
+            dates = self._params[_RequestField.DATES]
+        except (KeyError, TypeError, json.JSONDecodeError) as err:
+            raise ValueError("Could not read request parameters: {}".format(err))
+        if not isinstance(header, list) or not isinstance(dates, list) or \
+                not all(isinstance(size, int) for size in shape) or \
+                shape != (len(header), len(dates)):
+            raise ValueError("Request shape {} does not match its header and dates".format(shape))
+        # Checked before allocating, so that a request cannot claim more memory than it sends
+        pnl_size = shape[0] * shape[1] * _PNL_DTYPE.itemsize
+        if self._max_body_size is not None and pnl_size > self._max_body_size:
+            raise ValueError("Request pnls take {} bytes, more than the largest body of {} bytes"
+                             .format(pnl_size, self._max_body_size))
+        self._pnl_data = np.empty(shape=shape, dtype=_PNL_DTYPE)
+        self._pnl_bytes = self._pnl_data.reshape(-1).view("uint8")
 
 
 class _RequestField:
@@ -62,7 +326,13 @@ class _RequestField:
     TOP = "top"
     START_DATE = "start_date"
     END_DATE = "end_date"
-    PNL_DATA = "pnl_data"
+    ALPHA_IDS = "alpha_ids"
+    POOL_NAMES = "pool_names"
+    POOL = "pool"
+    WINDOWS = "windows"
+    HEADER = "header"
+    DATES = "dates"
+    SHAPE = "shape"
 
 
 def _build_url(host, port):
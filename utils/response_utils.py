@@ -2,14 +2,26 @@
 Module for consistent handling of server responses.
 The server should use build_response() to create response for client and
 the client should use decode_response() to decode the server's response.
+Large requests are answered one group of columns at a time, with one response per
+line, which the client decodes as they arrive with decode_response_stream(). If the server
+fails after sending some groups, it ends the response with a line built by build_error().
 Functionality (creating the json and decoding the json) could be delegated
 to the CorrelationResponse class (like in the case of PnlPool)
+
+Instead of a matrix of repeated file names, the response carries the row index of
+each correlation into a deduplicated table of names. Correlations and indices are
+sent as base64 encoded little endian float32 and int32 buffers, which are both
+smaller than their json lists and can be decoded without parsing every number.
 """
+import base64
 import json
 import numpy as np
 
 from model.correlation_response import CorrelationResponse
 
+_CORRS_DTYPE = np.dtype("<f4")
+_INDICES_DTYPE = np.dtype("<i4")
+
 
 def build_response(response):
     """
@@ -23,12 +35,33 @@ def build_response(response):
     -------
     A string representation of the correlation result
     """
-    data = {_ResponseField.CORRS: response.corrs_matrix.tolist(),
-            _ResponseField.NAMES_FOR_CORRS: response.names_matrix.tolist(),
-            _ResponseField.COL_NAMES: response.col_names.tolist()}
+    # Only send the names that are actually referenced, re-indexed into the smaller table
+    used_rows, row_indices = np.unique(response.row_indices, return_inverse=True)
+    data = {_ResponseField.SHAPE: list(response.corrs_matrix.shape),
+            _ResponseField.CORRS: _encode_array(response.corrs_matrix, _CORRS_DTYPE),
+            _ResponseField.ROW_INDICES: _encode_array(row_indices, _INDICES_DTYPE),
+            _ResponseField.ROW_NAMES: response.row_names[used_rows].tolist(),
+            _ResponseField.COL_NAMES: np.asarray(response.col_names).tolist(),
+            _ResponseField.ERRORS: response.errors}
     return json.dumps(data)
 
 
+def build_error(reason):
+    """
+    Builds the last line of a response the server could not finish after sending some groups
+    of columns
+
+    Parameters
+    ----------
+    reason (str): why the server stopped
+
+    Returns
+    -------
+    A string representation of the failure, raised by decode_response_stream()
+    """
+    return json.dumps({_ResponseField.ERROR: reason})
+
+
 def decode_response(data):
     """
     Builds a CorrelationResponse object from json data
@@ -41,16 +74,91 @@ def decode_response(data):
     -------
     A CorrelationResponse resulting from the json data
     """
-    data = json.loads(data)
-    return CorrelationResponse(np.array(data[_ResponseField.CORRS]),
-                               np.array(data[_ResponseField.NAMES_FOR_CORRS]),
-                               np.array(data[_ResponseField.COL_NAMES]))
+    return _decode_fields(json.loads(data))
+
+
+def _decode_fields(data):
+    """
+    Parameters
+    ----------
+    data (dict): fields of a json built by build_response()
+
+    Returns
+    -------
+    The CorrelationResponse holding those fields
+    """
+    shape = tuple(data[_ResponseField.SHAPE])
+    return CorrelationResponse(_decode_array(data[_ResponseField.CORRS], _CORRS_DTYPE, shape),
+                               _decode_array(data[_ResponseField.ROW_INDICES], _INDICES_DTYPE,
+                                             shape),
+                               np.array(data[_ResponseField.ROW_NAMES]),
+                               np.array(data[_ResponseField.COL_NAMES]),
+                               errors=data.get(_ResponseField.ERRORS))
+
+
+def decode_response_stream(lines):
+    """
+    Decodes a response sent as one json per line, one line at a time
+
+    Parameters
+    ----------
+    lines (iterable(str or bytes)): lines of the response, as they are received
+
+    Returns
+    -------
+    Generator of the CorrelationResponse of each line, holding results for a group of columns.
+    Raises ValueError with the server's reason if it could not finish the response
+    """
+    received_cols = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        data = json.loads(line)
+        if _ResponseField.ERROR in data:
+            raise ValueError("Server stopped after {} pnls due to {}"
+                             .format(received_cols, data[_ResponseField.ERROR]))
+        response = _decode_fields(data)
+        received_cols += len(response.col_names)
+        yield response
+
+
+def _encode_array(array, dtype):
+    """
+    Parameters
+    ----------
+    array (ndarray): array to encode
+    dtype (np.dtype): type to convert the array to before encoding
+
+    Returns
+    -------
+    base64 string of the raw bytes of the array
+    """
+    return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode("ascii")
+
+
+def _decode_array(data, dtype, shape):
+    """
+    Parameters
+    ----------
+    data (str): base64 string created by _encode_array
+    dtype (np.dtype): type the array was encoded with
+    shape (tuple): shape of the encoded array
+
+    Returns
+    -------
+    The decoded (read only) ndarray
+    """
+    return np.frombuffer(base64.b64decode(data), dtype=dtype).reshape(shape)
 
 
 class _ResponseField:
     """
     Internal class for consistent field access across build and decode
     """
+    SHAPE = "shape"
     CORRS = "correlations"
-    NAMES_FOR_CORRS = "file_names"
+    ROW_INDICES = "row_indices"
+    ROW_NAMES = "row_names"
     COL_NAMES = "col_names"
+    ERRORS = "errors"
+    ERROR = "error"